@@ -0,0 +1,223 @@
+"""
+Admission control for the request path.
+
+Database work runs in a shared pool of worker threads, so a burst of
+expensive list or export requests could take every thread and make cheap
+point reads queue behind them. Every route is therefore assigned a priority
+class ("point" reads, "scan" reads, "write"s, or a custom class configured
+in ``settings.ADMISSION_ROUTES``), and each class has its own ``Gate``: a
+concurrency limit plus a bounded wait queue. A request finding the queue
+full, or waiting longer than ``settings.ADMISSION_QUEUE_TIMEOUT``, is shed
+with a fast 503 and a ``Retry-After`` header instead of tying up a thread.
+
+A slot is held until the response is fully sent, streamed bodies included:
+``admit`` takes it before the route's dependencies run and
+``AdmissionMiddleware`` gives it back once the application returned, since
+FastAPI runs the exit code of dependencies before the body of a
+``StreamingResponse`` is sent.
+
+Gates live on the event loop and are only touched from it, so they need no
+locking. Their in-flight and queued counts and the shed requests are
+exported through ``app.metrics`` and ``GET /admission/stats``.
+"""
+import asyncio
+from collections import deque
+from typing import Dict, Optional
+
+from fastapi import HTTPException, Request
+
+from app import metrics
+from app.config import settings
+
+POINT = "point"
+SCAN = "scan"
+WRITE = "write"
+
+# Priority class of each route, keyed by method and path template. Routes
+# not listed are "scan" for GET and "write" otherwise; None exempts a route.
+DEFAULT_ROUTES: Dict[str, Optional[str]] = {
+    "GET /": None,
+    "GET /metrics": None,
+    "GET /cache/stats": None,
+    "GET /admission/stats": None,
+    "GET /books/{book_id}": POINT,
+    "GET /authors/{author_id}": POINT,
+    "GET /genres/{genre_id}": POINT,
+    "GET /books/{book_id}/related": POINT,
+    "GET /jobs/{job_id}": POINT,
+    # Multi-gets are bounded by MAX_BATCH_SIZE.
+    "GET /books": POINT,
+    "GET /authors": POINT,
+    "GET /genres": POINT,
+}
+
+class Gate:
+    """
+    Concurrency limit with a bounded FIFO wait queue.
+    """
+
+    def __init__(self, name: str, limit: int, queue_size: int):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.in_flight = 0
+        self.waiters: deque = deque()
+        self.admitted = 0
+        self.shed = 0
+
+    def _observe(self, shed_reason: Optional[str] = None):
+        if shed_reason is not None:
+            self.shed += 1
+        metrics.observe_admission(self.name, self.in_flight, len(self.waiters), shed_reason)
+
+    async def acquire(self, timeout: float):
+        """
+        Wait for a slot; raises a 503 error when the queue is full or the
+        wait exceeds ``timeout`` seconds.
+        """
+        if self.in_flight < self.limit and not self.waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            self._observe()
+            return
+        if len(self.waiters) >= self.queue_size:
+            self._observe("queue_full")
+            raise overloaded()
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self._observe()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the wait ended.
+                self.release()
+            else:
+                waiter.cancel()
+                self.waiters.remove(waiter)
+            if isinstance(exc, asyncio.CancelledError):
+                self._observe()
+                raise
+            self._observe("timeout")
+            raise overloaded() from exc
+        self.admitted += 1
+        self._observe()
+
+    def release(self):
+        """
+        Hand the slot over to the oldest waiter, or free it.
+        """
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._observe()
+                return
+        self.in_flight -= 1
+        self._observe()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Limits and counters of the gate.
+        """
+        return {
+            "limit": self.limit,
+            "queue_size": self.queue_size,
+            "in_flight": self.in_flight,
+            "queued": len(self.waiters),
+            "admitted": self.admitted,
+            "shed": self.shed,
+        }
+
+def overloaded() -> HTTPException:
+    """
+    503 error telling the client when to retry.
+    """
+    return HTTPException(
+        status_code=503, detail="Server overloaded",
+        headers={"Retry-After": str(settings.ADMISSION_RETRY_AFTER)})
+
+_gates: Dict[str, Gate] = {}
+
+def gate(name: str) -> Gate:
+    """
+    Gate of a priority class, created from the settings on first use.
+    """
+    existing = _gates.get(name)
+    if existing is None:
+        existing = _gates[name] = Gate(
+            name,
+            settings.ADMISSION_LIMITS.get(name, settings.ADMISSION_LIMITS[SCAN]),
+            settings.ADMISSION_QUEUE_SIZES.get(name, settings.ADMISSION_QUEUE_SIZES[SCAN]))
+    return existing
+
+def reset():
+    """
+    Drop every gate, so they are rebuilt from the current settings.
+    """
+    _gates.clear()
+
+# Scope key of the gates whose slot AdmissionMiddleware releases.
+HELD_GATES = "admission.held_gates"
+
+class AdmissionMiddleware:  # pylint: disable=too-few-public-methods
+    """
+    ASGI middleware releasing the slots taken by ``admit`` once the whole
+    response has been sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        held = scope[HELD_GATES] = []
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            for held_gate in held:
+                held_gate.release()
+
+def priority_class(method: str, path: str) -> Optional[str]:
+    """
+    Priority class of a route, or None when it is exempt.
+    """
+    key = f"{method} {path}"
+    if key in settings.ADMISSION_ROUTES:
+        return settings.ADMISSION_ROUTES[key]
+    if key in DEFAULT_ROUTES:
+        return DEFAULT_ROUTES[key]
+    return SCAN if method in ("GET", "HEAD") else WRITE
+
+async def admit(request: Request):
+    """
+    App-wide dependency holding a slot of the route's gate while the
+    request is handled. Runs before the route's own dependencies, so queued
+    requests do not hold a database session. Behind ``AdmissionMiddleware``
+    the slot is kept until the response body is sent.
+    """
+    name = None
+    if settings.ADMISSION_ENABLED:
+        name = priority_class(request.method, request.scope["route"].path)
+    if name is None:
+        yield
+        return
+    request_gate = gate(name)
+    await request_gate.acquire(settings.ADMISSION_QUEUE_TIMEOUT)
+    held = request.scope.get(HELD_GATES)
+    if held is not None:
+        held.append(request_gate)
+        yield
+        return
+    try:
+        yield
+    finally:
+        request_gate.release()
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """
+    Limits and counters of every gate used so far.
+    """
+    return {name: existing.stats() for name, existing in sorted(_gates.items())}
@@ -0,0 +1,171 @@
+"""
+Bulk book ingestion for the bookstore application.
+
+Entries are validated up front, every referenced author and genre ID is
+resolved with one set-based query per table, and books plus their
+association rows are written with executemany-style inserts, committing
+once per chunk of ``settings.BULK_CHUNK_SIZE`` entries.
+"""
+import json
+from typing import Any, Dict, Iterable, List, Set, Tuple, Union
+
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+from app import cache, changes, models, related, schemas, search, versioning
+from app.config import settings
+
+NDJSON_MEDIA_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+# SQLite refuses statements with more than 32766 bound parameters.
+MAX_IN_PARAMETERS = 30000
+
+# Cached responses to drop after inserting books.
+INGEST_TAGS = (cache.BOOK_LISTS, cache.SEARCH)
+
+def _validation_errors(exc: ValidationError) -> List[Any]:
+    return exc.errors(include_url=False, include_context=False, include_input=False)
+
+def _parse_entry(raw: Any) -> Union[schemas.BookCreate, List[Any]]:
+    try:
+        return schemas.BookCreate.model_validate(raw)
+    except ValidationError as exc:
+        return _validation_errors(exc)
+
+async def bulk_payload(request: Request) -> List[Union[schemas.BookCreate, List[Any]]]:
+    """
+    Dependency reading a bulk body as a JSON array or as NDJSON.
+
+    Every entry becomes either a validated ``BookCreate`` or the list of its
+    validation errors, so a single bad entry does not reject the whole batch.
+    """
+    body = await request.body()
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+
+    if content_type in NDJSON_MEDIA_TYPES:
+        entries = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                entries.append(_parse_entry(json.loads(line)))
+            except ValueError as exc:
+                entries.append([{"loc": [], "msg": f"Invalid JSON: {exc}", "type": "json_invalid"}])
+        return entries
+
+    try:
+        raw_entries = json.loads(body)
+    except ValueError as exc:
+        raise RequestValidationError(
+            [{"loc": ["body"], "msg": f"Invalid JSON: {exc}", "type": "json_invalid"}]) from exc
+    if not isinstance(raw_entries, list):
+        raise RequestValidationError(
+            [{"loc": ["body"], "msg": "Expected a JSON array of books", "type": "list_type"}])
+    return [_parse_entry(raw) for raw in raw_entries]
+
+def existing_ids(db_session: Session, id_column, ids: Iterable[int]) -> Set[int]:
+    """
+    Return the subset of ``ids`` present in ``id_column``.
+    """
+    ids = list(set(ids))
+    found = set()
+    for start in range(0, len(ids), MAX_IN_PARAMETERS):
+        batch = ids[start:start + MAX_IN_PARAMETERS]
+        found.update(db_session.scalars(select(id_column).where(id_column.in_(batch))))
+    return found
+
+def _unknown_id_error(field: str, ids: List[int]) -> dict:
+    return {
+        "loc": [field],
+        "msg": f"Unknown IDs: {', '.join(str(i) for i in ids)}",
+        "type": "unknown_id",
+    }
+
+def _resolve_links(
+    entry: schemas.BookCreate,
+    known: Dict[str, Set[int]]) -> Tuple[List[int], List[int], List[dict]]:
+    # The deduplicated author and genre IDs of an entry, and an error per
+    # field naming the IDs missing from ``known``.
+    author_ids = list(dict.fromkeys(entry.author_ids))
+    genre_ids = list(dict.fromkeys(entry.genre_ids))
+    errors = []
+    for field, ids in (("author_ids", author_ids), ("genre_ids", genre_ids)):
+        unknown = [i for i in ids if i not in known[field]]
+        if unknown:
+            errors.append(_unknown_id_error(field, unknown))
+    return author_ids, genre_ids, errors
+
+def ingest_books(
+    db_session: Session,
+    entries: List[Union[schemas.BookCreate, List[Any]]],
+    offset: int = 0,
+    commit: bool = True) -> schemas.BulkBookResponse:
+    """
+    Insert the valid entries and report a per-entry result.
+
+    Entries referencing unknown authors or genres are rejected rather than
+    silently dropping the unknown IDs. Result indexes start at ``offset``.
+    With ``commit=False`` nothing is committed, and the caller commits and
+    invalidates ``INGEST_TAGS`` itself.
+    """
+    valid = [entry for entry in entries if isinstance(entry, schemas.BookCreate)]
+    known = {
+        "author_ids": existing_ids(
+            db_session, models.Author.id, (i for entry in valid for i in entry.author_ids)),
+        "genre_ids": existing_ids(
+            db_session, models.Genre.id, (i for entry in valid for i in entry.genre_ids)),
+    }
+
+    results = []
+    pending = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, schemas.BookCreate):
+            results.append(schemas.BulkBookResult(index=offset + index, errors=entry))
+            continue
+        author_ids, genre_ids, errors = _resolve_links(entry, known)
+        result = schemas.BulkBookResult(index=offset + index, errors=errors or None)
+        results.append(result)
+        if not errors:
+            pending.append((result, entry, author_ids, genre_ids))
+
+    for start in range(0, len(pending), settings.BULK_CHUNK_SIZE):
+        _insert_chunk(db_session, pending[start:start + settings.BULK_CHUNK_SIZE])
+        if commit:
+            db_session.commit()
+            cache.invalidate(INGEST_TAGS)
+
+    return schemas.BulkBookResponse(
+        created=len(pending), failed=len(results) - len(pending), results=results)
+
+def _insert_chunk(db_session: Session, chunk):
+    # Core insert: the ORM bulk path costs more than the statement itself.
+    books = models.Book.__table__
+    rows = [{"title": entry.title, "publication_date": entry.publication_date}
+            for _, entry, _, _ in chunk]
+    if db_session.get_bind().dialect.name == "sqlite":
+        # SQLite serializes writers and assigns ascending rowids in the order
+        # of the rows, so sorting the IDs restores the order of the entries;
+        # sort_by_parameter_order would insert one row per statement.
+        book_ids = sorted(db_session.scalars(insert(books).returning(books.c.id), rows).all())
+    else:
+        book_ids = db_session.scalars(
+            insert(books).returning(books.c.id, sort_by_parameter_order=True), rows).all()
+
+    author_rows = []
+    genre_rows = []
+    for book_id, (result, _, author_ids, genre_ids) in zip(book_ids, chunk):
+        result.id = book_id
+        author_rows.extend({"book_id": book_id, "author_id": i} for i in author_ids)
+        genre_rows.extend({"book_id": book_id, "genre_id": i} for i in genre_ids)
+
+    if author_rows:
+        db_session.execute(insert(models.book_authors), author_rows)
+    if genre_rows:
+        db_session.execute(insert(models.book_genres), genre_rows)
+    search.get_backend(db_session).index_books(db_session, book_ids)
+    related.mark_stale(db_session, book_ids)
+    versioning.bump_counters(db_session, [versioning.BOOKS])
+    changes.record(db_session, changes.BOOK, changes.CREATE, book_ids)
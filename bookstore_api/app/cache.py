@@ -0,0 +1,200 @@
+"""
+Server-side response cache for read endpoints.
+
+Responses are stored as already-encoded JSON bytes, keyed on the request
+path and query string, and bounded by entry count, total size and age
+(least recently used entries are evicted first). Every entry carries tags
+naming the data it was built from; write operations invalidate exactly the
+tags they affect once their transaction has committed (see ``app.crud``).
+
+The cache is per process, so in multi-worker deployments other workers only
+see a write once their copy expires after ``RESPONSE_CACHE_TTL`` seconds,
+bodies and ETags alike. The default TTL is therefore short: hot keys are
+still served from memory at high request rates, while a stale response
+outlives a write by at most a second.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, NamedTuple, Optional, Set
+
+from app.config import settings
+
+# Tags of cached responses.
+BOOKS = "books"                              # GET /books/
+AUTHORS = "authors"                          # GET /authors/
+BOOK_LISTS = "book-lists"                    # every response listing books
+GENRE_SUBTREE_BOOKS = "genre-subtree-books"  # GET /genres/{id}/books?include_descendants=true
+SEARCH = "search"                            # GET /search
+GENRES = "genres"                            # book responses embedding genres (include=genres)
+RELATED = "related"                          # GET /books/{id}/related
+
+def book_tag(book_id: int) -> str:
+    """Tag of GET /books/{book_id}."""
+    return f"book:{book_id}"
+
+def author_tag(author_id: int) -> str:
+    """Tag of GET /authors/{author_id}."""
+    return f"author:{author_id}"
+
+def author_books_tag(author_id: int) -> str:
+    """Tag of GET /authors/{author_id}/books."""
+    return f"author:{author_id}:books"
+
+def genre_books_tag(genre_id: int) -> str:
+    """Tag of GET /genres/{genre_id}/books."""
+    return f"genre:{genre_id}:books"
+
+def book_change_tags(book_ids: Iterable[int], author_ids: Iterable[int], genre_ids: Iterable[int]):
+    """
+    Tags to invalidate when books with these authors and genres are created,
+    changed or deleted.
+    """
+    # Any book may enter or leave the related books of others.
+    tags = {BOOKS, SEARCH, RELATED}
+    tags.update(book_tag(book_id) for book_id in book_ids)
+    tags.update(author_books_tag(author_id) for author_id in author_ids)
+    genre_tags = {genre_books_tag(genre_id) for genre_id in genre_ids}
+    if genre_tags:
+        tags.update(genre_tags)
+        tags.add(GENRE_SUBTREE_BOOKS)
+    return tags
+
+class CachedResponse(NamedTuple):
+    """
+    A cached response body with the headers to replay.
+    """
+    body: bytes
+    headers: Dict[str, str]
+    tags: FrozenSet[str]
+    expires_at: float
+
+class ResponseCache:  # pylint: disable=too-many-instance-attributes
+    """
+    Thread-safe LRU cache of encoded responses with TTL and tag invalidation.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._keys_by_tag: Dict[str, Set[str]] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so that a response computed from data
+        # read before an invalidation is never stored after it.
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(path: str, query: str) -> str:
+        """
+        Cache key of a request: its path and its query parameters in canonical order.
+        """
+        params = "&".join(sorted(query.split("&"))) if query else ""
+        return f"{path}?{params}"
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """
+        Return a fresh entry and mark it as recently used.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(  # pylint: disable=too-many-arguments
+        self,
+        key: str,
+        body: bytes,
+        headers: Dict[str, str],
+        tags: Iterable[str],
+        generation: int):
+        """
+        Store a response computed while the cache was at ``generation``.
+
+        The response is dropped if anything was invalidated since.
+        """
+        if len(body) > self.max_bytes:
+            return
+        entry = CachedResponse(body, headers, frozenset(tags), time.monotonic() + self.ttl)
+        with self._lock:
+            if generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._size += len(body)
+            for tag in entry.tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, tags: Iterable[str]):
+        """
+        Drop every entry carrying one of ``tags``.
+        """
+        with self._lock:
+            self.generation += 1
+            for tag in tags:
+                for key in self._keys_by_tag.pop(tag, ()):
+                    if key in self._entries:
+                        self._remove(key)
+                        self.invalidations += 1
+
+    def clear(self):
+        """
+        Drop every entry.
+        """
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._keys_by_tag.clear()
+            self._size = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Counters and current size of the cache.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._size -= len(entry.body)
+        for tag in entry.tags:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+response_cache = ResponseCache(
+    max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+    max_bytes=settings.RESPONSE_CACHE_MAX_BYTES,
+    ttl=settings.RESPONSE_CACHE_TTL)
+
+def invalidate(tags: Iterable[str]):
+    """
+    Invalidate ``tags`` in the response cache.
+    """
+    response_cache.invalidate(tags)
@@ -2,10 +2,114 @@
 Configuration settings for the application.
 """
 
+from typing import Dict, Optional
+
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
     """Settings configuration for the application."""
     SQLALCHEMY_DATABASE_URL: str = "sqlite:///./test.db"
+    # Database used by read-only endpoints; defaults to SQLALCHEMY_DATABASE_URL.
+    SQLALCHEMY_READ_DATABASE_URL: Optional[str] = None
+    # Serve endpoints with AsyncSession (aiosqlite / asyncpg) instead of Session.
+    DB_ASYNC: bool = False
+
+    # Connection pool
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 3600
+    DB_POOL_PRE_PING: bool = False
+
+    # SQLite PRAGMAs applied to every new connection
+    SQLITE_JOURNAL_MODE: str = "WAL"
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    SQLITE_CACHE_SIZE: int = -64000  # negative values are KiB
+    SQLITE_BUSY_TIMEOUT: int = 5000  # milliseconds
+
+    # Pagination
+    DEFAULT_PAGE_SIZE: int = 100
+    MAX_PAGE_SIZE: int = 1000
+
+    # Largest number of IDs accepted by the multi-get endpoints
+    MAX_BATCH_SIZE: int = 100
+
+    # Response cache. Writes only invalidate the cache of the worker serving
+    # them, so the TTL bounds how long other workers serve stale responses.
+    RESPONSE_CACHE_ENABLED: bool = True
+    RESPONSE_CACHE_MAX_ENTRIES: int = 10000
+    RESPONSE_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    RESPONSE_CACHE_TTL: float = 1.0
+
+    # Change feed: entries older than the retention are compacted to the
+    # latest entry per entity every CHANGES_COMPACT_INTERVAL seconds.
+    CHANGES_RETENTION: float = 7 * 24 * 3600.0
+    CHANGES_COMPACT_INTERVAL: float = 3600.0
+
+    # Rows read per query by the streaming exports
+    EXPORT_CHUNK_SIZE: int = 1000
+
+    # Instrumentation: /metrics, and a warning for every SQL statement slower
+    # than SLOW_QUERY_THRESHOLD seconds (disabled when unset).
+    METRICS_ENABLED: bool = True
+    SLOW_QUERY_THRESHOLD: Optional[float] = None
+
+    # Admission control: each request is admitted by the gate of its priority
+    # class ("point" reads, "scan" reads, "write"s, or a class named in
+    # ADMISSION_ROUTES, keyed by "METHOD /route/{template}"), which serves at
+    # most ADMISSION_LIMITS[class] requests at once and queues at most
+    # ADMISSION_QUEUE_SIZES[class] more; beyond that, or after waiting
+    # ADMISSION_QUEUE_TIMEOUT seconds, requests get a 503 with Retry-After.
+    # SQLite has a single writer, so writes are kept to a few at once: they
+    # wait in the FIFO queue rather than in SQLite's busy handler, which does
+    # not serve them in order and lets one run into SQLITE_BUSY_TIMEOUT.
+    ADMISSION_ENABLED: bool = True
+    ADMISSION_LIMITS: Dict[str, int] = {"point": 16, "scan": 8, "write": 2}
+    ADMISSION_QUEUE_SIZES: Dict[str, int] = {"point": 256, "scan": 32, "write": 64}
+    ADMISSION_QUEUE_TIMEOUT: float = 10.0
+    ADMISSION_RETRY_AFTER: int = 1
+    ADMISSION_ROUTES: Dict[str, str] = {}
+    # Worker threads running sync handlers and database calls; keep it above
+    # the sum of ADMISSION_LIMITS. Defaults to anyio's 40.
+    THREADPOOL_SIZE: Optional[int] = None
+
+    # In-memory catalog snapshot: point reads and unfiltered lists of books
+    # and authors are served from arrays in memory, reloaded when the change
+    # counters moved, checked every SNAPSHOT_REFRESH_INTERVAL seconds. Reads
+    # may lag writes by up to that interval.
+    SNAPSHOT_ENABLED: bool = False
+    SNAPSHOT_REFRESH_INTERVAL: float = 5.0
+
+    # Related books: the number kept per book, and the score of a shared
+    # author; a shared genre scores its depth (1 for top-level genres).
+    # Authors and genres with more books than RELATED_MAX_GROUP_SIZE relate
+    # too many pairs of books to score, and are ignored. The background jobs
+    # maintaining the lists commit at most RELATED_JOB_CHUNK_SIZE books per
+    # chunk, and fewer once JOB_CHUNK_DURATION is spent, since every chunk
+    # holds the write lock.
+    RELATED_BOOKS_LIMIT: int = 20
+    RELATED_AUTHOR_WEIGHT: float = 4.0
+    RELATED_MAX_GROUP_SIZE: int = 200
+    RELATED_JOB_CHUNK_SIZE: int = 100
+
+    # Bulk ingestion
+    BULK_CHUNK_SIZE: int = 5000
+
+    # Background jobs: worker threads, items committed per chunk, the
+    # number of entry errors kept per job, and how often queued jobs are
+    # looked for, in seconds. Workers pause JOB_CHUNK_PAUSE seconds after
+    # each chunk so that request writers waiting for the SQLite write lock
+    # get it, and keep pausing, up to JOB_MAX_PAUSES times, while requests
+    # of the process still wait for it; SQLite retries a busy lock every
+    # 100 ms at most. Chunks of the related books jobs stop after
+    # JOB_CHUNK_DURATION seconds of work.
+    JOB_WORKERS: int = 2
+    JOB_CHUNK_SIZE: int = 1000
+    JOB_MAX_ERRORS: int = 100
+    JOB_POLL_INTERVAL: float = 1.0
+    JOB_CHUNK_PAUSE: float = 0.1
+    JOB_MAX_PAUSES: int = 10
+    JOB_CHUNK_DURATION: float = 0.05
 
 settings = Settings()
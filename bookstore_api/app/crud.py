@@ -0,0 +1,670 @@
+"""
+Database operations behind the API endpoints.
+
+Every function takes a synchronous ``Session`` so it can run either in the
+threadpool (sync mode) or through ``AsyncSession.run_sync`` (async mode).
+Relationships are never lazy-loaded here: association rows are read and
+written explicitly through the association tables, and responses are built
+before committing so that no expired attribute has to be reloaded.
+
+Read functions do not hydrate ORM objects: they select the response columns
+and return plain dicts (see ``app.loaders``).
+"""
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from fastapi import HTTPException
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import StaleDataError
+
+from app import (
+    cache, changes, genre_cache, hierarchy, models, related, schemas, search, versioning)
+from app.bulk import MAX_IN_PARAMETERS, existing_ids
+from app.loaders import (
+    AUTHOR_COLUMNS, FULL_VIEW, GENRE_SUMMARY_COLUMNS, BookView, author_records, book_records,
+    genre_summary_records, load_association_ids, serialize_book)
+from app.filters import NO_FILTERS, BookFilters
+from app.pagination import PageParams, encode_cursor, paginate_by_id, paginate_by_key
+
+def get_book(db_session: Session, book_id: int) -> models.Book:
+    """
+    Load a book or raise a 404 error.
+    """
+    book = db_session.get(models.Book, book_id)
+    if book is None:
+        raise HTTPException(status_code=404, detail="Book not found")
+    return book
+
+def get_author(db_session: Session, author_id: int) -> models.Author:
+    """
+    Load an author or raise a 404 error.
+    """
+    author = db_session.get(models.Author, author_id)
+    if author is None:
+        raise HTTPException(status_code=404, detail="Author not found")
+    return author
+
+def get_genre(db_session: Session, genre_id: int, detail: str = "Genre not found") -> models.Genre:
+    """
+    Load a genre or raise a 404 error.
+    """
+    genre = db_session.get(models.Genre, genre_id)
+    if genre is None:
+        raise HTTPException(status_code=404, detail=detail)
+    return genre
+
+def _entity_version(db_session: Session, model, entity_id: int, detail: str) -> int:
+    version = db_session.scalar(select(model.version).where(model.id == entity_id))
+    if version is None:
+        raise HTTPException(status_code=404, detail=detail)
+    return version
+
+def book_version(db_session: Session, book_id: int) -> int:
+    """
+    Current version of a book, without loading it; raises a 404 error if missing.
+    """
+    return _entity_version(db_session, models.Book, book_id, "Book not found")
+
+def author_version(db_session: Session, author_id: int) -> int:
+    """
+    Current version of an author, without loading it; raises a 404 error if missing.
+    """
+    return _entity_version(db_session, models.Author, author_id, "Author not found")
+
+def _bump_version(db_session: Session, instance, expected_version: Optional[int]):
+    """
+    Bump the version of a loaded book or author and flush it.
+
+    The flushed UPDATE only matches the version that was loaded, so a
+    concurrent write makes it fail instead of being silently overwritten.
+    A mismatch with ``expected_version`` (from ``If-Match``) is a 412 error,
+    a concurrent write without one a 409 error.
+    """
+    if expected_version is not None and instance.version != expected_version:
+        raise HTTPException(status_code=412, detail="Precondition failed")
+    instance.version = instance.version + 1
+    try:
+        db_session.flush()
+    except StaleDataError as exc:
+        db_session.rollback()
+        if expected_version is not None:
+            raise HTTPException(status_code=412, detail="Precondition failed") from exc
+        raise HTTPException(status_code=409, detail="Concurrent update") from exc
+
+def _known_ids(db_session: Session, id_column, ids: Iterable[int]) -> List[int]:
+    """
+    Keep the IDs present in ``id_column``, preserving order and dropping duplicates.
+    """
+    ids = list(dict.fromkeys(ids))
+    known = existing_ids(db_session, id_column, ids)
+    return [i for i in ids if i in known]
+
+def _link_book(db_session: Session, book_id: int, author_ids: List[int], genre_ids: List[int]):
+    """
+    Insert the association rows of a book.
+    """
+    if author_ids:
+        db_session.execute(
+            insert(models.book_authors),
+            [{"book_id": book_id, "author_id": author_id} for author_id in author_ids])
+    if genre_ids:
+        db_session.execute(
+            insert(models.book_genres),
+            [{"book_id": book_id, "genre_id": genre_id} for genre_id in genre_ids])
+
+def _chunked(ids: List[int]) -> Iterable[List[int]]:
+    """
+    Split ``ids`` into chunks small enough for an ``IN`` list.
+    """
+    for start in range(0, len(ids), MAX_IN_PARAMETERS):
+        yield ids[start:start + MAX_IN_PARAMETERS]
+
+def _delete_books(db_session: Session, book_ids: List[int]) -> Tuple[Set[int], Set[int], int]:
+    """
+    Delete books, their association rows and their search documents with
+    set-based statements, and record the deletion. Does not commit.
+
+    Returns the IDs of the authors and genres the books were linked to and
+    the number of association rows deleted.
+    """
+    author_ids, genre_ids, links = set(), set(), 0
+    book_authors, book_genres = models.book_authors.c, models.book_genres.c
+    for chunk in _chunked(book_ids):
+        search.get_backend(db_session).remove_books(db_session, chunk)
+        unlinked = db_session.scalars(
+            delete(models.book_authors).where(book_authors.book_id.in_(chunk))
+            .returning(book_authors.author_id)).all()
+        author_ids.update(unlinked)
+        links += len(unlinked)
+        unlinked = db_session.scalars(
+            delete(models.book_genres).where(book_genres.book_id.in_(chunk))
+            .returning(book_genres.genre_id)).all()
+        genre_ids.update(unlinked)
+        links += len(unlinked)
+        related.remove(db_session, chunk)
+        db_session.execute(
+            delete(models.Book).where(models.Book.id.in_(chunk))
+            .execution_options(synchronize_session=False))
+    if book_ids:
+        versioning.bump_counters(db_session, [versioning.BOOKS])
+        changes.record(db_session, changes.BOOK, changes.DELETE, book_ids)
+    return author_ids, genre_ids, links
+
+def _delete_authors(db_session: Session, author_ids: List[int]) -> Tuple[List[int], int]:
+    """
+    Delete authors and their association rows with set-based statements,
+    bump the versions of their books and record the changes. Does not commit.
+
+    Returns the IDs of the books that lost an author and the number of
+    association rows deleted.
+    """
+    book_ids, links = set(), 0
+    book_authors = models.book_authors.c
+    for chunk in _chunked(author_ids):
+        unlinked = db_session.scalars(
+            delete(models.book_authors).where(book_authors.author_id.in_(chunk))
+            .returning(book_authors.book_id)).all()
+        book_ids.update(unlinked)
+        links += len(unlinked)
+        db_session.execute(
+            delete(models.Author).where(models.Author.id.in_(chunk))
+            .execution_options(synchronize_session=False))
+    book_ids = sorted(book_ids)
+    # The authors disappear from the representation of their books.
+    for chunk in _chunked(book_ids):
+        db_session.execute(
+            update(models.Book).where(models.Book.id.in_(chunk))
+            .values(version=models.Book.version + 1)
+            .execution_options(synchronize_session=False))
+        search.get_backend(db_session).index_books(db_session, chunk)
+        related.mark_stale(db_session, chunk)
+    if author_ids:
+        versioning.bump_counters(
+            db_session,
+            [versioning.AUTHORS, versioning.BOOKS] if book_ids else [versioning.AUTHORS])
+        changes.record(db_session, changes.AUTHOR, changes.DELETE, author_ids)
+        changes.record(db_session, changes.BOOK, changes.UPDATE, book_ids)
+    return book_ids, links
+
+def create_book(db_session: Session, book: schemas.BookCreate) -> schemas.Book:
+    """
+    Create a book; unknown author and genre IDs are ignored.
+    """
+    db_book = models.Book(title=book.title, publication_date=book.publication_date)
+    db_session.add(db_book)
+    db_session.flush()
+    author_ids = _known_ids(db_session, models.Author.id, book.author_ids)
+    genre_ids = _known_ids(db_session, models.Genre.id, book.genre_ids)
+    _link_book(db_session, db_book.id, author_ids, genre_ids)
+    search.get_backend(db_session).index_books(db_session, [db_book.id])
+    related.mark_stale(db_session, [db_book.id])
+    versioning.bump_counters(db_session, [versioning.BOOKS])
+    changes.record(db_session, changes.BOOK, changes.CREATE, [db_book.id])
+    result = serialize_book(db_session, db_book)
+    db_session.commit()
+    cache.invalidate(cache.book_change_tags([result.id], author_ids, genre_ids))
+    return result
+
+def read_book(db_session: Session, book_id: int, view: BookView = FULL_VIEW) -> Dict[str, Any]:
+    """
+    Read a book with its author and genre IDs.
+    """
+    row = db_session.execute(select(*view.columns).where(models.Book.id == book_id)).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Book not found")
+    return book_records(db_session, [row], view)[0]
+
+def _batch(records: List[Dict[str, Any]], ids: List[int]) -> Dict[str, Any]:
+    """
+    Order ``records`` as ``ids`` and list the IDs without a record.
+    """
+    by_id = {record["id"]: record for record in records}
+    return {
+        "items": [by_id[i] for i in ids if i in by_id],
+        "missing": [i for i in ids if i not in by_id],
+    }
+
+def read_books(
+    db_session: Session,
+    book_ids: List[int],
+    view: BookView = FULL_VIEW) -> Dict[str, Any]:
+    """
+    Read several books in a constant number of queries, in the order of ``book_ids``.
+    """
+    rows = db_session.execute(
+        select(*view.columns).where(models.Book.id.in_(book_ids))).all() if book_ids else []
+    return _batch(book_records(db_session, rows, view), book_ids)
+
+def list_books(
+    db_session: Session,
+    page: PageParams,
+    view: BookView = FULL_VIEW,
+    filters: BookFilters = NO_FILTERS) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    List a page of books matching ``filters``, in their sort order.
+    """
+    sort_column = filters.sort_column
+    columns = view.columns
+    if not any(column is sort_column for column in columns):
+        columns = (*columns, sort_column)
+    statement = filters.apply(select(*columns))
+    if sort_column is models.Book.id:
+        rows, next_cursor = paginate_by_id(
+            db_session, statement, models.Book.id, page, filters.descending)
+    else:
+        rows, next_cursor = paginate_by_key(
+            db_session, statement, (sort_column, models.Book.id), page, filters.descending)
+    return book_records(db_session, rows, view), next_cursor
+
+def _sync_links(
+    db_session: Session,
+    link_column,
+    book_id: int,
+    old_ids: List[int],
+    ids: Iterable[int]) -> List[int]:
+    """
+    Make the association rows of a book match ``ids``.
+
+    ``link_column`` is the association column (``book_authors.c.author_id``).
+    Only the rows that change are deleted or inserted, and only IDs not
+    already linked are checked against the primary key it references, in
+    one query; unknown IDs are ignored. Returns the sorted IDs now linked.
+    """
+    table = link_column.table
+    id_column = next(iter(link_column.foreign_keys)).column
+    ids = list(ids)
+    linked = set(old_ids)
+    added = _known_ids(db_session, id_column, (i for i in ids if i not in linked))
+    kept = linked.intersection(ids)
+    removed = linked - kept
+    if removed:
+        db_session.execute(delete(table).where(
+            table.c.book_id == book_id, link_column.in_(removed)))
+    if added:
+        db_session.execute(
+            insert(table), [{"book_id": book_id, link_column.key: i} for i in added])
+    return sorted(kept.union(added))
+
+def update_book(
+    db_session: Session,
+    book_id: int,
+    book: Union[schemas.BookCreate, schemas.BookUpdate],
+    expected_version: Optional[int] = None) -> Tuple[schemas.Book, int]:
+    """
+    Update a book's fields and associations; unknown IDs are ignored.
+
+    A ``BookCreate`` replaces everything. A ``BookUpdate`` only touches the
+    fields it sets, so a PATCH leaves the other fields and associations alone.
+    Returns the book with its new version.
+    """
+    values = book.model_dump(exclude_unset=True, exclude_none=True)
+    db_book = get_book(db_session, book_id)
+    title_changed = "title" in values and values["title"] != db_book.title
+    for field in ("title", "publication_date"):
+        if field in values:
+            setattr(db_book, field, values[field])
+    _bump_version(db_session, db_book, expected_version)
+    old_author_ids, old_genre_ids = load_association_ids(db_session, [book_id])
+    old_author_ids, old_genre_ids = old_author_ids.get(book_id, []), old_genre_ids.get(book_id, [])
+    author_ids, genre_ids = old_author_ids, old_genre_ids
+    if "author_ids" in values:
+        author_ids = _sync_links(
+            db_session, models.book_authors.c.author_id, book_id,
+            old_author_ids, values["author_ids"])
+    if "genre_ids" in values:
+        genre_ids = _sync_links(
+            db_session, models.book_genres.c.genre_id, book_id,
+            old_genre_ids, values["genre_ids"])
+    # The search document is made of the title and the author names.
+    if title_changed or author_ids != old_author_ids:
+        search.get_backend(db_session).index_books(db_session, [book_id])
+    if author_ids != old_author_ids or genre_ids != old_genre_ids:
+        related.mark_stale(db_session, [book_id])
+    versioning.bump_counters(db_session, [versioning.BOOKS])
+    changes.record(db_session, changes.BOOK, changes.UPDATE, [book_id])
+    result = schemas.Book(
+        id=book_id,
+        title=db_book.title,
+        publication_date=db_book.publication_date,
+        authors=author_ids,
+        genres=genre_ids)
+    version = db_book.version
+    db_session.commit()
+    cache.invalidate(cache.book_change_tags(
+        [book_id], {*old_author_ids, *author_ids}, {*old_genre_ids, *genre_ids}))
+    return result, version
+
+def delete_book(db_session: Session, book_id: int):
+    """
+    Delete a book and its association rows.
+    """
+    book_version(db_session, book_id)
+    author_ids, genre_ids, _ = _delete_books(db_session, [book_id])
+    db_session.commit()
+    cache.invalidate(cache.book_change_tags([book_id], author_ids, genre_ids))
+
+def _selected_ids(db_session: Session, id_column, ids: List[int]) -> Tuple[List[int], List[int]]:
+    """
+    Split requested IDs into the existing ones and the missing ones, in request order.
+    """
+    ids = list(dict.fromkeys(ids))
+    found = existing_ids(db_session, id_column, ids)
+    return [i for i in ids if i in found], [i for i in ids if i not in found]
+
+def delete_books(
+    db_session: Session,
+    book_ids: Optional[List[int]] = None,
+    filters: BookFilters = NO_FILTERS) -> Dict[str, Any]:
+    """
+    Delete the books with the given IDs, or else every book matching
+    ``filters``, in one transaction.
+
+    Returns the number of books and association rows deleted and the
+    requested IDs that did not exist.
+    """
+    if book_ids is not None:
+        book_ids, missing = _selected_ids(db_session, models.Book.id, book_ids)
+    else:
+        book_ids, missing = db_session.scalars(
+            filters.apply(select(models.Book.id)).order_by(models.Book.id)).all(), []
+    author_ids, genre_ids, links = _delete_books(db_session, book_ids)
+    db_session.commit()
+    if book_ids:
+        cache.invalidate(cache.book_change_tags(book_ids, author_ids, genre_ids))
+    return {"deleted": len(book_ids), "links": links, "missing": missing}
+
+def list_authors(
+    db_session: Session, page: PageParams) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    List a page of authors.
+    """
+    rows, next_cursor = paginate_by_id(
+        db_session, select(*AUTHOR_COLUMNS), models.Author.id, page)
+    return author_records(rows), next_cursor
+
+def _author_book_ids(db_session: Session, author_id: int) -> List[int]:
+    """
+    IDs of the books of an author.
+    """
+    return db_session.scalars(
+        select(models.book_authors.c.book_id)
+        .where(models.book_authors.c.author_id == author_id)).all()
+
+def read_authors(db_session: Session, author_ids: List[int]) -> Dict[str, Any]:
+    """
+    Read several authors in one query, in the order of ``author_ids``.
+    """
+    rows = db_session.execute(
+        select(*AUTHOR_COLUMNS).where(models.Author.id.in_(author_ids))).all() if author_ids else []
+    return _batch(author_records(rows), author_ids)
+
+def create_author(db_session: Session, author: schemas.AuthorCreate) -> schemas.Author:
+    """
+    Create an author.
+    """
+    db_author = models.Author(full_name=author.full_name, birth_date=author.birth_date)
+    db_session.add(db_author)
+    db_session.flush()
+    versioning.bump_counters(db_session, [versioning.AUTHORS])
+    changes.record(db_session, changes.AUTHOR, changes.CREATE, [db_author.id])
+    result = schemas.Author.model_validate(db_author)
+    db_session.commit()
+    cache.invalidate([cache.AUTHORS])
+    return result
+
+def read_author(db_session: Session, author_id: int) -> Dict[str, Any]:
+    """
+    Read an author.
+    """
+    row = db_session.execute(
+        select(*AUTHOR_COLUMNS).where(models.Author.id == author_id)).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Author not found")
+    return author_records([row])[0]
+
+def update_author(
+    db_session: Session,
+    author_id: int,
+    author: schemas.AuthorCreate,
+    expected_version: Optional[int] = None) -> Tuple[schemas.Author, int]:
+    """
+    Replace an author's fields.
+
+    Returns the author with its new version.
+    """
+    db_author = get_author(db_session, author_id)
+    db_author.full_name = author.full_name
+    db_author.birth_date = author.birth_date
+    _bump_version(db_session, db_author, expected_version)
+    search.get_backend(db_session).index_books(
+        db_session, _author_book_ids(db_session, author_id))
+    versioning.bump_counters(db_session, [versioning.AUTHORS])
+    changes.record(db_session, changes.AUTHOR, changes.UPDATE, [author_id])
+    result = schemas.Author.model_validate(db_author)
+    version = db_author.version
+    db_session.commit()
+    cache.invalidate([cache.author_tag(author_id), cache.AUTHORS, cache.SEARCH])
+    return result, version
+
+def _author_deletion_tags(author_ids: List[int], book_ids: List[int]) -> List[str]:
+    # The authors disappear from the author lists of their books, which may
+    # appear in any list of books.
+    return [
+        cache.AUTHORS, cache.SEARCH, cache.BOOK_LISTS,
+        *(cache.author_tag(author_id) for author_id in author_ids),
+        *(cache.book_tag(book_id) for book_id in book_ids)]
+
+def delete_author(db_session: Session, author_id: int):
+    """
+    Delete an author and its association rows.
+    """
+    author_version(db_session, author_id)
+    book_ids, _ = _delete_authors(db_session, [author_id])
+    db_session.commit()
+    cache.invalidate(_author_deletion_tags([author_id], book_ids))
+
+def delete_authors(
+    db_session: Session,
+    author_ids: Optional[List[int]] = None,
+    orphaned: bool = False) -> Dict[str, Any]:
+    """
+    Delete the authors with the given IDs, or else every author without
+    books when ``orphaned``, in one transaction.
+
+    Returns the number of authors and association rows deleted, the number
+    of books that lost an author and the requested IDs that did not exist.
+    """
+    if author_ids is not None:
+        author_ids, missing = _selected_ids(db_session, models.Author.id, author_ids)
+    elif orphaned:
+        linked = select(models.book_authors.c.author_id)
+        author_ids, missing = db_session.scalars(
+            select(models.Author.id).where(models.Author.id.not_in(linked))
+            .order_by(models.Author.id)).all(), []
+    else:
+        author_ids, missing = [], []
+    book_ids, links = _delete_authors(db_session, author_ids)
+    db_session.commit()
+    if author_ids:
+        cache.invalidate(_author_deletion_tags(author_ids, book_ids))
+    return {
+        "deleted": len(author_ids), "links": links,
+        "updated_books": len(book_ids), "missing": missing,
+    }
+
+def list_books_by_author(
+    db_session: Session,
+    author_id: int,
+    page: PageParams,
+    view: BookView = FULL_VIEW) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    List a page of the books of an author.
+    """
+    author_version(db_session, author_id)
+    statement = select(*view.columns).join(
+        models.book_authors, models.book_authors.c.book_id == models.Book.id
+    ).where(models.book_authors.c.author_id == author_id)
+    rows, next_cursor = paginate_by_id(db_session, statement, models.Book.id, page)
+    return book_records(db_session, rows, view), next_cursor
+
+def list_books_by_genre(
+    db_session: Session,
+    genre_id: int,
+    page: PageParams,
+    include_descendants: bool = False,
+    view: BookView = FULL_VIEW) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    List a page of the books of a genre, optionally including its subgenres.
+    """
+    genre = get_genre(db_session, genre_id)
+    if include_descendants:
+        book_ids = select(models.book_genres.c.book_id).join(
+            models.Genre, models.Genre.id == models.book_genres.c.genre_id
+        ).where(hierarchy.subtree_clause(genre))
+        statement = select(*view.columns).where(models.Book.id.in_(book_ids))
+    else:
+        statement = select(*view.columns).join(
+            models.book_genres, models.book_genres.c.book_id == models.Book.id
+        ).where(models.book_genres.c.genre_id == genre_id)
+    rows, next_cursor = paginate_by_id(db_session, statement, models.Book.id, page)
+    return book_records(db_session, rows, view), next_cursor
+
+def list_related_books(
+    db_session: Session,
+    book_id: int,
+    limit: int,
+    view: BookView = FULL_VIEW) -> List[Dict[str, Any]]:
+    """
+    List the books most related to a book, best first, from the related books index.
+    """
+    book_version(db_session, book_id)
+    related_ids = related.related_ids(db_session, book_id, limit)
+    rows = db_session.execute(
+        select(*view.columns).where(models.Book.id.in_(related_ids))).all() if related_ids else []
+    return _batch(book_records(db_session, rows, view), related_ids)["items"]
+
+def genre_json(db_session: Session, genre_id: int) -> bytes:
+    """
+    JSON of a genre with its subgenres, served from the genre tree cache.
+    """
+    content = genre_cache.get_tree(db_session).genre_json(genre_id)
+    if content is None:
+        raise HTTPException(status_code=404, detail="Genre not found")
+    return content
+
+def genres_json(db_session: Session, genre_ids: List[int]) -> bytes:
+    """
+    JSON of several genres, in the order of ``genre_ids``, served from the genre tree cache.
+    """
+    return genre_cache.get_tree(db_session).batch_json(genre_ids)
+
+def list_genres(db_session: Session, page: PageParams) -> Tuple[bytes, Optional[str]]:
+    """
+    JSON of a page of genres, served from the genre tree cache.
+    """
+    content, last_id = genre_cache.get_tree(db_session).page_json(page.after_id, page.limit)
+    return content, None if last_id is None else encode_cursor(last_id)
+
+def create_genre(db_session: Session, genre: schemas.GenreCreate) -> bytes:
+    """
+    Create a genre, optionally under a parent genre.
+    """
+    parent = None
+    if genre.parent_id is not None:
+        parent = get_genre(db_session, genre.parent_id, "Parent genre not found")
+    db_genre = models.Genre(
+        name=genre.name,
+        parent_id=genre.parent_id,
+        path=hierarchy.child_path(parent))
+    db_session.add(db_genre)
+    db_session.flush()
+    genre_id = db_genre.id
+    versioning.bump_counters(db_session, [versioning.GENRES])
+    changes.record(db_session, changes.GENRE, changes.CREATE, [genre_id])
+    # Genres embed their whole subtree, so every ancestor changes too.
+    changes.record(db_session, changes.GENRE, changes.UPDATE, hierarchy.ancestor_ids(db_genre))
+    db_session.commit()
+    # A new genre has no books yet, so no cached response depends on it; the
+    # genre endpoints themselves are served from the rebuilt genre tree.
+    return genre_json(db_session, genre_id)
+
+def update_genre(db_session: Session, genre_id: int, genre: schemas.GenreCreate) -> bytes:
+    """
+    Rename a genre or move it, with its subgenres, under another parent.
+    """
+    db_genre = get_genre(db_session, genre_id)
+    parent = None
+    if genre.parent_id is not None:
+        parent = get_genre(db_session, genre.parent_id, "Parent genre not found")
+
+    old_ancestor_ids = hierarchy.ancestor_ids(db_genre)
+    db_genre.name = genre.name
+    try:
+        hierarchy.move_subtree(db_session, db_genre, parent)
+    except ValueError as exc:
+        db_session.rollback()
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    versioning.bump_counters(db_session, [versioning.GENRES])
+    # Genres embed their whole subtree, so every old and new ancestor changes too.
+    changes.record(
+        db_session, changes.GENRE, changes.UPDATE,
+        [genre_id, *old_ancestor_ids, *hierarchy.ancestor_ids(db_genre)])
+    moved = old_ancestor_ids != hierarchy.ancestor_ids(db_genre)
+    if moved:
+        # Shared genres score their depth, which changed for the whole subtree.
+        db_session.flush()
+        related.mark_stale(db_session, select(models.book_genres.c.book_id).join(
+            models.Genre, models.Genre.id == models.book_genres.c.genre_id
+        ).where(hierarchy.subtree_clause(db_genre)))
+    db_session.commit()
+    cache.invalidate([cache.GENRE_SUBTREE_BOOKS, cache.GENRES])
+    return genre_json(db_session, genre_id)
+
+def list_genre_descendants(db_session: Session, genre_id: int) -> List[Dict[str, Any]]:
+    """
+    List all descendants of a genre, in depth-first order.
+    """
+    genre = get_genre(db_session, genre_id)
+    descendants = db_session.execute(
+        select(*GENRE_SUMMARY_COLUMNS, models.Genre.path)
+        .where(hierarchy.descendants_clause(genre))).all()
+    descendants.sort(key=lambda descendant: [*hierarchy.ancestor_ids(descendant), descendant.id])
+    return genre_summary_records(descendants)
+
+def list_genre_ancestors(db_session: Session, genre_id: int) -> List[Dict[str, Any]]:
+    """
+    List the ancestors of a genre, root first.
+    """
+    genre = get_genre(db_session, genre_id)
+    ancestor_ids = hierarchy.ancestor_ids(genre)
+    ancestors = {
+        ancestor.id: ancestor
+        for ancestor in db_session.execute(
+            select(*GENRE_SUMMARY_COLUMNS).where(models.Genre.id.in_(ancestor_ids)))
+    }
+    return genre_summary_records(
+        [ancestors[ancestor_id] for ancestor_id in ancestor_ids if ancestor_id in ancestors])
+
+def search_books(
+    db_session: Session,
+    query: str,
+    page: PageParams,
+    view: BookView = FULL_VIEW) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Full-text search over book titles and author names, best match first.
+
+    Search cursors carry the offset of the next hit rather than a book ID.
+    """
+    terms = search.search_terms(query)
+    if not terms:
+        return [], None
+    offset = page.after_id or 0
+    hits = search.get_backend(db_session).search(db_session, terms, page.limit + 1, offset)
+    next_cursor = encode_cursor(offset + page.limit) if len(hits) > page.limit else None
+    book_ids = [book_id for book_id, _ in hits[:page.limit]]
+    books = {
+        row.id: row
+        for row in db_session.execute(select(*view.columns).where(models.Book.id.in_(book_ids)))
+    }
+    return book_records(
+        db_session, [books[book_id] for book_id in book_ids if book_id in books], view), next_cursor
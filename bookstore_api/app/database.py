@@ -1,103 +1,437 @@
 """
 Database configuration for the bookstore application.
 """
-from sqlalchemy import create_engine
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from sqlalchemy import String, cast, create_engine, event, insert, inspect, select, text, update
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import IntegrityError, OperationalError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+from app import metrics
+from app.config import settings
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SQLALCHEMY_DATABASE_URL = settings.SQLALCHEMY_DATABASE_URL
 
-Base = declarative_base()
+def is_sqlite_memory(url) -> bool:
+    """
+    Whether ``url`` points at an in-memory SQLite database.
+    """
+    url = make_url(url)
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
 
-def init_db():
+def sqlite_pragmas(read_only: bool = False):
     """
-    Initialize the database and create tables.
+    PRAGMA statements applied to every new SQLite connection.
+
+    WAL lets readers proceed while a writer holds the database, and
+    ``synchronous=NORMAL`` is durable enough in WAL mode while avoiding an
+    fsync per commit.
     """
-    from app import models  # Importing models inside the function to avoid circular imports
+    pragmas = [
+        f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}",
+        f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}",
+        f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}",
+        f"PRAGMA cache_size={settings.SQLITE_CACHE_SIZE}",
+        f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT}",
+    ]
+    if read_only:
+        pragmas.append("PRAGMA query_only=ON")
+    return pragmas
 
-    Base.metadata.create_all(bind=engine)
-    session = SessionLocal()
-
-    genres = [
-        {"name": "Fiction", "subgenres": [
-            {"name": "Fantasy", "subgenres": [
-                {"name": "High Fantasy", "subgenres": [
-                    {"name": "Epic Fantasy"}
-                ]},
-                {"name": "Urban Fantasy"}
-            ]},
-            {"name": "Science Fiction", "subgenres": [
-                {"name": "Dystopian"},
-                {"name": "Space Opera", "subgenres": [
-                    {"name": "Military Sci-Fi"}
-                ]}
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+def async_database_url(url: str) -> str:
+    """
+    Rewrite a database URL to use the asyncio driver of its backend.
+    """
+    url = make_url(url)
+    if url.get_dialect().is_async:
+        return url.render_as_string(hide_password=False)
+    drivername = ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername)
+    return url.set(drivername=drivername).render_as_string(hide_password=False)
+
+def engine_options(url: str) -> dict:
+    """
+    Keyword arguments for ``create_engine`` derived from ``settings``.
+    """
+    options = {"pool_pre_ping": settings.DB_POOL_PRE_PING}
+    if make_url(url).get_backend_name() == "sqlite":
+        options["connect_args"] = {"check_same_thread": False}
+    if not is_sqlite_memory(url):
+        options.update(
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_recycle=settings.DB_POOL_RECYCLE)
+    return options
+
+class TimedQueuePool(QueuePool):
+    """
+    ``QueuePool`` recording how long each checkout waits for a connection.
+    """
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.observe_pool_checkout(time.perf_counter() - started)
+
+class TimedAsyncAdaptedQueuePool(TimedQueuePool, AsyncAdaptedQueuePool):
+    """
+    ``AsyncAdaptedQueuePool`` recording how long each checkout waits for a connection.
+    """
+
+def install_sqlite_pragmas(sync_engine: Engine, read_only: bool = False):
+    """
+    Apply ``sqlite_pragmas`` to every connection ``sync_engine`` opens.
+    """
+    pragmas = sqlite_pragmas(read_only)
+
+    @event.listens_for(sync_engine, "connect")
+    def apply_pragmas(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+# Transactions of this process waiting in BEGIN IMMEDIATE for the write
+# lock, except those begun inside background_writes().
+_waiting_writers: int = 0
+_waiting_writers_lock = threading.Lock()
+_background = threading.local()
+
+def waiting_writers() -> int:
+    """
+    Number of transactions of this process, outside of ``background_writes()``,
+    currently waiting for the SQLite write lock.
+    """
+    return _waiting_writers
+
+@contextmanager
+def background_writes():
+    """
+    Leave the transactions begun by the current thread out of ``waiting_writers()``.
+    """
+    _background.active = True
+    try:
+        yield
+    finally:
+        _background.active = False
+
+def _count_waiting(delta: int):
+    global _waiting_writers  # pylint: disable=global-statement
+    with _waiting_writers_lock:
+        _waiting_writers += delta
+
+def is_lock_timeout(exc: OperationalError) -> bool:
+    """
+    Whether ``exc`` is SQLite giving up on the write lock after the busy timeout.
+    """
+    return "database is locked" in str(exc.orig)
+
+def install_sqlite_immediate_transactions(sync_engine: Engine):
+    """
+    Start the transactions of ``sync_engine`` with ``BEGIN IMMEDIATE``.
+
+    A deferred transaction that read first and then writes cannot wait for
+    the write lock: when another connection committed in between, SQLite
+    fails it with "database is locked" at once, whatever the busy timeout.
+    Taking the lock up front makes concurrent writers queue for
+    ``settings.SQLITE_BUSY_TIMEOUT`` instead; past it, the request gets a
+    503 like one shed by admission control. The writers queued at any time
+    are counted by ``waiting_writers()``, so background jobs can let them go
+    first.
+    """
+
+    @event.listens_for(sync_engine, "connect")
+    def disable_driver_transactions(dbapi_connection, _connection_record):
+        # Let SQLAlchemy emit BEGIN rather than the driver.
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(sync_engine, "begin")
+    def begin_immediate(connection):
+        if getattr(_background, "active", False):
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            return
+        _count_waiting(1)
+        try:
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+        finally:
+            _count_waiting(-1)
+
+def create_db_engine(url: str, read_only: bool = False) -> Engine:
+    """
+    Create an engine configured from ``settings``.
+
+    SQLite connections get the tuning PRAGMAs on connect; ``read_only``
+    engines additionally refuse writes, and the others take the write lock
+    when their transactions begin.
+    """
+    options = engine_options(url)
+    if "pool_size" in options:
+        options["poolclass"] = TimedQueuePool
+    db_engine = create_engine(url, **options)
+    if db_engine.dialect.name == "sqlite":
+        install_sqlite_pragmas(db_engine, read_only)
+        if not read_only:
+            install_sqlite_immediate_transactions(db_engine)
+    metrics.instrument_engine(db_engine)
+    return db_engine
+
+def create_async_db_engine(url: str, read_only: bool = False) -> AsyncEngine:
+    """
+    Create an asyncio engine (aiosqlite, asyncpg) configured like ``create_db_engine``.
+    """
+    options = engine_options(url)
+    if "pool_size" in options:
+        # aiosqlite defaults to NullPool; pool connections like the sync engine does.
+        options["poolclass"] = TimedAsyncAdaptedQueuePool
+    db_engine = create_async_engine(async_database_url(url), **options)
+    if db_engine.dialect.name == "sqlite":
+        install_sqlite_pragmas(db_engine.sync_engine, read_only)
+        if not read_only:
+            install_sqlite_immediate_transactions(db_engine.sync_engine)
+    metrics.instrument_engine(db_engine.sync_engine)
+    return db_engine
+
+def read_database_url() -> Optional[str]:
+    """
+    URL for the read-only pool, or None when reads share the primary engine.
+
+    Read-only endpoints use their own pool so they never wait behind writers
+    for a connection. SQLite shares the database file; other backends share
+    the primary engine unless a replica is configured.
+    """
+    if settings.SQLALCHEMY_READ_DATABASE_URL:
+        return settings.SQLALCHEMY_READ_DATABASE_URL
+    if (make_url(SQLALCHEMY_DATABASE_URL).get_backend_name() == "sqlite"
+            and not is_sqlite_memory(SQLALCHEMY_DATABASE_URL)):
+        return SQLALCHEMY_DATABASE_URL
+    return None
+
+engine = create_db_engine(SQLALCHEMY_DATABASE_URL)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+READ_DATABASE_URL = read_database_url()
+read_engine = create_db_engine(READ_DATABASE_URL, read_only=True) if READ_DATABASE_URL else engine
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+# Async mode (settings.DB_ASYNC): endpoints use AsyncSession on these engines.
+# The sync engines above remain in use for startup tasks such as init_db.
+async_engine: Optional[AsyncEngine] = None
+async_read_engine: Optional[AsyncEngine] = None
+AsyncSessionLocal: Optional[async_sessionmaker] = None
+AsyncReadSessionLocal: Optional[async_sessionmaker] = None
+if settings.DB_ASYNC:
+    async_engine = create_async_db_engine(SQLALCHEMY_DATABASE_URL)
+    async_read_engine = (
+        create_async_db_engine(READ_DATABASE_URL, read_only=True)
+        if READ_DATABASE_URL else async_engine)
+    AsyncSessionLocal = async_sessionmaker(
+        bind=async_engine, autoflush=False, expire_on_commit=False)
+    AsyncReadSessionLocal = async_sessionmaker(
+        bind=async_read_engine, autoflush=False, expire_on_commit=False)
+
+Base = declarative_base()
+
+# Bump whenever GENRE_TAXONOMY, the seeding logic, derived tables or indexes change.
+SEED_VERSION = 8
+SEED_VERSION_KEY = "seed_version"
+
+GENRE_TAXONOMY = [
+    {"name": "Fiction", "subgenres": [
+        {"name": "Fantasy", "subgenres": [
+            {"name": "High Fantasy", "subgenres": [
+                {"name": "Epic Fantasy"}
             ]},
-            {"name": "Mystery", "subgenres": [
-                {"name": "Detective"},
-                {"name": "Cozy Mystery"}
-            ]}
+            {"name": "Urban Fantasy"}
         ]},
-        {"name": "Non-Fiction", "subgenres": [
-            {"name": "Biography", "subgenres": [
-                {"name": "Historical Biography"},
-                {"name": "Memoir"}
-            ]},
-            {"name": "Self-Help", "subgenres": [
-                {"name": "Personal Development", "subgenres": [
-                    {"name": "Motivational"}
-                ]},
-                {"name": "Psychology"}
-            ]},
-            {"name": "History", "subgenres": [
-                {"name": "Ancient History"},
-                {"name": "Modern History", "subgenres": [
-                    {"name": "World War II"}
-                ]}
+        {"name": "Science Fiction", "subgenres": [
+            {"name": "Dystopian"},
+            {"name": "Space Opera", "subgenres": [
+                {"name": "Military Sci-Fi"}
             ]}
         ]},
-        {"name": "Children's Books", "subgenres": [
-            {"name": "Picture Books", "subgenres": [
-                {"name": "Bedtime Stories"}
-            ]},
-            {"name": "Young Adult", "subgenres": [
-                {"name": "Fantasy"},
-                {"name": "Romance"}
-            ]}
+        {"name": "Mystery", "subgenres": [
+            {"name": "Detective"},
+            {"name": "Cozy Mystery"}
+        ]}
+    ]},
+    {"name": "Non-Fiction", "subgenres": [
+        {"name": "Biography", "subgenres": [
+            {"name": "Historical Biography"},
+            {"name": "Memoir"}
         ]},
-        {"name": "Romance", "subgenres": [
-            {"name": "Contemporary Romance"},
-            {"name": "Historical Romance", "subgenres": [
-                {"name": "Regency Romance"},
-                {"name": "Victorian Romance"}
+        {"name": "Self-Help", "subgenres": [
+            {"name": "Personal Development", "subgenres": [
+                {"name": "Motivational"}
             ]},
-            {"name": "Paranormal Romance", "subgenres": [
-                {"name": "Vampire Romance"}
-            ]}
+            {"name": "Psychology"}
         ]},
-        {"name": "Horror", "subgenres": [
-            {"name": "Gothic Horror"},
-            {"name": "Psychological Horror"},
-            {"name": "Supernatural Horror", "subgenres": [
-                {"name": "Ghost Stories"}
+        {"name": "History", "subgenres": [
+            {"name": "Ancient History"},
+            {"name": "Modern History", "subgenres": [
+                {"name": "World War II"}
             ]}
         ]}
-    ]
+    ]},
+    {"name": "Children's Books", "subgenres": [
+        {"name": "Picture Books", "subgenres": [
+            {"name": "Bedtime Stories"}
+        ]},
+        {"name": "Young Adult", "subgenres": [
+            {"name": "Fantasy"},
+            {"name": "Romance"}
+        ]}
+    ]},
+    {"name": "Romance", "subgenres": [
+        {"name": "Contemporary Romance"},
+        {"name": "Historical Romance", "subgenres": [
+            {"name": "Regency Romance"},
+            {"name": "Victorian Romance"}
+        ]},
+        {"name": "Paranormal Romance", "subgenres": [
+            {"name": "Vampire Romance"}
+        ]}
+    ]},
+    {"name": "Horror", "subgenres": [
+        {"name": "Gothic Horror"},
+        {"name": "Psychological Horror"},
+        {"name": "Supernatural Horror", "subgenres": [
+            {"name": "Ghost Stories"}
+        ]}
+    ]}
+]
 
-    def add_genres(parent, subgenres):
-        for subgenre in subgenres:
-            genre = models.Genre(name=subgenre['name'], parent=parent)
-            session.add(genre)
-            session.commit()
-            if 'subgenres' in subgenre:
-                add_genres(genre, subgenre['subgenres'])
+def stored_seed_version() -> Optional[int]:
+    """
+    Return the seed version recorded in the database, or None if it was never seeded.
+    """
+    # Deferred: app.models imports this module.
+    from app import models  # pylint: disable=import-outside-toplevel
+
+    try:
+        with engine.connect() as connection:
+            value = connection.execute(
+                select(models.AppState.value).where(models.AppState.key == SEED_VERSION_KEY)
+            ).scalar()
+    except SQLAlchemyError:
+        # The state table does not exist yet.
+        return None
+    return int(value) if value is not None else None
+
+def taxonomy_rows():
+    """
+    Flatten a genre taxonomy into ``genres`` rows with preassigned IDs and paths.
+
+    IDs are assigned in depth-first order, matching the order in which genres
+    were historically inserted one by one.
+    """
+    rows = []
+
+    def add_genres(parent_id, path, subgenres):
+        for genre_data in subgenres:
+            genre_id = len(rows) + 1
+            rows.append({
+                "id": genre_id,
+                "name": genre_data["name"],
+                "parent_id": parent_id,
+                "path": path,
+            })
+            add_genres(genre_id, f"{path}{genre_id}/", genre_data.get("subgenres", []))
+
+    add_genres(None, "/", GENRE_TAXONOMY)
+    return rows
+
+def backfill_genre_paths(connection):
+    """
+    Compute ``genres.path`` from ``parent_id``, one level of the hierarchy
+    per statement, for genres created before paths were stored.
+    """
+    from app import models  # pylint: disable=import-outside-toplevel
+
+    genres = models.Genre.__table__
+    parent = genres.alias()
+    path = select(parent.c.path.concat(cast(parent.c.id, String)).concat("/")).where(
+        parent.c.id == genres.c.parent_id).scalar_subquery()
+    while connection.execute(update(genres).where(
+            genres.c.parent_id.is_not(None), genres.c.path != path).values(path=path)).rowcount:
+        pass
 
-    for genre_data in genres:
-        genre = models.Genre(name=genre_data['name'])
-        session.add(genre)
-        session.commit()
-        if 'subgenres' in genre_data:
-            add_genres(genre, genre_data['subgenres'])
+# Columns added to existing tables, with the first seed version whose
+# databases have them, their DDL and how to backfill them.
+ADDED_COLUMNS = (
+    (1, "genres", "path", "VARCHAR NOT NULL DEFAULT '/'", backfill_genre_paths),
+    (3, "books", "version", "INTEGER NOT NULL DEFAULT 1", None),
+    (3, "authors", "version", "INTEGER NOT NULL DEFAULT 1", None),
+)
 
-    session.close()
+def add_missing_columns(bind: Engine, stored_version: Optional[int]):
+    """
+    Add the columns of ``ADDED_COLUMNS`` missing from a database seeded
+    before they were introduced, and backfill them, in one transaction.
+
+    Runs before the indexes are created, as some of them cover these columns.
+    """
+    pending = [column for column in ADDED_COLUMNS if (stored_version or 0) < column[0]]
+    if not pending:
+        return
+    with bind.begin() as connection:
+        inspector = inspect(connection)
+        for _, table, column, ddl, backfill in pending:
+            if column in {existing["name"] for existing in inspector.get_columns(table)}:
+                continue
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+            if backfill is not None:
+                backfill(connection)
+
+def init_db():
+    """
+    Initialize the database: create tables and seed the genre taxonomy.
+
+    Idempotent and cheap to call on every process start: when the recorded
+    seed version is current this is a single query. Otherwise the tables are
+    created, the columns added since the recorded version are added to
+    existing tables, the taxonomy is inserted in one transaction with a bulk
+    insert unless genres already exist, the search index is rebuilt and a
+    background job is queued to rebuild the related books index. Concurrent
+    callers race on the preassigned genre IDs, so only one of them seeds.
+    """
+    from app import genre_cache, models, related, search, versioning  # pylint: disable=cyclic-import
+
+    stored_version = stored_seed_version()
+    if stored_version == SEED_VERSION:
+        return
+
+    Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine, stored_version)
+    # create_all skips existing tables, so indexes added to them later are created here.
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    with SessionLocal() as session:
+        try:
+            if session.scalar(select(models.Genre.id).limit(1)) is None:
+                session.execute(insert(models.Genre), taxonomy_rows())
+                # Other processes may have cached the empty genre tree.
+                versioning.bump_counters(session, [versioning.GENRES])
+                if engine.dialect.name == "postgresql":
+                    # Explicit IDs do not advance the serial sequence.
+                    session.execute(text(
+                        "SELECT setval(pg_get_serial_sequence('genres', 'id'), "
+                        "(SELECT max(id) FROM genres))"))
+            search.get_backend(session).rebuild(session)
+            related.queue_rebuild(session)
+            session.merge(models.AppState(key=SEED_VERSION_KEY, value=str(SEED_VERSION)))
+            session.commit()
+        except IntegrityError:
+            # Another process seeded the database concurrently.
+            session.rollback()
+    genre_cache.invalidate()
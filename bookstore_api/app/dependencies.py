@@ -3,15 +3,83 @@
 """
 Dependencies for the bookstore application.
 """
+from typing import Any, Callable, List, Optional, Union
 
-from app.database import SessionLocal
+from fastapi import HTTPException, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app import database
+from app.config import settings
+
+DbSession = Union[Session, AsyncSession]
 
 def get_db():
     """
     Dependency to get the database session.
     """
-    db_session = SessionLocal()
+    db_session = database.SessionLocal()
+    try:
+        yield db_session
+    finally:
+        db_session.close()
+
+def get_read_db():
+    """
+    Dependency to get a database session for read-only endpoints.
+    """
+    db_session = database.ReadSessionLocal()
     try:
         yield db_session
     finally:
         db_session.close()
+
+async def get_async_db():
+    """
+    Dependency to get an asyncio database session.
+    """
+    async with database.AsyncSessionLocal() as db_session:
+        yield db_session
+
+async def get_async_read_db():
+    """
+    Dependency to get an asyncio database session for read-only endpoints.
+    """
+    async with database.AsyncReadSessionLocal() as db_session:
+        yield db_session
+
+# Session dependencies used by the endpoints, selected by settings.DB_ASYNC.
+get_session = get_async_db if settings.DB_ASYNC else get_db
+get_read_session = get_async_read_db if settings.DB_ASYNC else get_read_db
+
+def batch_ids(
+    ids: Optional[str] = Query(None, description="Comma-separated IDs")) -> Optional[List[int]]:
+    """
+    Dependency parsing the ``ids`` parameter of the multi-get endpoints.
+
+    Duplicates are dropped, keeping the first occurrence. Returns None when
+    the parameter is absent; more than ``settings.MAX_BATCH_SIZE`` IDs is a
+    400 error.
+    """
+    if ids is None:
+        return None
+    try:
+        parsed = list(dict.fromkeys(int(part) for part in ids.split(",") if part.strip()))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail="Invalid ids") from exc
+    if len(parsed) > settings.MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=400, detail=f"At most {settings.MAX_BATCH_SIZE} ids can be requested")
+    return parsed
+
+async def run_db(db_session: DbSession, func: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Run a synchronous database function (see ``app.crud``) with ``db_session``.
+
+    Async sessions run it through ``AsyncSession.run_sync`` on the event loop,
+    without a thread hop; sync sessions run it in the threadpool.
+    """
+    if isinstance(db_session, AsyncSession):
+        return await db_session.run_sync(func, *args, **kwargs)
+    return await run_in_threadpool(func, db_session, *args, **kwargs)
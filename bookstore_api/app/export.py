@@ -0,0 +1,118 @@
+"""
+Streaming catalog export for the bookstore application.
+
+Exports are generated chunk by chunk: each chunk is one keyset query of
+``settings.EXPORT_CHUNK_SIZE`` rows (plus one query per association table
+for books), encoded and handed to the response before the next one is read.
+Memory use is bounded by the chunk size whatever the size of the catalog,
+and the first bytes leave as soon as the first chunk is read.
+
+The generators open their own read session, since the response body is
+produced after the endpoint has returned. That session reads every chunk in
+one explicit transaction, so the dump is a consistent snapshot: pysqlite
+would otherwise run each query in a transaction of its own, and PostgreSQL
+takes a new snapshot per statement under READ COMMITTED.
+"""
+import csv
+import io
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Sequence
+
+import orjson
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app import database, models
+from app.config import settings
+from app.loaders import AUTHOR_COLUMNS, BOOK_COLUMNS, book_records
+
+NDJSON = "ndjson"
+CSV = "csv"
+MEDIA_TYPES = {NDJSON: "application/x-ndjson", CSV: "text/csv"}
+
+def _plain_rows(_db_session: Session, rows) -> List[Dict[str, Any]]:
+    return [row._asdict() for row in rows]
+
+class ExportSpec(NamedTuple):
+    """
+    What an export reads: the selected columns, the fields of its records in
+    output order, how the rows of a chunk become records, and the ID column
+    the chunks are keyed on (selected as ``id``).
+    """
+    columns: Sequence[Any]
+    fields: Sequence[str]
+    to_records: Callable[[Session, Sequence[Any]], List[Dict[str, Any]]]
+    id_column: Any
+
+EXPORTS: Dict[str, ExportSpec] = {
+    "books": ExportSpec(
+        BOOK_COLUMNS,
+        ["title", "publication_date", "id", "authors", "genres"],
+        book_records,
+        models.Book.id),
+    "authors": ExportSpec(
+        AUTHOR_COLUMNS,
+        ["full_name", "birth_date", "id"],
+        _plain_rows,
+        models.Author.id),
+    "genres": ExportSpec(
+        [models.Genre.name, models.Genre.id, models.Genre.parent_id],
+        ["name", "id", "parent_id"],
+        _plain_rows,
+        models.Genre.id),
+}
+
+def _chunks(db_session: Session, spec: ExportSpec) -> Iterator[List[Dict[str, Any]]]:
+    last_id = None
+    while True:
+        query = select(*spec.columns).order_by(spec.id_column).limit(settings.EXPORT_CHUNK_SIZE)
+        if last_id is not None:
+            query = query.where(spec.id_column > last_id)
+        rows = db_session.execute(query).all()
+        if not rows:
+            return
+        yield spec.to_records(db_session, rows)
+        last_id = rows[-1].id
+
+def _csv_value(value: Any) -> Any:
+    if isinstance(value, list):
+        return " ".join(str(item) for item in value)
+    return "" if value is None else value
+
+def _encode_ndjson(records: List[Dict[str, Any]]) -> bytes:
+    return b"".join(orjson.dumps(record) + b"\n" for record in records)  # pylint: disable=no-member
+
+def _encode_csv(fields: Sequence[str]) -> Callable[[List[Dict[str, Any]]], bytes]:
+    def encode(records):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows([_csv_value(record[field]) for field in fields] for record in records)
+        return buffer.getvalue().encode()
+    return encode
+
+def _begin_snapshot(db_session: Session):
+    dialect = db_session.get_bind().dialect.name
+    if dialect == "postgresql":
+        db_session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    elif dialect == "sqlite":
+        connection = db_session.connection()
+        # Write engines have already begun one with BEGIN IMMEDIATE.
+        if not connection.connection.driver_connection.in_transaction:
+            connection.exec_driver_sql("BEGIN")
+
+def stream(name: str, fmt: str) -> Iterator[bytes]:
+    """
+    Stream the export ``name`` in format ``fmt``, one encoded chunk at a time.
+
+    CSV exports start with a header row; list values (the author and genre
+    IDs of books) are joined with spaces.
+    """
+    spec = EXPORTS[name]
+    if fmt == CSV:
+        yield (",".join(spec.fields) + "\r\n").encode()
+        encode = _encode_csv(spec.fields)
+    else:
+        encode = _encode_ndjson
+    with database.ReadSessionLocal() as db_session:
+        _begin_snapshot(db_session)
+        for records in _chunks(db_session, spec):
+            yield encode(records)
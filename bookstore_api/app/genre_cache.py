@@ -0,0 +1,173 @@
+"""
+In-process cache of the genre tree.
+
+The taxonomy is read on every storefront page but almost never changes, so
+it is loaded with a single query into an immutable ``GenreTree`` holding the
+pre-serialized JSON of every genre (including its nested subgenres). The
+genre endpoints serve those bytes directly instead of lazy-loading
+``Genre.subgenres`` level by level and re-running Pydantic serialization.
+
+The tree is rebuilt whenever a session that flushed a ``Genre`` commits and
+swapped in with a single reference assignment, so readers never observe a
+partially built tree. Each process keeps its own tree and only sees its own
+commits, so the tree also records the genres change counter it was built
+from, and ``get_tree()`` compares it with the current counter before serving
+it: a tree built before a write of another worker is rebuilt, at the cost of
+one primary key lookup per read. Every write to ``genres`` must therefore
+bump that counter.
+"""
+import bisect
+import json
+import threading
+from itertools import chain
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from app import models, versioning
+
+class GenreNode:  # pylint: disable=too-few-public-methods
+    """
+    A genre of the cached tree.
+    """
+    __slots__ = ("id", "name", "parent_id", "children")
+
+    def __init__(self, genre_id: int, name: str, parent_id: Optional[int]):
+        self.id = genre_id
+        self.name = name
+        self.parent_id = parent_id
+        self.children: Tuple[int, ...] = ()
+
+class GenreTree:
+    """
+    Immutable snapshot of all genres with their pre-serialized JSON, as of
+    the genres change counter ``version``.
+    """
+
+    def __init__(self, nodes: Dict[int, GenreNode], version: int = 0):
+        self.version = version
+        self.nodes: Mapping[int, GenreNode] = MappingProxyType(nodes)
+        self.ids: Tuple[int, ...] = tuple(sorted(nodes))
+        self._json = self._serialize(nodes)
+
+    def _serialize(self, nodes: Dict[int, GenreNode]) -> Dict[int, bytes]:
+        # Serialize children before their parents without recursing, so deep
+        # trees cannot hit the recursion limit.
+        order: List[int] = []
+        stack = [genre_id for genre_id, node in nodes.items() if node.parent_id not in nodes]
+        while stack:
+            genre_id = stack.pop()
+            order.append(genre_id)
+            stack.extend(nodes[genre_id].children)
+
+        serialized: Dict[int, bytes] = {}
+        for genre_id in reversed(order):
+            node = nodes[genre_id]
+            subgenres = b",".join(serialized[child] for child in node.children)
+            serialized[genre_id] = b"".join((
+                b'{"name":', json.dumps(node.name, ensure_ascii=False).encode(),
+                b',"id":', str(node.id).encode(),
+                b',"subgenres":[', subgenres, b"]}",
+            ))
+        return serialized
+
+    def genre_json(self, genre_id: int) -> Optional[bytes]:
+        """
+        JSON of a genre with its nested subgenres, or None if it does not exist.
+        """
+        return self._json.get(genre_id)
+
+    def page_json(self, after_id: Optional[int], limit: int) -> Tuple[bytes, Optional[int]]:
+        """
+        JSON array of the genres following ``after_id`` in ID order.
+
+        Returns the array and the ID to resume after, or None on the last page.
+        """
+        start = 0 if after_id is None else bisect.bisect_right(self.ids, after_id)
+        page = self.ids[start:start + limit]
+        body = b"[" + b",".join(self._json[genre_id] for genre_id in page) + b"]"
+        has_more = start + limit < len(self.ids)
+        return body, (page[-1] if has_more and page else None)
+
+    def batch_json(self, genre_ids: List[int]) -> bytes:
+        """
+        JSON object with the ``items`` found among ``genre_ids``, in request
+        order, and the ``missing`` IDs.
+        """
+        found = [self._json[genre_id] for genre_id in genre_ids if genre_id in self._json]
+        missing = [genre_id for genre_id in genre_ids if genre_id not in self._json]
+        return (b'{"items":[' + b",".join(found) + b'],"missing":'
+                + json.dumps(missing).encode() + b"}")
+
+def build(db_session: Session) -> GenreTree:
+    """
+    Build a genre tree from the database in a single query.
+    """
+    # Read the counter first: a write committed in between is then caught by
+    # the next get_tree() instead of being missed.
+    version = _genres_version(db_session)
+    rows = db_session.execute(
+        select(models.Genre.id, models.Genre.name, models.Genre.parent_id)
+        .order_by(models.Genre.id))
+    nodes = {genre_id: GenreNode(genre_id, name, parent_id) for genre_id, name, parent_id in rows}
+    children: Dict[int, List[int]] = {}
+    for node in nodes.values():
+        if node.parent_id in nodes:
+            children.setdefault(node.parent_id, []).append(node.id)
+    for parent_id, child_ids in children.items():
+        nodes[parent_id].children = tuple(child_ids)
+    return GenreTree(nodes, version)
+
+def _genres_version(db_session: Session) -> int:
+    return versioning.read_counters(db_session, [versioning.GENRES])[versioning.GENRES]
+
+_tree: Optional[GenreTree] = None
+_build_lock = threading.Lock()
+
+def get_tree(db_session: Session) -> GenreTree:
+    """
+    Return the current genre tree, building it on first use and rebuilding it
+    when the genres changed since it was built.
+    """
+    tree = _tree
+    version = _genres_version(db_session)
+    if tree is not None and tree.version == version:
+        return tree
+    with _build_lock:
+        if _tree is None or _tree.version != version:
+            rebuild(db_session)
+        return _tree
+
+def rebuild(db_session: Session):
+    """
+    Build a fresh tree and atomically replace the current one.
+    """
+    global _tree  # pylint: disable=global-statement
+    _tree = build(db_session)
+
+def invalidate():
+    """
+    Drop the current tree so that the next read rebuilds it.
+    """
+    global _tree  # pylint: disable=global-statement
+    _tree = None
+
+@event.listens_for(Session, "after_flush")
+def _track_genre_changes(session, _flush_context):
+    changed = chain(session.new, session.dirty, session.deleted)
+    if any(isinstance(instance, models.Genre) for instance in changed):
+        session.info["genres_changed"] = True
+
+@event.listens_for(Session, "after_commit")
+def _rebuild_after_commit(session):
+    if not session.info.pop("genres_changed", False):
+        return
+    # The committing session cannot emit SQL here, so read through a new one.
+    with Session(bind=session.get_bind()) as rebuild_session:
+        rebuild(rebuild_session)
+
+@event.listens_for(Session, "after_rollback")
+def _forget_genre_changes(session):
+    session.info.pop("genres_changed", None)
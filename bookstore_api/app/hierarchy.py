@@ -0,0 +1,89 @@
+"""
+Materialized path helpers for the genre hierarchy.
+
+Every genre stores in ``Genre.path`` the IDs of its ancestors, root first,
+as ``/1/3/`` (``/`` for top-level genres). The descendants of a genre are
+then the rows whose path starts with ``genre.path + "<id>/"``, which is a
+single range scan over the ``genres.path`` index regardless of depth.
+"""
+from typing import List, Optional
+
+from sqlalchemy import String, and_, func, literal, update
+from sqlalchemy.orm import Session
+
+from app import models
+
+ROOT_PATH = "/"
+
+def child_path(parent: Optional[models.Genre]) -> str:
+    """
+    Path to store on a genre placed under ``parent``.
+    """
+    if parent is None:
+        return ROOT_PATH
+    return f"{parent.path}{parent.id}/"
+
+def subtree_prefix(genre: models.Genre) -> str:
+    """
+    Path prefix shared by all descendants of ``genre``.
+    """
+    return child_path(genre)
+
+def prefix_clause(prefix: str):
+    """
+    SQL expression matching the genres whose path starts with ``prefix``.
+
+    Written as a range rather than ``LIKE 'prefix%'`` so SQLite can serve it
+    from the path index without ``case_sensitive_like``.
+    """
+    # '0' sorts right after '/', so this bounds every path extending the prefix.
+    upper = prefix[:-1] + "0"
+    return and_(models.Genre.path >= prefix, models.Genre.path < upper)
+
+def descendants_clause(genre: models.Genre):
+    """
+    SQL expression matching the descendants of ``genre``.
+    """
+    return prefix_clause(subtree_prefix(genre))
+
+def subtree_clause(genre: models.Genre):
+    """
+    SQL expression matching ``genre`` and all its descendants.
+    """
+    return (models.Genre.id == genre.id) | descendants_clause(genre)
+
+def ancestor_ids(genre: models.Genre) -> List[int]:
+    """
+    IDs of the ancestors of ``genre``, root first.
+    """
+    return [int(part) for part in genre.path.strip("/").split("/") if part]
+
+def depth(genre: models.Genre) -> int:
+    """
+    Depth of ``genre`` in the hierarchy, top-level genres having depth 1.
+    """
+    return genre.path.count("/")
+
+def move_subtree(db_session: Session, genre: models.Genre, parent: Optional[models.Genre]):
+    """
+    Re-parent ``genre`` and rewrite the paths of its whole subtree.
+
+    Raises ValueError when ``parent`` is the genre itself or one of its descendants.
+    """
+    if parent is not None and (
+            parent.id == genre.id or parent.path.startswith(subtree_prefix(genre))):
+        raise ValueError("A genre cannot be moved under itself or one of its descendants")
+
+    old_prefix = subtree_prefix(genre)
+    genre.parent_id = parent.id if parent is not None else None
+    genre.path = child_path(parent)
+    new_prefix = subtree_prefix(genre)
+    if new_prefix == old_prefix:
+        return
+
+    db_session.execute(
+        update(models.Genre)
+        .where(prefix_clause(old_prefix))
+        .values(path=literal(new_prefix, String).concat(
+            func.substr(models.Genre.path, len(old_prefix) + 1)))
+        .execution_options(synchronize_session=False))
@@ -0,0 +1,334 @@
+"""
+Background jobs for long-running imports and rebuilds.
+
+A job is a row of the ``jobs`` table processed in chunks of
+``settings.JOB_CHUNK_SIZE`` items by a small pool of worker threads
+(``settings.JOB_WORKERS``), outside of any request. Each chunk is written
+in one transaction together with the job's new checkpoint and counters, so
+a job interrupted by a restart or a crash resumes after its last committed
+chunk instead of starting over: ``resume()`` resubmits every unfinished job
+when the application starts, and ``poll()`` submits the jobs queued since,
+including by other processes, every ``settings.JOB_POLL_INTERVAL`` seconds.
+
+Every chunk holds the SQLite write lock until it commits. Scoring related
+books takes far longer per book than the other kinds, so the related books
+jobs end a chunk after ``settings.JOB_CHUNK_DURATION`` seconds or
+``settings.RELATED_JOB_CHUNK_SIZE`` books, and workers step aside between
+chunks while requests of the process wait for the lock.
+
+Runners advance a job only from the revision they last saw, so when two
+processes resume the same job, only one of them commits each chunk and the
+other gives up.
+
+Kinds:
+
+- ``import_books``: insert the book entries of the payload, like
+  ``POST /books/bulk``; the checkpoint is the index of the next entry
+- ``rebuild_related``: recompute the related books of every book
+- ``refresh_related``: refresh the related books of the books marked stale
+  by ``related.mark_stale()``; queued by the writes marking them
+- ``rebuild_search``: reindex every book for search
+
+For the rebuilds the checkpoint is the last book ID processed; the refresh
+needs none, as it unmarks the books it refreshed.
+"""
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.orm import Session
+
+from app import cache, database, models, related, schemas, search
+from app.bulk import INGEST_TAGS, ingest_books
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+IMPORT_BOOKS = "import_books"
+REBUILD_RELATED = related.REBUILD_JOB
+REBUILD_SEARCH = "rebuild_search"
+REFRESH_RELATED = related.REFRESH_JOB
+
+# Books scored per statement by the related books jobs.
+RELATED_GROUP_SIZE = 5
+
+class Step(NamedTuple):
+    """
+    Outcome of one chunk of a job.
+    """
+    processed: int
+    failed: int
+    errors: List[Any]
+    checkpoint: Any
+    done: bool
+    # Cached responses to drop once the chunk is committed.
+    tags: Iterable[str]
+
+def _import_books(db_session: Session, entries: List[Any], checkpoint: Optional[int]) -> Step:
+    start = checkpoint or 0
+    chunk = [
+        schemas.BookCreate.model_validate(entry) if isinstance(entry, dict) else entry
+        for entry in entries[start:start + settings.JOB_CHUNK_SIZE]
+    ]
+    response = ingest_books(db_session, chunk, offset=start, commit=False)
+    end = start + len(chunk)
+    return Step(
+        processed=len(chunk), failed=response.failed,
+        errors=[
+            result.model_dump(exclude_none=True) for result in response.results if result.errors
+        ],
+        checkpoint=end, done=end >= len(entries), tags=INGEST_TAGS)
+
+def _book_ids_after(db_session: Session, after_id: Optional[int]) -> List[int]:
+    statement = select(models.Book.id).order_by(models.Book.id).limit(settings.JOB_CHUNK_SIZE)
+    if after_id is not None:
+        statement = statement.where(models.Book.id > after_id)
+    return db_session.scalars(statement).all()
+
+def _score_within_budget(score: Callable[[List[int], int], List[int]]) -> Tuple[List[int], bool]:
+    """
+    Score books ``RELATED_GROUP_SIZE`` at a time with ``score(scored, count)``
+    until ``settings.RELATED_JOB_CHUNK_SIZE`` books are scored,
+    ``settings.JOB_CHUNK_DURATION`` seconds are spent or no book is left.
+
+    Returns the IDs of the books scored and whether no book is left.
+    """
+    deadline = time.perf_counter() + settings.JOB_CHUNK_DURATION
+    book_ids: List[int] = []
+    while True:
+        count = min(RELATED_GROUP_SIZE, settings.RELATED_JOB_CHUNK_SIZE - len(book_ids))
+        group = score(book_ids, count)
+        book_ids.extend(group)
+        if len(group) < count:
+            return book_ids, True
+        if len(book_ids) >= settings.RELATED_JOB_CHUNK_SIZE or time.perf_counter() >= deadline:
+            return book_ids, False
+
+def _rebuild_related(db_session: Session, _payload: Any, checkpoint: Optional[int]) -> Step:
+    book_ids, done = _score_within_budget(lambda scored, count: related.rebuild(
+        db_session, scored[-1] if scored else checkpoint, count))
+    return Step(
+        processed=len(book_ids), failed=0, errors=[],
+        checkpoint=book_ids[-1] if book_ids else checkpoint, done=done, tags=[cache.RELATED])
+
+def _refresh_related(db_session: Session, _payload: Any, _checkpoint: Any) -> Step:
+    book_ids, done = _score_within_budget(
+        lambda _scored, count: related.refresh_stale(db_session, count))
+    return Step(
+        processed=len(book_ids), failed=0, errors=[], checkpoint=None, done=done,
+        tags=[cache.RELATED])
+
+def _rebuild_search(db_session: Session, _payload: Any, checkpoint: Optional[int]) -> Step:
+    book_ids = _book_ids_after(db_session, checkpoint)
+    search.get_backend(db_session).index_books(db_session, book_ids)
+    return Step(
+        processed=len(book_ids), failed=0, errors=[],
+        checkpoint=book_ids[-1] if book_ids else checkpoint,
+        done=len(book_ids) < settings.JOB_CHUNK_SIZE, tags=[cache.SEARCH])
+
+# Processing of one chunk of each kind of job, from the decoded payload and checkpoint.
+KINDS: Dict[str, Callable[[Session, Any, Any], Step]] = {
+    IMPORT_BOOKS: _import_books,
+    REBUILD_RELATED: _rebuild_related,
+    REBUILD_SEARCH: _rebuild_search,
+    REFRESH_RELATED: _refresh_related,
+}
+
+def _loads(value: Optional[str]) -> Any:
+    return json.loads(value) if value is not None else None
+
+def job_record(job: models.Job) -> Dict[str, Any]:
+    """
+    Build a ``schemas.Job``-shaped dict.
+    """
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "total": job.total,
+        "processed": job.processed,
+        "failed": job.failed,
+        "throughput": job.processed / job.elapsed if job.elapsed else None,
+        "errors": _loads(job.errors) or [],
+        "error": job.error,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+
+def enqueue(
+    db_session: Session,
+    kind: str,
+    payload: Any = None,
+    total: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Create a queued job, commit and hand it to the worker threads.
+    """
+    if total is None and kind in (REBUILD_RELATED, REBUILD_SEARCH):
+        total = db_session.scalar(
+            select(func.count()).select_from(models.Book))  # pylint: disable=not-callable
+    job_id = db_session.scalar(insert(models.Job).values(
+        kind=kind, status=QUEUED, total=total, created_at=datetime.utcnow(),
+        payload=json.dumps(payload) if payload is not None else None,
+    ).returning(models.Job.id))
+    db_session.commit()
+    submit(job_id)
+    return read_job(db_session, job_id)
+
+def read_job(db_session: Session, job_id: int) -> Dict[str, Any]:
+    """
+    Read the status and progress of a job.
+    """
+    job = db_session.get(models.Job, job_id, populate_existing=True)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_record(job)
+
+def _finish(db_session: Session, job_id: int, revision: int, values: Dict[str, Any]):
+    job = models.Job
+    # Leave the job alone when another runner took it over meanwhile.
+    db_session.execute(update(job).where(job.id == job_id, job.revision == revision).values(
+        finished_at=datetime.utcnow(), **values))
+    db_session.commit()
+
+def run(job_id: int):
+    """
+    Process a job chunk by chunk from its last checkpoint until it is done,
+    fails, loses its revision to another runner or the pool shuts down.
+    """
+    job = models.Job
+    with database.SessionLocal() as db_session:
+        row = db_session.get(job, job_id)
+        if row is None or row.status not in (QUEUED, RUNNING):
+            return
+        revision = row.revision
+        claimed = db_session.execute(update(job).where(
+            job.id == job_id, job.revision == revision
+        ).values(
+            status=RUNNING, revision=revision + 1,
+            started_at=func.coalesce(job.started_at, datetime.utcnow()))).rowcount
+        db_session.commit()
+        if not claimed:
+            return
+        revision += 1
+        step_chunk = KINDS[row.kind]
+        payload = _loads(row.payload)
+        checkpoint = _loads(row.checkpoint)
+        errors = _loads(row.errors) or []
+        while not _stopping.is_set():
+            started = time.perf_counter()
+            try:
+                step = step_chunk(db_session, payload, checkpoint)
+                values = {
+                    "checkpoint": json.dumps(step.checkpoint),
+                    "revision": revision + 1,
+                    "processed": job.processed + step.processed,
+                    "failed": job.failed + step.failed,
+                    "elapsed": job.elapsed + (time.perf_counter() - started),
+                }
+                if step.errors and len(errors) < settings.JOB_MAX_ERRORS:
+                    errors.extend(step.errors[:settings.JOB_MAX_ERRORS - len(errors)])
+                    values["errors"] = json.dumps(errors, default=str)
+                if step.done:
+                    values.update(status=SUCCEEDED, finished_at=datetime.utcnow())
+                advanced = db_session.execute(update(job).where(
+                    job.id == job_id, job.revision == revision).values(**values)).rowcount
+                if not advanced:
+                    # Another runner took the job over.
+                    db_session.rollback()
+                    return
+                db_session.commit()
+            except Exception as exc:  # pylint: disable=broad-except
+                # Any error fails the job; its committed chunks are kept.
+                logger.exception("Job %s failed", job_id)
+                db_session.rollback()
+                _finish(db_session, job_id, revision, {"status": FAILED, "error": str(exc)})
+                return
+            cache.invalidate(step.tags)
+            if step.done:
+                return
+            revision += 1
+            checkpoint = step.checkpoint
+            _yield_to_writers()
+
+def _yield_to_writers():
+    # Let waiting writers take the lock before the next chunk, for as long as
+    # requests of this process are still waiting for it, within bounds.
+    # Writers of other processes only get the first pause.
+    for _ in range(settings.JOB_MAX_PAUSES):
+        if _stopping.wait(settings.JOB_CHUNK_PAUSE) or not database.waiting_writers():
+            return
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+_stopping = threading.Event()
+# Jobs submitted and not yet run to completion by this process.
+_submitted: Set[int] = set()
+
+def _run_submitted(job_id: int):
+    try:
+        with database.background_writes():
+            run(job_id)
+    finally:
+        with _pool_lock:
+            _submitted.discard(job_id)
+
+def submit(job_id: int):
+    """
+    Run a job on the worker threads, starting them on first use, unless
+    this process already has it waiting or running.
+    """
+    global _pool  # pylint: disable=global-statement
+    with _pool_lock:
+        if job_id in _submitted:
+            return
+        if _pool is None:
+            _stopping.clear()
+            _pool = ThreadPoolExecutor(settings.JOB_WORKERS, thread_name_prefix="job")
+        _submitted.add(job_id)
+        _pool.submit(_run_submitted, job_id)
+
+def _submit_all(statuses: Iterable[str]):
+    with database.ReadSessionLocal() as db_session:
+        job_ids = db_session.scalars(
+            select(models.Job.id).where(models.Job.status.in_(statuses))
+            .order_by(models.Job.id)).all()
+    for job_id in job_ids:
+        submit(job_id)
+
+def resume():
+    """
+    Resubmit every queued or interrupted job, oldest first.
+    """
+    _submit_all((QUEUED, RUNNING))
+
+def poll():
+    """
+    Submit every queued job, oldest first. Running jobs are left to their
+    runner.
+    """
+    _submit_all((QUEUED,))
+
+def shutdown():
+    """
+    Stop the worker threads once their current chunk is committed. Running
+    jobs keep their status and are resumed on the next start.
+    """
+    global _pool  # pylint: disable=global-statement
+    with _pool_lock:
+        pool, _pool = _pool, None
+        _stopping.set()
+        _submitted.clear()
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
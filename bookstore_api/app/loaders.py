@@ -0,0 +1,227 @@
+"""
+Batched relationship loading for the bookstore application.
+
+Book responses only carry author and genre IDs, so instead of walking the
+lazy ``Book.authors`` / ``Book.genres`` relationships (two SELECTs per book)
+the IDs for a whole page are read straight from the association tables in
+one query per table.
+
+Read endpoints skip the ORM altogether: they select only the response
+columns with Core and build plain dicts, with keys in the order of the
+response schemas, which are encoded straight to JSON bytes.
+
+Book read endpoints also take a ``BookView``: ``fields=`` narrows the
+returned fields, so unrequested columns are not selected and unrequested
+associations are not read, and ``include=`` replaces author and genre IDs
+with the full objects, loaded for the whole page in one query per relation.
+"""
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException, Query
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app import models, schemas
+
+def load_association_ids(
+    db_session: Session,
+    book_ids: Iterable[int],
+    authors: bool = True,
+    genres: bool = True) -> Tuple[Dict[int, List[int]], Dict[int, List[int]]]:
+    """
+    Load the author IDs and genre IDs of the given books.
+
+    Returns two mappings of book ID to a sorted list of IDs. Passing
+    ``authors=False`` or ``genres=False`` skips the query for that
+    association and leaves its mapping empty.
+    """
+    book_ids = list(book_ids)
+    author_ids = defaultdict(list)
+    genre_ids = defaultdict(list)
+    if not book_ids:
+        return author_ids, genre_ids
+
+    if authors:
+        book_authors = models.book_authors.c
+        rows = db_session.execute(
+            select(book_authors.book_id, book_authors.author_id)
+            .where(book_authors.book_id.in_(book_ids))
+            .order_by(book_authors.book_id, book_authors.author_id))
+        for book_id, author_id in rows:
+            author_ids[book_id].append(author_id)
+
+    if genres:
+        book_genres = models.book_genres.c
+        rows = db_session.execute(
+            select(book_genres.book_id, book_genres.genre_id)
+            .where(book_genres.book_id.in_(book_ids))
+            .order_by(book_genres.book_id, book_genres.genre_id))
+        for book_id, genre_id in rows:
+            genre_ids[book_id].append(genre_id)
+
+    return author_ids, genre_ids
+
+def serialize_books(db_session: Session, books: List[models.Book]) -> List[schemas.Book]:
+    """
+    Build ``schemas.Book`` objects for a page of books in a constant number of queries.
+    """
+    author_ids, genre_ids = load_association_ids(db_session, (book.id for book in books))
+    return [
+        schemas.Book(
+            id=book.id,
+            title=book.title,
+            publication_date=book.publication_date,
+            authors=author_ids.get(book.id, []),
+            genres=genre_ids.get(book.id, []))
+        for book in books
+    ]
+
+def serialize_book(db_session: Session, book: models.Book) -> schemas.Book:
+    """
+    Build a ``schemas.Book`` for a single book.
+    """
+    return serialize_books(db_session, [book])[0]
+
+# Columns selected by the projection read path.
+BOOK_COLUMNS = (models.Book.id, models.Book.title, models.Book.publication_date)
+AUTHOR_COLUMNS = (models.Author.full_name, models.Author.birth_date, models.Author.id)
+GENRE_SUMMARY_COLUMNS = (models.Genre.name, models.Genre.id, models.Genre.parent_id)
+
+# Fields of ``schemas.Book``, in response order, and the relations that can be embedded.
+BOOK_FIELDS = ("title", "publication_date", "id", "authors", "genres")
+BOOK_RELATIONS = ("authors", "genres")
+
+@dataclass(frozen=True)
+class BookView:
+    """
+    Requested shape of book records: the fields to return and the relations
+    to embed as full objects instead of IDs. The ID is always returned.
+    """
+    fields: FrozenSet[str] = frozenset(BOOK_FIELDS)
+    include: FrozenSet[str] = frozenset()
+
+    @property
+    def columns(self) -> Tuple[Any, ...]:
+        """
+        Columns to select for this view, a subset of ``BOOK_COLUMNS``.
+        """
+        return tuple(column for column in BOOK_COLUMNS
+                     if column.key == "id" or column.key in self.fields)
+
+    @property
+    def etag_variant(self) -> Optional[str]:
+        """
+        Suffix telling this view's ETags apart from the full record's, or
+        None for the full view.
+        """
+        if self is FULL_VIEW:
+            return None
+        return "+".join(sorted(self.fields))
+
+FULL_VIEW = BookView()
+
+def _split(value: Optional[str], allowed: Sequence[str], name: str) -> Optional[FrozenSet[str]]:
+    if value is None:
+        return None
+    names = frozenset(part.strip() for part in value.split(",") if part.strip())
+    unknown = sorted(names.difference(allowed))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown {name}: {', '.join(unknown)}")
+    return names
+
+def book_view(
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+    include: Optional[str] = Query(None, description="Relations to embed: authors, genres")
+) -> BookView:
+    """
+    Dependency reading the ``fields`` and ``include`` parameters of book endpoints.
+
+    Included relations are returned even when ``fields`` leaves them out.
+    """
+    requested = _split(fields, BOOK_FIELDS, "fields")
+    included = _split(include, BOOK_RELATIONS, "include") or frozenset()
+    if requested is None and not included:
+        return FULL_VIEW
+    return BookView(fields=(requested or frozenset(BOOK_FIELDS)) | included, include=included)
+
+def _embedded_authors(db_session: Session, author_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    author_ids = set(author_ids)
+    if not author_ids:
+        return {}
+    rows = db_session.execute(select(*AUTHOR_COLUMNS).where(models.Author.id.in_(author_ids)))
+    return {record["id"]: record for record in author_records(rows.all())}
+
+def _embedded_genres(db_session: Session, genre_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    genre_ids = set(genre_ids)
+    if not genre_ids:
+        return {}
+    rows = db_session.execute(select(*GENRE_SUMMARY_COLUMNS).where(models.Genre.id.in_(genre_ids)))
+    return {record["id"]: record for record in genre_summary_records(rows.all())}
+
+def book_records(
+    db_session: Session,
+    rows: Sequence[Any],
+    view: BookView = FULL_VIEW) -> List[Dict[str, Any]]:
+    """
+    Build ``schemas.Book``-shaped dicts from rows of ``view.columns``.
+
+    Runs at most one query per requested association and one per included
+    relation, whatever the number of rows.
+    """
+    fields = view.fields
+    author_ids, genre_ids = load_association_ids(
+        db_session, (row.id for row in rows),
+        authors="authors" in fields, genres="genres" in fields)
+    relations = {"authors": author_ids, "genres": genre_ids}
+    if "authors" in view.include:
+        authors = _embedded_authors(db_session, (i for ids in author_ids.values() for i in ids))
+        relations["authors"] = {
+            book_id: [authors[i] for i in ids if i in authors]
+            for book_id, ids in author_ids.items()
+        }
+    if "genres" in view.include:
+        genres = _embedded_genres(db_session, (i for ids in genre_ids.values() for i in ids))
+        relations["genres"] = {
+            book_id: [genres[i] for i in ids if i in genres]
+            for book_id, ids in genre_ids.items()
+        }
+
+    if view is FULL_VIEW:
+        return [
+            {
+                "title": row.title,
+                "publication_date": row.publication_date,
+                "id": row.id,
+                "authors": author_ids.get(row.id, []),
+                "genres": genre_ids.get(row.id, []),
+            }
+            for row in rows
+        ]
+    records = []
+    for row in rows:
+        record = {}
+        for field in BOOK_FIELDS:
+            if field in relations:
+                if field in fields:
+                    record[field] = relations[field].get(row.id, [])
+            elif field == "id" or field in fields:
+                record[field] = getattr(row, field)
+        records.append(record)
+    return records
+
+def author_records(rows: Sequence[Any]) -> List[Dict[str, Any]]:
+    """
+    Build ``schemas.Author``-shaped dicts from rows of ``AUTHOR_COLUMNS``.
+    """
+    return [
+        {"full_name": row.full_name, "birth_date": row.birth_date, "id": row.id}
+        for row in rows
+    ]
+
+def genre_summary_records(rows: Sequence[Any]) -> List[Dict[str, Any]]:
+    """
+    Build ``schemas.GenreSummary``-shaped dicts from rows holding ``GENRE_SUMMARY_COLUMNS``.
+    """
+    return [{"name": row.name, "id": row.id, "parent_id": row.parent_id} for row in rows]
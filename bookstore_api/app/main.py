@@ -1,226 +1,759 @@
 """
 Main module for the FastAPI application.
 """
-from typing import List
-from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy.orm import Session
-from . import models, schemas, database
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Iterable, List, Literal, Optional, Union
+import anyio.to_thread
+from fastapi import FastAPI, Body, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exception_handlers import http_exception_handler
+from fastapi.responses import (
+    ORJSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse)
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from . import (
+    admission, cache, changes, crud, schemas, database, export, genre_cache, jobs, metrics,
+    snapshot, versioning)
+from .config import settings
+from .bulk import bulk_payload, ingest_books
+from .dependencies import DbSession, batch_ids, get_read_session, get_session, run_db
+from .filters import BookFilters, book_filters
+from .loaders import BookView, book_view
+from .pagination import PageParams, page_params, page_size, set_next_page
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
 
-# Initialize the database
-database.init_db()
+def compact_changes() -> int:
+    """
+    Compact the change log entries older than ``settings.CHANGES_RETENTION``.
+    """
+    with database.SessionLocal() as db_session:
+        return changes.compact(db_session, timedelta(seconds=settings.CHANGES_RETENTION))
+
+async def compact_changes_periodically():
+    """
+    Compact the change log every ``settings.CHANGES_COMPACT_INTERVAL`` seconds.
+    """
+    while True:
+        try:
+            await run_in_threadpool(compact_changes)
+        except SQLAlchemyError:
+            logger.exception("Change log compaction failed")
+        await asyncio.sleep(settings.CHANGES_COMPACT_INTERVAL)
+
+def refresh_snapshot(force: bool = False) -> bool:
+    """
+    Reload the catalog snapshot if the catalog changed since it was loaded.
+    """
+    with database.ReadSessionLocal() as db_session:
+        return snapshot.refresh(db_session, force)
 
-def get_db():
+async def refresh_snapshot_periodically():
     """
-    Dependency to get the database session.
+    Refresh the catalog snapshot every ``settings.SNAPSHOT_REFRESH_INTERVAL`` seconds.
     """
-    db_session = database.SessionLocal()
-    try:
-        yield db_session
-    finally:
-        db_session.close()
+    while True:
+        await asyncio.sleep(settings.SNAPSHOT_REFRESH_INTERVAL)
+        try:
+            await run_in_threadpool(refresh_snapshot)
+        except SQLAlchemyError:
+            logger.exception("Catalog snapshot refresh failed")
+
+async def poll_jobs_periodically():
+    """
+    Submit the queued background jobs every ``settings.JOB_POLL_INTERVAL`` seconds.
+    """
+    while True:
+        await asyncio.sleep(settings.JOB_POLL_INTERVAL)
+        try:
+            await run_in_threadpool(jobs.poll)
+        except SQLAlchemyError:
+            logger.exception("Polling for background jobs failed")
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """
+    Initialize the database and warm the genre tree cache on startup, and
+    compact the change log in the background while serving. In snapshot
+    mode, load the catalog snapshot and keep it refreshed as well.
+
+    Unfinished background jobs are resumed on startup, queued ones are
+    picked up while serving, and the job workers stop after their current
+    chunk on shutdown.
+    """
+    if settings.THREADPOOL_SIZE is not None:
+        anyio.to_thread.current_default_thread_limiter().total_tokens = settings.THREADPOOL_SIZE
+    database.init_db()
+    with database.SessionLocal() as db_session:
+        genre_cache.rebuild(db_session)
+    tasks = [asyncio.create_task(compact_changes_periodically())]
+    if settings.SNAPSHOT_ENABLED:
+        await run_in_threadpool(refresh_snapshot, True)
+        tasks.append(asyncio.create_task(refresh_snapshot_periodically()))
+    await run_in_threadpool(jobs.resume)
+    tasks.append(asyncio.create_task(poll_jobs_periodically()))
+    yield
+    for task in tasks:
+        task.cancel()
+    await run_in_threadpool(jobs.shutdown)
+    snapshot.clear()
+
+app = FastAPI(lifespan=lifespan, dependencies=[Depends(admission.admit)])
+app.add_middleware(admission.AdmissionMiddleware)
+if settings.METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+
+@app.exception_handler(OperationalError)
+async def database_locked_handler(request: Request, exc: OperationalError) -> Response:
+    """
+    Answer a write that waited for the SQLite write lock longer than the
+    busy timeout like a request shed by admission control: a 503 with
+    ``Retry-After``. Other operational errors remain server errors.
+    """
+    if not database.is_lock_timeout(exc):
+        raise exc
+    return await http_exception_handler(request, admission.overloaded())
+
+def json_response(content: bytes) -> Response:
+    """
+    Wrap pre-serialized JSON in a response.
+    """
+    return Response(content=content, media_type="application/json")
+
+CACHED_HEADERS = ("etag", "link", "x-next-cursor")
+
+def list_redirect(request: Request) -> Response:
+    """
+    Send a multi-get route called without ``ids`` to the list route it shadows.
+    """
+    return RedirectResponse(request.url.replace(path=request.url.path + "/"), status_code=307)
+
+def not_modified(etag: str) -> Response:
+    """
+    Empty 304 response for a matching ``If-None-Match``.
+    """
+    return Response(status_code=304, headers={"ETag": etag})
+
+def book_etag(
+    db_session: DbSession,
+    book_id: int,
+    variant: Optional[str] = None) -> Callable[[], Awaitable[str]]:
+    """
+    Strong ETag of a book, or of its representation ``variant``, read from
+    its version alone.
+    """
+    async def etag():
+        version = await run_db(db_session, crud.book_version, book_id)
+        return versioning.strong_etag("book", book_id, version, variant)
+    return etag
+
+def author_etag(db_session: DbSession, author_id: int) -> Callable[[], Awaitable[str]]:
+    """
+    Strong ETag of an author, read from its version alone.
+    """
+    async def etag():
+        version = await run_db(db_session, crud.author_version, author_id)
+        return versioning.strong_etag("author", author_id, version)
+    return etag
+
+def list_etag(db_session: DbSession, *tables: str) -> Callable[[], Awaitable[str]]:
+    """
+    Weak ETag of a list built from ``tables``, read from their change counters.
+    """
+    async def etag():
+        return versioning.weak_etag(await run_db(db_session, versioning.read_counters, tables))
+    return etag
+
+def in_memory(func: Callable[..., Any], *args: Any) -> Callable[[], Awaitable[Any]]:
+    """
+    Call a read of the catalog snapshot on the event loop, for ``cached_json``.
+    """
+    async def call():
+        return func(*args)
+    return call
+
+# Cache tags and change counters of the relations a book view can embed.
+INCLUDE_TAGS = {"authors": cache.AUTHORS, "genres": cache.GENRES}
+INCLUDE_TABLES = {"authors": versioning.AUTHORS, "genres": versioning.GENRES}
+
+def view_tags(view: BookView, tags: Iterable[str]) -> List[str]:
+    """
+    Cache tags of a book response, plus those of the relations it embeds.
+    """
+    return [*tags, *(INCLUDE_TAGS[relation] for relation in sorted(view.include))]
+
+def view_tables(view: BookView, *tables: str) -> List[str]:
+    """
+    Change counters of a book response built from ``tables`` and the relations it embeds.
+    """
+    return [*tables, *(INCLUDE_TABLES[relation] for relation in sorted(view.include)
+                       if INCLUDE_TABLES[relation] not in tables)]
+
+def view_etag(db_session: DbSession, view: BookView, *tables: str) -> Callable[[], Awaitable[str]]:
+    """
+    Weak ETag of a book response built from ``tables`` and the relations it embeds.
+    """
+    return list_etag(db_session, *view_tables(view, *tables))
+
+async def cached_json(
+    request: Request,
+    tags: Iterable[str],
+    produce: Callable[[], Awaitable[Any]],
+    paginated: bool = False,
+    etag: Optional[Callable[[], Awaitable[str]]] = None) -> Response:
+    """
+    Serve a read endpoint through the response cache.
+
+    ``produce`` returns the payload as plain dicts and lists, or a
+    ``(payload, next_cursor)`` pair when ``paginated``; it is encoded straight
+    to bytes with orjson. Only successful responses are cached.
+
+    ``etag`` returns the current ETag of the resource. It is read before the
+    payload, so a concurrent write can only make it older than the body, and
+    answers a matching ``If-None-Match`` with a 304 before any serialization.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if not settings.RESPONSE_CACHE_ENABLED:
+        key = None
+    else:
+        key = cache.response_cache.key(request.url.path, request.url.query)
+        entry = cache.response_cache.get(key)
+        if entry is not None:
+            if versioning.none_match(if_none_match, entry.headers.get("etag")):
+                return not_modified(entry.headers["etag"])
+            return Response(
+                content=entry.body, headers=entry.headers, media_type="application/json")
+        generation = cache.response_cache.generation
+
+    current_etag = await etag() if etag is not None else None
+    if versioning.none_match(if_none_match, current_etag):
+        return not_modified(current_etag)
+    payload, next_cursor = await produce() if paginated else (await produce(), None)
+    response = ORJSONResponse(content=payload)
+    set_next_page(request, response, next_cursor)
+    if current_etag is not None:
+        response.headers["ETag"] = current_etag
+    if key is not None:
+        headers = {
+            name: response.headers[name] for name in CACHED_HEADERS if name in response.headers
+        }
+        cache.response_cache.set(key, response.body, headers, tags, generation)
+    return response
 
 # Add the root endpoint
 @app.get("/")
-def read_root():
+async def read_root():
     """Root endpoint returning a welcome message."""
     return {"message": "Welcome to the Bookstore API!"}
 
 @app.post("/books/", response_model=schemas.Book)
-def create_book(book: schemas.BookCreate, db_session: Session = Depends(get_db)):
+async def create_book(book: schemas.BookCreate, db_session: DbSession = Depends(get_session)):
     """
     Create a new book.
     """
-    db_book = models.Book(
-        title=book.title,
-        publication_date=book.publication_date
-    )
-    db_session.add(db_book)
-    db_session.commit()
-    db_session.refresh(db_book)
-
-    for author_id in book.author_ids:
-        author = db_session.query(models.Author).filter(models.Author.id == author_id).first()
-        if author:
-            db_book.authors.append(author)
-
-    for genre_id in book.genre_ids:
-        genre = db_session.query(models.Genre).filter(models.Genre.id == genre_id).first()
-        if genre:
-            db_book.genres.append(genre)
+    return await run_db(db_session, crud.create_book, book)
 
-    db_session.commit()
-    db_session.refresh(db_book)
-    return schemas.Book.from_orm(db_book)
+@app.post("/books/bulk", response_model=schemas.BulkBookResponse)
+async def create_books_bulk(
+    entries: List[Union[schemas.BookCreate, List[Any]]] = Depends(bulk_payload),
+    db_session: DbSession = Depends(get_session)):
+    """
+    Create many books from a JSON array or an NDJSON stream.
+    """
+    return await run_db(db_session, ingest_books, entries)
 
 @app.get("/books/{book_id}", response_model=schemas.Book)
-def read_book(book_id: int, db_session: Session = Depends(get_db)):
+async def read_book(
+    book_id: int,
+    request: Request,
+    view: BookView = Depends(book_view),
+    db_session: DbSession = Depends(get_read_session)):
     """
     Read details of a specific book.
-    """
-    book = db_session.query(models.Book).filter(models.Book.id == book_id).first()
-    if book is None:
-        raise HTTPException(status_code=404, detail="Book not found")
-    return schemas.Book.from_orm(book)
+
+    Embedded authors and genres change without the book version changing, so
+    ``include`` switches the strong ETag to a weak one; ``fields`` alone keeps
+    it strong, but distinct from the full record's.
+    """
+    tags = view_tags(view, [cache.book_tag(book_id)])
+    catalog = snapshot.current()
+    if catalog is not None:
+        return await cached_json(
+            request, tags, in_memory(catalog.read_book, book_id, view),
+            etag=in_memory(catalog.list_etag, view_tables(view, versioning.BOOKS)) if view.include
+            else in_memory(catalog.book_etag, book_id, view.etag_variant))
+    return await cached_json(
+        request, tags,
+        lambda: run_db(db_session, crud.read_book, book_id, view),
+        etag=view_etag(db_session, view, versioning.BOOKS) if view.include
+        else book_etag(db_session, book_id, view.etag_variant))
+
+@app.get("/books", response_model=schemas.BookBatch)
+async def read_books(
+    request: Request,
+    ids: Optional[List[int]] = Depends(batch_ids),
+    view: BookView = Depends(book_view),
+    db_session: DbSession = Depends(get_read_session)):
+    """
+    Read several books at once with ``?ids=1,2,3``, in the requested order.
+
+    IDs of books that do not exist are listed in ``missing``.
+    """
+    if ids is None:
+        return list_redirect(request)
+    # Bulk imports only invalidate BOOK_LISTS.
+    tags = view_tags(view, [cache.BOOK_LISTS, *(cache.book_tag(book_id) for book_id in ids)])
+    catalog = snapshot.current()
+    if catalog is not None:
+        return await cached_json(
+            request, tags, in_memory(catalog.read_books, ids, view),
+            etag=in_memory(catalog.list_etag, view_tables(view, versioning.BOOKS)))
+    return await cached_json(
+        request, tags,
+        lambda: run_db(db_session, crud.read_books, ids, view),
+        etag=view_etag(db_session, view, versioning.BOOKS))
 
 @app.get("/genres/", response_model=List[schemas.Genre])
-def list_genres(db_session: Session = Depends(get_db)):
+async def list_genres(
+    request: Request,
+    page: PageParams = Depends(page_params),
+    db_session: DbSession = Depends(get_read_session)):
     """
-    List all genres.
+    List genres, one page at a time.
     """
-    genres = db_session.query(models.Genre).all()
-    return [schemas.Genre.from_orm(genre) for genre in genres]
+    content, next_cursor = await run_db(db_session, crud.list_genres, page)
+    response = json_response(content)
+    set_next_page(request, response, next_cursor)
+    return response
 
 @app.get("/books/", response_model=List[schemas.Book])
-def list_books(db_session: Session = Depends(get_db)):
-    """
-    List all books.
+async def list_books(
+    request: Request,
+    page: PageParams = Depends(page_params),
+    view: BookView = Depends(book_view),
+    filters: BookFilters = Depends(book_filters),
+    db_session: DbSession = Depends(get_read_session)):
+    """
+    List books, one page at a time, optionally filtered and sorted.
+
+    Filters combine: ``published_from`` / ``published_to`` (inclusive),
+    ``title_prefix`` (case-sensitive), ``author_id`` and ``genre_id``.
+    ``sort`` is ``id`` (the default), ``title`` or ``publication_date``,
+    prefixed with ``-`` for descending order.
+    """
+    tags = view_tags(view, [cache.BOOKS, cache.BOOK_LISTS])
+    catalog = snapshot.current()
+    if catalog is not None and not filters.active and filters.sort == "id":
+        return await cached_json(
+            request, tags, in_memory(catalog.list_books, page, view), paginated=True,
+            etag=in_memory(catalog.list_etag, view_tables(view, versioning.BOOKS)))
+    return await cached_json(
+        request, tags,
+        lambda: run_db(db_session, crud.list_books, page, view, filters), paginated=True,
+        etag=view_etag(db_session, view, versioning.BOOKS))
+
+@app.get("/search", response_model=List[schemas.Book])
+async def search_books(
+    request: Request,
+    q: str = Query(..., min_length=1),
+    page: PageParams = Depends(page_params),
+    view: BookView = Depends(book_view),
+    db_session: DbSession = Depends(get_read_session)):
+    """
+    Search books by title and author names, best match first.
+
+    Every word of ``q`` is matched as a prefix.
     """
-    books = db_session.query(models.Book).all()
-    return [schemas.Book.from_orm(book) for book in books]
+    return await cached_json(
+        request, view_tags(view, [cache.SEARCH]),
+        lambda: run_db(db_session, crud.search_books, q, page, view), paginated=True,
+        etag=view_etag(db_session, view, versioning.BOOKS, versioning.AUTHORS))
 
 @app.get("/authors/", response_model=List[schemas.Author])
-def list_authors(db_session: Session = Depends(get_db)):
-    """
-    List all authors.
+async def list_authors(
+    request: Request,
+    page: PageParams = Depends(page_params),
+    db_session: DbSession = Depends(get_read_session)):
+    """
+    List authors, one page at a time.
+    """
+    catalog = snapshot.current()
+    if catalog is not None:
+        return await cached_json(
+            request, [cache.AUTHORS], in_memory(catalog.list_authors, page), paginated=True,
+            etag=in_memory(catalog.list_etag, [versioning.AUTHORS]))
+    return await cached_json(
+        request, [cache.AUTHORS],
+        lambda: run_db(db_session, crud.list_authors, page), paginated=True,
+        etag=list_etag(db_session, versioning.AUTHORS))
+
+@app.get("/authors", response_model=schemas.AuthorBatch)
+async def read_authors(
+    request: Request,
+    ids: Optional[List[int]] = Depends(batch_ids),
+    db_session: DbSession = Depends(get_read_session)):
     """
-    authors = db_session.query(models.Author).all()
-    return [schemas.Author.from_orm(author) for author in authors]
+    Read several authors at once with ``?ids=1,2,3``, in the requested order.
+
+    IDs of authors that do not exist are listed in ``missing``.
+    """
+    if ids is None:
+        return list_redirect(request)
+    tags = [cache.AUTHORS, *(cache.author_tag(author_id) for author_id in ids)]
+    catalog = snapshot.current()
+    if catalog is not None:
+        return await cached_json(
+            request, tags, in_memory(catalog.read_authors, ids),
+            etag=in_memory(catalog.list_etag, [versioning.AUTHORS]))
+    return await cached_json(
+        request, tags,
+        lambda: run_db(db_session, crud.read_authors, ids),
+        etag=list_etag(db_session, versioning.AUTHORS))
 
 @app.post("/authors/", response_model=schemas.Author)
-def create_author(author: schemas.AuthorCreate, db_session: Session = Depends(get_db)):
+async def create_author(
+    author: schemas.AuthorCreate,
+    db_session: DbSession = Depends(get_session)):
     """
     Create a new author.
     """
-    db_author = models.Author(
-        full_name=author.full_name,
-        birth_date=author.birth_date
-    )
-    db_session.add(db_author)
-    db_session.commit()
-    db_session.refresh(db_author)
-    return schemas.Author.from_orm(db_author)
+    return await run_db(db_session, crud.create_author, author)
 
 @app.post("/genres/", response_model=schemas.Genre)
-def create_genre(genre: schemas.GenreCreate, db_session: Session = Depends(get_db)):
+async def create_genre(genre: schemas.GenreCreate, db_session: DbSession = Depends(get_session)):
     """
     Create a new genre.
     """
-    db_genre = models.Genre(
-        name=genre.name
-    )
-    db_session.add(db_genre)
-    db_session.commit()
-    db_session.refresh(db_genre)
-    return schemas.Genre.from_orm(db_genre)
+    return json_response(await run_db(db_session, crud.create_genre, genre))
+
+@app.put("/genres/{genre_id}", response_model=schemas.Genre)
+async def update_genre(
+    genre_id: int,
+    genre: schemas.GenreCreate,
+    db_session: DbSession = Depends(get_session)):
+    """
+    Rename a genre or move it, with its subgenres, under another parent.
+    """
+    return json_response(await run_db(db_session, crud.update_genre, genre_id, genre))
+
+@app.get("/genres/{genre_id}/descendants", response_model=List[schemas.GenreSummary])
+async def list_genre_descendants(
+    genre_id: int,
+    db_session: DbSession = Depends(get_read_session)):
+    """
+    List all descendants of a genre, in depth-first order.
+    """
+    return ORJSONResponse(await run_db(db_session, crud.list_genre_descendants, genre_id))
+
+@app.get("/genres/{genre_id}/ancestors", response_model=List[schemas.GenreSummary])
+async def list_genre_ancestors(
+    genre_id: int,
+    db_session: DbSession = Depends(get_read_session)):
+    """
+    List the ancestors of a genre, root first.
+    """
+    return ORJSONResponse(await run_db(db_session, crud.list_genre_ancestors, genre_id))
 
 @app.get("/authors/{author_id}", response_model=schemas.Author)
-def read_author(author_id: int, db_session: Session = Depends(get_db)):
+async def read_author(
+    author_id: int,
+    request: Request,
+    db_session: DbSession = Depends(get_read_session)):
     """
     Read details of a specific author.
     """
-    author = db_session.query(models.Author).filter(models.Author.id == author_id).first()
-    if author is None:
-        raise HTTPException(status_code=404, detail="Author not found")
-    return schemas.Author.from_orm(author)
+    catalog = snapshot.current()
+    if catalog is not None:
+        return await cached_json(
+            request, [cache.author_tag(author_id)], in_memory(catalog.read_author, author_id),
+            etag=in_memory(catalog.author_etag, author_id))
+    return await cached_json(
+        request, [cache.author_tag(author_id)],
+        lambda: run_db(db_session, crud.read_author, author_id),
+        etag=author_etag(db_session, author_id))
+
+@app.get("/genres", response_model=schemas.GenreBatch)
+async def read_genres(
+    request: Request,
+    ids: Optional[List[int]] = Depends(batch_ids),
+    db_session: DbSession = Depends(get_read_session)):
+    """
+    Read several genres at once with ``?ids=1,2,3``, in the requested order.
+
+    IDs of genres that do not exist are listed in ``missing``.
+    """
+    if ids is None:
+        return list_redirect(request)
+    return json_response(await run_db(db_session, crud.genres_json, ids))
 
 @app.get("/genres/{genre_id}", response_model=schemas.Genre)
-def read_genre(genre_id: int, db_session: Session = Depends(get_db)):
+async def read_genre(genre_id: int, db_session: DbSession = Depends(get_read_session)):
     """
     Read details of a specific genre.
     """
-    genre = db_session.query(models.Genre).filter(models.Genre.id == genre_id).first()
-    if genre is None:
-        raise HTTPException(status_code=404, detail="Genre not found")
-    return schemas.Genre.from_orm(genre)
+    return json_response(await run_db(db_session, crud.genre_json, genre_id))
 
 @app.put("/books/{book_id}", response_model=schemas.Book)
-def update_book(book_id: int, book: schemas.BookCreate, db_session: Session = Depends(get_db)):
+async def update_book(
+    book_id: int,
+    book: schemas.BookCreate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    db_session: DbSession = Depends(get_session)):
     """
     Update an existing book.
-    """
-    db_book = db_session.query(models.Book).filter(models.Book.id == book_id).first()
-    if db_book is None:
-        raise HTTPException(status_code=404, detail="Book not found")
 
-    db_book.title = book.title
-    db_book.publication_date = book.publication_date
-
-    db_book.authors = []
-    for author_id in book.author_ids:
-        author = db_session.query(models.Author).filter(models.Author.id == author_id).first()
-        if author:
-            db_book.authors.append(author)
+    With ``If-Match`` the update only applies to the given version of the book.
+    """
+    expected_version = versioning.expected_version(if_match, "book", book_id)
+    result, version = await run_db(
+        db_session, crud.update_book, book_id, book, expected_version)
+    response.headers["ETag"] = versioning.strong_etag("book", book_id, version)
+    return result
 
-    db_book.genres = []
-    for genre_id in book.genre_ids:
-        genre = db_session.query(models.Genre).filter(models.Genre.id == genre_id).first()
-        if genre:
-            db_book.genres.append(genre)
+@app.patch("/books/{book_id}", response_model=schemas.Book)
+async def patch_book(
+    book_id: int,
+    book: schemas.BookUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    db_session: DbSession = Depends(get_session)):
+    """
+    Partially update a book: fields and associations left out are not changed.
 
-    db_session.commit()
-    db_session.refresh(db_book)
-    return schemas.Book.from_orm(db_book)
+    With ``If-Match`` the update only applies to the given version of the book.
+    """
+    expected_version = versioning.expected_version(if_match, "book", book_id)
+    result, version = await run_db(
+        db_session, crud.update_book, book_id, book, expected_version)
+    response.headers["ETag"] = versioning.strong_etag("book", book_id, version)
+    return result
 
 @app.delete("/books/{book_id}", response_model=None, status_code=204)
-def delete_book(book_id: int, db_session: Session = Depends(get_db)):
+async def delete_book(book_id: int, db_session: DbSession = Depends(get_session)):
     """
     Delete a book.
     """
-    db_book = db_session.query(models.Book).filter(models.Book.id == book_id).first()
-    if db_book is None:
-        raise HTTPException(status_code=404, detail="Book not found")
+    await run_db(db_session, crud.delete_book, book_id)
 
-    db_session.delete(db_book)
-    db_session.commit()
+@app.delete("/books", response_model=schemas.BulkDeleteResponse)
+async def delete_books(
+    selection: Optional[schemas.IdSelection] = Body(None),
+    filters: BookFilters = Depends(book_filters),
+    db_session: DbSession = Depends(get_session)):
+    """
+    Delete many books in one transaction: those listed in the body as
+    ``{"ids": [...]}``, or those matching the ``GET /books/`` filters given
+    as query parameters, e.g. ``?published_to=1950-12-31``.
+    """
+    if (selection is None) == (not filters.active):
+        raise HTTPException(status_code=400, detail="Select books either by ids or by filters")
+    return await run_db(
+        db_session, crud.delete_books, selection.ids if selection else None, filters)
 
 @app.get("/authors/{author_id}/books", response_model=List[schemas.Book])
-def list_books_by_author(author_id: int, db_session: Session = Depends(get_db)):
-    """
-    List all books by a specific author.
-    """
-    author = db_session.query(models.Author).filter(models.Author.id == author_id).first()
-    if author is None:
-        raise HTTPException(status_code=404, detail="Author not found")
-    return [schemas.Book.from_orm(book) for book in author.books]
+async def list_books_by_author(
+    author_id: int,
+    request: Request,
+    page: PageParams = Depends(page_params),
+    view: BookView = Depends(book_view),
+    db_session: DbSession = Depends(get_read_session)):
+    """
+    List books by a specific author, one page at a time.
+    """
+    tags = view_tags(
+        view, [cache.author_books_tag(author_id), cache.author_tag(author_id), cache.BOOK_LISTS])
+    catalog = snapshot.current()
+    if catalog is not None:
+        return await cached_json(
+            request, tags, in_memory(catalog.list_books_by_author, author_id, page, view),
+            paginated=True,
+            etag=in_memory(
+                catalog.list_etag, view_tables(view, versioning.BOOKS, versioning.AUTHORS)))
+    return await cached_json(
+        request, tags,
+        lambda: run_db(db_session, crud.list_books_by_author, author_id, page, view),
+        paginated=True,
+        etag=view_etag(db_session, view, versioning.BOOKS, versioning.AUTHORS))
 
 @app.get("/genres/{genre_id}/books", response_model=List[schemas.Book])
-def list_books_by_genre(genre_id: int, db_session: Session = Depends(get_db)):
-    """
-    List all books in a specific genre.
-    """
-    genre = db_session.query(models.Genre).filter(models.Genre.id == genre_id).first()
-    if genre is None:
-        raise HTTPException(status_code=404, detail="Genre not found")
-    return [schemas.Book.from_orm(book) for book in genre.books]
+async def list_books_by_genre(  # pylint: disable=too-many-arguments
+    genre_id: int,
+    request: Request,
+    page: PageParams = Depends(page_params),
+    include_descendants: bool = False,
+    view: BookView = Depends(book_view),
+    db_session: DbSession = Depends(get_read_session)):
+    """
+    List books in a specific genre, one page at a time.
+
+    With ``include_descendants`` the books of every subgenre are listed too.
+    """
+    tag = cache.GENRE_SUBTREE_BOOKS if include_descendants else cache.genre_books_tag(genre_id)
+    tags = view_tags(view, [tag, cache.BOOK_LISTS])
+    catalog = snapshot.current()
+    if catalog is not None and not include_descendants:
+        return await cached_json(
+            request, tags, in_memory(catalog.list_books_by_genre, genre_id, page, view),
+            paginated=True,
+            etag=in_memory(
+                catalog.list_etag, view_tables(view, versioning.BOOKS, versioning.GENRES)))
+    return await cached_json(
+        request, tags,
+        lambda: run_db(
+            db_session, crud.list_books_by_genre, genre_id, page, include_descendants, view),
+        paginated=True,
+        etag=view_etag(db_session, view, versioning.BOOKS, versioning.GENRES))
+
+@app.get("/books/{book_id}/related", response_model=List[schemas.Book])
+async def list_related_books(
+    book_id: int,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1),
+    view: BookView = Depends(book_view),
+    db_session: DbSession = Depends(get_read_session)):
+    """
+    List the books sharing the most authors and genres with a book, best first.
+
+    Shared genres weigh more the deeper they are in the hierarchy. At most
+    ``settings.RELATED_BOOKS_LIMIT`` books are kept per book.
+    """
+    limit = min(limit or settings.RELATED_BOOKS_LIMIT, settings.RELATED_BOOKS_LIMIT)
+    return await cached_json(
+        request, view_tags(view, [cache.RELATED, cache.BOOK_LISTS]),
+        lambda: run_db(db_session, crud.list_related_books, book_id, limit, view),
+        etag=view_etag(db_session, view, versioning.BOOKS, versioning.GENRES))
 
 @app.put("/authors/{author_id}", response_model=schemas.Author)
-def update_author(
+async def update_author(
     author_id: int,
     author: schemas.AuthorCreate,
-    db_session: Session = Depends(get_db)):
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    db_session: DbSession = Depends(get_session)):
     """
     Update an existing author.
-    """
-    db_author = db_session.query(models.Author).filter(models.Author.id == author_id).first()
-    if db_author is None:
-        raise HTTPException(status_code=404, detail="Author not found")
-    db_author.full_name = author.full_name
-    db_author.birth_date = author.birth_date
 
-    db_session.commit()
-    db_session.refresh(db_author)
-    return schemas.Author.from_orm(db_author)
+    With ``If-Match`` the update only applies to the given version of the author.
+    """
+    expected_version = versioning.expected_version(if_match, "author", author_id)
+    result, version = await run_db(
+        db_session, crud.update_author, author_id, author, expected_version)
+    response.headers["ETag"] = versioning.strong_etag("author", author_id, version)
+    return result
 
 @app.delete("/authors/{author_id}", response_model=None, status_code=204)
-def delete_author(author_id: int, db_session: Session = Depends(get_db)):
+async def delete_author(author_id: int, db_session: DbSession = Depends(get_session)):
     """
     Delete an author.
     """
-    db_author = db_session.query(models.Author).filter(models.Author.id == author_id).first()
-    if db_author is None:
-        raise HTTPException(status_code=404, detail="Author not found")
+    await run_db(db_session, crud.delete_author, author_id)
+
+@app.delete("/authors", response_model=schemas.BulkAuthorDeleteResponse)
+async def delete_authors(
+    selection: Optional[schemas.IdSelection] = Body(None),
+    orphaned: bool = False,
+    db_session: DbSession = Depends(get_session)):
+    """
+    Delete many authors in one transaction: those listed in the body as
+    ``{"ids": [...]}``, or with ``?orphaned=true`` every author without books.
+    """
+    if (selection is None) == (not orphaned):
+        raise HTTPException(status_code=400, detail="Select authors either by ids or with orphaned")
+    return await run_db(
+        db_session, crud.delete_authors, selection.ids if selection else None, orphaned)
+
+@app.get("/changes", response_model=List[schemas.Change])
+async def list_changes(
+    request: Request,
+    since: int = Query(0, ge=0),
+    limit: int = Depends(page_size),
+    db_session: DbSession = Depends(get_read_session)):
+    """
+    List the changes made after the ``since`` token, oldest first.
+
+    Resume from the token of the last change received; old entries are
+    compacted to the latest change of each entity.
+    """
+    items, next_since = await run_db(db_session, changes.read_changes, since, limit)
+    response = ORJSONResponse(content=items)
+    set_next_page(
+        request, response, None if next_since is None else str(next_since), param="since")
+    return response
+
+def job_accepted(job: dict) -> Response:
+    """
+    202 response for a queued job, pointing at its status.
+    """
+    return ORJSONResponse(job, status_code=202, headers={"Location": f"/jobs/{job['id']}"})
+
+@app.post("/jobs/import-books", response_model=schemas.Job, status_code=202)
+async def import_books_job(
+    entries: List[Union[schemas.BookCreate, List[Any]]] = Depends(bulk_payload),
+    db_session: DbSession = Depends(get_session)):
+    """
+    Import books from a JSON array or an NDJSON stream in the background.
+
+    Entries are validated up front as by ``POST /books/bulk``; the errors of
+    the rejected ones are reported by ``GET /jobs/{job_id}``.
+    """
+    payload = [
+        entry.model_dump(mode="json") if isinstance(entry, schemas.BookCreate) else entry
+        for entry in entries
+    ]
+    return job_accepted(await run_db(
+        db_session, jobs.enqueue, jobs.IMPORT_BOOKS, payload, len(payload)))
+
+@app.post("/jobs/rebuild/{index}", response_model=schemas.Job, status_code=202)
+async def rebuild_index_job(
+    index: Literal["related", "search"],
+    db_session: DbSession = Depends(get_session)):
+    """
+    Rebuild the related books or the search index in the background.
+    """
+    kind = jobs.REBUILD_RELATED if index == "related" else jobs.REBUILD_SEARCH
+    return job_accepted(await run_db(db_session, jobs.enqueue, kind))
+
+@app.get("/jobs/{job_id}", response_model=schemas.Job)
+async def read_job(job_id: int, db_session: DbSession = Depends(get_session)):
+    """
+    Status, progress, throughput and errors of a background job.
+    """
+    # Read from the primary, which job workers write to outside of any request.
+    return ORJSONResponse(await run_db(db_session, jobs.read_job, job_id))
 
-    db_session.delete(db_author)
-    db_session.commit()
+@app.get("/export/{name}", response_class=StreamingResponse)
+def export_catalog(
+    name: Literal["books", "authors", "genres"],
+    fmt: Literal["ndjson", "csv"] = Query(export.NDJSON, alias="format")):
+    """
+    Stream every book, author or genre as NDJSON or CSV.
+    """
+    return StreamingResponse(
+        export.stream(name, fmt),
+        media_type=export.MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'})
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def read_metrics():
+    """
+    Request, SQL and connection pool metrics in Prometheus text format.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/admission/stats")
+async def read_admission_stats():
+    """
+    Limits, in-flight and queued requests, and admitted and shed counts of
+    every admission gate.
+    """
+    return admission.stats()
+
+@app.get("/cache/stats")
+async def read_cache_stats():
+    """
+    Hit, miss and eviction counters of the response cache.
+    """
+    return cache.response_cache.stats()
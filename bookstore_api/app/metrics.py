@@ -0,0 +1,302 @@
+"""
+Request and database instrumentation exposed in Prometheus text format.
+
+``MetricsMiddleware`` times every HTTP request and labels it with its route
+template (``/books/{book_id}``, not the raw path), so the number of series
+stays bounded. SQL statements are counted and timed through cursor events
+on every engine (see ``instrument_engine``) and attributed to the request
+they run in through a context variable, which follows the request into the
+threadpool and into ``AsyncSession.run_sync``. Statements slower than
+``settings.SLOW_QUERY_THRESHOLD`` are logged.
+"""
+import bisect
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.config import settings
+
+slow_query_logger = logging.getLogger("app.slow_queries")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+Labels = Tuple[str, ...]
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Labels) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+def _format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+class Counter:
+    """
+    Monotonic counter with labels. Not thread-safe on its own; see ``_lock``.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, labels: Labels = (), amount: float = 1.0):
+        """Add ``amount`` to the series of ``labels``."""
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def render(self) -> Iterable[str]:
+        """Lines of the text exposition format."""
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_number(value)}"
+
+class Gauge:
+    """
+    Value that goes up and down, with labels. Not thread-safe on its own; see ``_lock``.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Labels, float] = {}
+
+    def set(self, value: float, labels: Labels = ()):
+        """Set the series of ``labels`` to ``value``."""
+        self.values[labels] = value
+
+    def render(self) -> Iterable[str]:
+        """Lines of the text exposition format."""
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_number(value)}"
+
+class Histogram:
+    """
+    Histogram with fixed buckets and labels. Not thread-safe on its own; see ``_lock``.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Per series: count per bucket (the last one being +Inf), sum.
+        self.series: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        """Record ``value`` in the series of ``labels``."""
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = series
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def render(self) -> Iterable[str]:
+        """Lines of the text exposition format."""
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_number(bound)
+                bucket_labels = _format_labels((*self.labelnames, "le"), (*labels, le))
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            series_labels = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{series_labels} {_format_number(total[0])}"
+            yield f"{self.name}_count{series_labels} {cumulative}"
+
+_lock = threading.Lock()
+
+REQUESTS = Counter(
+    "bookstore_http_requests_total", "HTTP requests by route and status code.",
+    ("method", "route", "status"))
+REQUEST_DURATION = Histogram(
+    "bookstore_http_request_duration_seconds", "HTTP request latency by route.",
+    ("method", "route"))
+RESPONSE_SIZE = Histogram(
+    "bookstore_http_response_size_bytes", "HTTP response body size by route.",
+    ("method", "route"), SIZE_BUCKETS)
+DB_STATEMENTS = Counter(
+    "bookstore_db_statements_total", "SQL statements executed by route.",
+    ("method", "route"))
+DB_DURATION = Counter(
+    "bookstore_db_statement_duration_seconds_total", "Time spent in SQL statements by route.",
+    ("method", "route"))
+SLOW_QUERIES = Counter(
+    "bookstore_db_slow_queries_total", "SQL statements slower than SLOW_QUERY_THRESHOLD.",
+    ("route",))
+POOL_CHECKOUT = Histogram(
+    "bookstore_db_pool_checkout_duration_seconds",
+    "Time spent waiting for a connection from the pool.")
+
+ADMISSION_IN_FLIGHT = Gauge(
+    "bookstore_admission_in_flight", "Requests being served by priority class.", ("class",))
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "bookstore_admission_queue_depth", "Requests waiting for admission by priority class.",
+    ("class",))
+ADMISSION_SHED = Counter(
+    "bookstore_admission_shed_total",
+    "Requests rejected with 503 by priority class, because the queue was full "
+    "or the wait timed out.",
+    ("class", "reason"))
+
+SNAPSHOT_BYTES = Gauge(
+    "bookstore_snapshot_bytes", "Approximate memory held by the in-memory catalog snapshot.")
+SNAPSHOT_LOADED = Gauge(
+    "bookstore_snapshot_loaded_timestamp_seconds", "Unix time the catalog snapshot was loaded at.")
+
+METRICS = (REQUESTS, REQUEST_DURATION, RESPONSE_SIZE, DB_STATEMENTS, DB_DURATION,
+           SLOW_QUERIES, POOL_CHECKOUT, ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, ADMISSION_SHED,
+           SNAPSHOT_BYTES, SNAPSHOT_LOADED)
+
+def route_template(scope) -> str:
+    """
+    Path template of the route that matched a request, once routing has happened.
+    """
+    route = scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+class RequestStats:  # pylint: disable=too-few-public-methods
+    """
+    Database activity of the request being served.
+    """
+    __slots__ = ("scope", "statements", "db_time")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.statements = 0
+        self.db_time = 0.0
+
+_current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+def observe_admission(
+    priority: str,
+    in_flight: int,
+    queued: int,
+    shed_reason: Optional[str] = None):
+    """
+    Record the state of an admission gate, and a request it shed if any.
+    """
+    with _lock:
+        ADMISSION_IN_FLIGHT.set(in_flight, (priority,))
+        ADMISSION_QUEUE_DEPTH.set(queued, (priority,))
+        if shed_reason is not None:
+            ADMISSION_SHED.inc((priority, shed_reason))
+
+def observe_snapshot(nbytes: int, loaded_at: float):
+    """
+    Record a newly loaded catalog snapshot.
+    """
+    with _lock:
+        SNAPSHOT_BYTES.set(nbytes)
+        SNAPSHOT_LOADED.set(loaded_at)
+
+def observe_pool_checkout(duration: float):
+    """
+    Record the time spent getting a connection from a pool.
+    """
+    with _lock:
+        POOL_CHECKOUT.observe(duration)
+
+def _before_cursor_execute(conn, _cursor, _statement, _parameters, _context, _executemany):
+    conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, _cursor, statement, _parameters, _context, _executemany):
+    duration = time.perf_counter() - conn.info["statement_started"].pop()
+    stats = _current_request.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_time += duration
+    threshold = settings.SLOW_QUERY_THRESHOLD
+    if threshold is not None and duration >= threshold:
+        route = route_template(stats.scope) if stats is not None else "none"
+        with _lock:
+            SLOW_QUERIES.inc((route,))
+        slow_query_logger.warning(
+            "Slow query (%.1f ms) on %s: %s", duration * 1000, route, " ".join(statement.split()))
+
+def instrument_engine(sync_engine: Engine):
+    """
+    Count and time the statements ``sync_engine`` executes.
+    """
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+class MetricsMiddleware:  # pylint: disable=too-few-public-methods
+    """
+    ASGI middleware recording the metrics of every HTTP request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope)
+        token = _current_request.set(stats)
+        status = 500
+        size = 0
+
+        async def send_with_metrics(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            duration = time.perf_counter() - started
+            _current_request.reset(token)
+            labels = (scope["method"], route_template(scope))
+            with _lock:
+                REQUESTS.inc((*labels, str(status)))
+                REQUEST_DURATION.observe(duration, labels)
+                RESPONSE_SIZE.observe(size, labels)
+                DB_STATEMENTS.inc(labels, stats.statements)
+                DB_DURATION.inc(labels, stats.db_time)
+
+def render() -> str:
+    """
+    Every metric in the Prometheus text exposition format.
+    """
+    with _lock:
+        lines = [line for metric in METRICS for line in metric.render()]
+    return "\n".join(lines) + "\n"
+
+def reset():
+    """
+    Clear every metric.
+    """
+    with _lock:
+        for metric in METRICS:
+            if isinstance(metric, (Counter, Gauge)):
+                metric.values.clear()
+            else:
+                metric.series.clear()
@@ -3,7 +3,8 @@
 """
 Models for the bookstore application.
 """
-from sqlalchemy import Column, Integer, String, Date, Table, ForeignKey
+from sqlalchemy import (
+    Column, Integer, Float, String, Text, Date, DateTime, Table, ForeignKey, Index)
 from sqlalchemy.orm import relationship, backref
 from app.database import Base
 
@@ -11,13 +12,16 @@ from app.database import Base
 book_authors = Table(
     'book_authors', Base.metadata,
     Column('book_id', Integer, ForeignKey('books.id'), primary_key=True),
-    Column('author_id', Integer, ForeignKey('authors.id'), primary_key=True)
+    Column('author_id', Integer, ForeignKey('authors.id'), primary_key=True),
+    # The primary key only serves lookups by book; this one serves lookups by author.
+    Index('ix_book_authors_author_id_book_id', 'author_id', 'book_id')
 )
 
 book_genres = Table(
     'book_genres', Base.metadata,
     Column('book_id', Integer, ForeignKey('books.id'), primary_key=True),
-    Column('genre_id', Integer, ForeignKey('genres.id'), primary_key=True)
+    Column('genre_id', Integer, ForeignKey('genres.id'), primary_key=True),
+    Index('ix_book_genres_genre_id_book_id', 'genre_id', 'book_id')
 )
 
 class Book(Base):
@@ -27,9 +31,13 @@ class Book(Base):
     __tablename__ = 'books'
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String, index=True)
-    publication_date = Column(Date)
+    publication_date = Column(Date, index=True)
+    # Row version behind the book's ETag; see app.versioning
+    version = Column(Integer, nullable=False, default=1)
     authors = relationship('Author', secondary=book_authors, back_populates='books')
     genres = relationship('Genre', secondary=book_genres, back_populates='books')
+    # Versions are bumped explicitly by app.crud; the ORM only checks them on UPDATE.
+    __mapper_args__ = {'version_id_col': version, 'version_id_generator': False}
 
 class Author(Base):
     """
@@ -39,7 +47,9 @@ class Author(Base):
     id = Column(Integer, primary_key=True, index=True)
     full_name = Column(String, index=True)
     birth_date = Column(Date)
+    version = Column(Integer, nullable=False, default=1)
     books = relationship('Book', secondary=book_authors, back_populates='authors')
+    __mapper_args__ = {'version_id_col': version, 'version_id_generator': False}
 
 class Genre(Base):
     """
@@ -49,8 +59,90 @@ class Genre(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
     parent_id = Column(Integer, ForeignKey('genres.id'), nullable=True)
+    # Materialized path of ancestor IDs, e.g. '/1/3/'; see app.hierarchy
+    path = Column(String, nullable=False, default='/', index=True)
     parent = relationship(
         'Genre',
         remote_side=[id],
         backref=backref('subgenres', remote_side=[parent_id]))
     books = relationship("Book", secondary=book_genres, back_populates="genres")
+
+class RelatedBook(Base):
+    """
+    Entry of the precomputed related books of a book; see app.related.
+    """
+    __tablename__ = 'related_books'
+    book_id = Column(Integer, ForeignKey('books.id'), primary_key=True)
+    related_id = Column(Integer, ForeignKey('books.id'), primary_key=True)
+    score = Column(Float, nullable=False)
+    __table_args__ = (
+        # Serves the ranked list of a book; the primary key does not.
+        Index('ix_related_books_ranking', book_id, score.desc(), related_id),
+        # Serves removing a book from the lists of others.
+        Index('ix_related_books_related_id', related_id),
+    )
+
+class StaleRelatedBook(Base):
+    """
+    Book whose related books are due to be refreshed; see app.related.
+    """
+    __tablename__ = 'stale_related_books'
+    book_id = Column(Integer, primary_key=True)
+
+class AppState(Base):
+    """
+    Key/value store for application bookkeeping such as the seed version.
+    """
+    __tablename__ = 'app_state'
+    key = Column(String, primary_key=True)
+    value = Column(String, nullable=False)
+
+class ChangeCounter(Base):
+    """
+    Per-table counter bumped by every write, behind the list ETags.
+    """
+    __tablename__ = 'change_counters'
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+class Change(Base):
+    """
+    Entry of the append-only change log; its ID is the feed token. See app.changes.
+    """
+    __tablename__ = 'changes'
+    id = Column(Integer, primary_key=True)
+    entity = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    action = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, index=True)
+    __table_args__ = (
+        Index('ix_changes_entity', 'entity', 'entity_id', 'id'),
+        # Tokens must never be reused once compaction deletes rows.
+        {'sqlite_autoincrement': True},
+    )
+
+class Job(Base):
+    """
+    Background job with its progress and checkpoint; see app.jobs.
+    """
+    __tablename__ = 'jobs'
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    status = Column(String, nullable=False, index=True)
+    # Input of the job as JSON, e.g. the entries of an import.
+    payload = Column(Text, nullable=True)
+    # Position to resume from as JSON, committed with the chunk it follows.
+    checkpoint = Column(Text, nullable=True)
+    # Bumped by every committed chunk, so that only one runner advances a job.
+    revision = Column(Integer, nullable=False, default=0)
+    total = Column(Integer, nullable=True)
+    processed = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    # Seconds spent processing chunks, for the throughput.
+    elapsed = Column(Float, nullable=False, default=0.0)
+    # JSON list of the first entry errors; error is why the job failed.
+    errors = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
@@ -0,0 +1,162 @@
+"""
+Keyset (cursor) pagination helpers for the bookstore application.
+
+Cursors are opaque to clients: they are URL-safe base64 encoded JSON arrays
+holding the sort key of the last row on the previous page. Pages are read
+with ``WHERE key > :last ORDER BY key LIMIT :limit + 1`` so every page costs
+one index range scan no matter how deep the client has paged.
+"""
+import base64
+import binascii
+import json
+from dataclasses import dataclass
+from datetime import date
+from typing import Any, List, Optional, Tuple
+
+from fastapi import Depends, HTTPException, Query, Request, Response
+
+from sqlalchemy import Select, tuple_
+from sqlalchemy.orm import Session
+
+from app.config import settings
+
+def encode_cursor(*values: Any) -> str:
+    """
+    Encode the sort key of the last returned row into an opaque cursor.
+    """
+    raw = json.dumps(list(values), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[Any, ...]:
+    """
+    Decode a cursor produced by ``encode_cursor``.
+
+    Raises a 400 error when the cursor is malformed.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, ValueError) as exc:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from exc
+    if not isinstance(values, list) or not values:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return tuple(values)
+
+@dataclass(frozen=True)
+class PageParams:
+    """
+    Requested page: the page size and the decoded position to resume after.
+    """
+    limit: int
+    after: Optional[Tuple[Any, ...]] = None
+
+    @property
+    def after_id(self) -> Optional[int]:
+        """
+        The ID to resume after for pages keyed on ``id`` alone.
+        """
+        if self.after is None:
+            return None
+        if len(self.after) != 1 or not isinstance(self.after[0], int):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        return self.after[0]
+
+def page_size(limit: Optional[int] = Query(None, ge=1)) -> int:
+    """
+    Dependency parsing the ``limit`` query parameter, clamped to ``settings.MAX_PAGE_SIZE``.
+    """
+    if limit is None:
+        limit = settings.DEFAULT_PAGE_SIZE
+    return min(limit, settings.MAX_PAGE_SIZE)
+
+def page_params(
+    limit: int = Depends(page_size),
+    cursor: Optional[str] = Query(None)) -> PageParams:
+    """
+    Dependency parsing the ``limit`` and ``cursor`` query parameters.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    return PageParams(limit=limit, after=after)
+
+def paginate_by_id(
+    db_session: Session,
+    statement: Select,
+    id_column,
+    page: PageParams,
+    descending: bool = False) -> Tuple[List[Any], Optional[str]]:
+    """
+    Apply keyset pagination on ``id_column`` to a ``select()`` and execute it.
+
+    Returns the rows of the page and the cursor of the next page, or None
+    when this is the last page. ``statement`` must select ``id_column``.
+    """
+    after_id = page.after_id
+    if after_id is not None:
+        statement = statement.where(id_column < after_id if descending else id_column > after_id)
+    order = id_column.desc() if descending else id_column
+    rows = db_session.execute(statement.order_by(order).limit(page.limit + 1)).all()
+    if len(rows) <= page.limit:
+        return rows, None
+    rows = rows[:page.limit]
+    return rows, encode_cursor(rows[-1].id)
+
+def _cursor_value(column, value: Any) -> Any:
+    # Cursors hold JSON values; dates travel as ISO strings.
+    if value is None:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if column.type.python_type is date:
+        if not isinstance(value, str):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        try:
+            return date.fromisoformat(value)
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail="Invalid cursor") from exc
+    if not isinstance(value, column.type.python_type):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value
+
+def paginate_by_key(
+    db_session: Session,
+    statement: Select,
+    key_columns: Tuple[Any, Any],
+    page: PageParams,
+    descending: bool = False) -> Tuple[List[Any], Optional[str]]:
+    """
+    Apply keyset pagination on ``key_columns``, a ``(key_column, id_column)``
+    pair, to a ``select()`` and execute it.
+
+    Like ``paginate_by_id``, for lists sorted on a non-unique column with the
+    ID as tie-breaker. ``statement`` must select both columns.
+    """
+    key_column, id_column = key_columns
+    if page.after is not None:
+        if len(page.after) != 2 or not isinstance(page.after[1], int):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        after = tuple_(_cursor_value(key_column, page.after[0]), page.after[1])
+        position = tuple_(key_column, id_column)
+        statement = statement.where(position < after if descending else position > after)
+    order = (key_column.desc(), id_column.desc()) if descending else (key_column, id_column)
+    rows = db_session.execute(statement.order_by(*order).limit(page.limit + 1)).all()
+    if len(rows) <= page.limit:
+        return rows, None
+    rows = rows[:page.limit]
+    last_key = getattr(rows[-1], key_column.key)
+    if isinstance(last_key, date):
+        last_key = last_key.isoformat()
+    return rows, encode_cursor(last_key, rows[-1].id)
+
+def set_next_page(
+    request: Request,
+    response: Response,
+    next_cursor: Optional[str],
+    param: str = "cursor"):
+    """
+    Advertise the next page through the ``Link`` and ``X-Next-Cursor`` headers.
+
+    ``param`` is the query parameter the next page URL passes the cursor in.
+    """
+    if next_cursor is None:
+        return
+    next_url = request.url.include_query_params(**{param: next_cursor})
+    response.headers["Link"] = f'<{next_url}>; rel="next"'
+    response.headers["X-Next-Cursor"] = next_cursor
@@ -0,0 +1,237 @@
+"""
+Precomputed index of related books.
+
+Two books are related when they share authors or genres. Every shared
+author scores ``settings.RELATED_AUTHOR_WEIGHT`` and every shared genre its
+depth in the hierarchy (1 for top-level genres), so a shared subgenre counts
+for more than a shared broad genre. The ``related_books`` table keeps the
+``settings.RELATED_BOOKS_LIMIT`` best-scoring books of every book, so the
+related books of one book are a single index range scan.
+
+Scores are computed in SQL with set operations: self-joins of the
+association tables on their ``(author_id, book_id)`` / ``(genre_id,
+book_id)`` indexes, grouped by book pair and ranked with a window function.
+No pair is ever built in Python.
+
+An author or genre with more than ``settings.RELATED_MAX_GROUP_SIZE`` books
+is ignored: it says little about any two of its books, and would make every
+one of them a candidate for all the others, so the cost of scoring a book
+would grow with the catalog.
+
+Writes changing the associations of books never score them: scoring holds
+the write lock for far longer than the write itself. They call
+``mark_stale()``, which records the books in the ``stale_related_books``
+table and queues a ``refresh_related`` job of ``app.jobs``; related books
+lag the write until the job has run. The job calls ``refresh()`` on chunks
+of stale books: it recomputes their lists, and inserts them into the lists
+of the books they share something with, trimming those back to the limit.
+A book that stops being related to another only leaves the other book's
+list, which may then hold fewer books than the limit until ``rebuild()``
+recomputes every list.
+"""
+from datetime import datetime
+from typing import List, Optional, Union
+
+from sqlalchemy import (
+    Float, Select, delete, func, insert, literal, or_, select, tuple_, union_all)
+from sqlalchemy.orm import Session
+
+from app import models
+from app.config import settings
+
+# Books refreshed per statement; their IDs are bound up to three times.
+CHUNK_SIZE = 10000
+
+COLUMNS = ("book_id", "related_id", "score")
+
+# Kinds of the app.jobs jobs rebuilding the index, and refreshing the books
+# marked stale.
+REBUILD_JOB = "rebuild_related"
+REFRESH_JOB = "refresh_related"
+
+def _crowded(association, group_id):
+    """
+    Whether the author or genre ``group_id`` of an association table has
+    more than ``settings.RELATED_MAX_GROUP_SIZE`` books. Reads at most that
+    many index entries.
+    """
+    members = association.alias()
+    column = members.c[group_id.key]
+    return select(members.c.book_id).where(column == group_id).offset(
+        settings.RELATED_MAX_GROUP_SIZE).limit(1).exists()
+
+def _pair_scores(book_ids: List[int]):
+    """
+    Subquery of ``(book_id, related_id, score)`` for every book related to
+    one of ``book_ids``.
+    """
+    left, right = models.book_authors.alias(), models.book_authors.alias()
+    author_pairs = select(
+        left.c.book_id,
+        right.c.book_id.label("related_id"),
+        literal(settings.RELATED_AUTHOR_WEIGHT, Float).label("weight"),
+    ).select_from(
+        left.join(right, right.c.author_id == left.c.author_id)
+    ).where(
+        left.c.book_id.in_(book_ids), right.c.book_id != left.c.book_id,
+        ~_crowded(models.book_authors, left.c.author_id))
+
+    genre = models.Genre
+    # Depth from the materialized path, as in hierarchy.depth().
+    depth = func.length(genre.path) - func.length(func.replace(genre.path, "/", ""))
+    left, right = models.book_genres.alias(), models.book_genres.alias()
+    genre_pairs = select(
+        left.c.book_id, right.c.book_id.label("related_id"), depth.label("weight"),
+    ).select_from(
+        left.join(right, right.c.genre_id == left.c.genre_id)
+        .join(genre, genre.id == left.c.genre_id)
+    ).where(
+        left.c.book_id.in_(book_ids), right.c.book_id != left.c.book_id,
+        ~_crowded(models.book_genres, left.c.genre_id))
+
+    pairs = union_all(author_pairs, genre_pairs).subquery()
+    return select(
+        pairs.c.book_id, pairs.c.related_id, func.sum(pairs.c.weight).label("score")
+    ).group_by(pairs.c.book_id, pairs.c.related_id).subquery()
+
+def _ranked(statement):
+    """
+    Subquery adding to ``(book_id, related_id, score)`` rows their rank in
+    the list of their book.
+    """
+    rows = statement.subquery()
+    rank = func.row_number().over(
+        partition_by=rows.c.book_id, order_by=(rows.c.score.desc(), rows.c.related_id))
+    return select(rows.c.book_id, rows.c.related_id, rows.c.score, rank.label("rank")).subquery()
+
+def _top(scores):
+    ranked = _ranked(select(scores))
+    return select(ranked.c.book_id, ranked.c.related_id, ranked.c.score).where(
+        ranked.c.rank <= settings.RELATED_BOOKS_LIMIT)
+
+def _recompute(db_session: Session, book_ids: List[int]):
+    related = models.RelatedBook
+    db_session.execute(delete(related).where(related.book_id.in_(book_ids)))
+    db_session.execute(insert(related).from_select(COLUMNS, _top(_pair_scores(book_ids))))
+
+def remove(db_session: Session, book_ids: List[int]):
+    """
+    Remove books from the index, along with their own lists. Does not commit.
+    """
+    related = models.RelatedBook
+    for start in range(0, len(book_ids), CHUNK_SIZE):
+        chunk = book_ids[start:start + CHUNK_SIZE]
+        db_session.execute(delete(related).where(
+            or_(related.book_id.in_(chunk), related.related_id.in_(chunk))))
+
+def refresh(db_session: Session, book_ids: List[int]):
+    """
+    Update the index after the associations of books changed or the books
+    were deleted. Does not commit.
+    """
+    related = models.RelatedBook
+    for start in range(0, len(book_ids), CHUNK_SIZE):
+        chunk = book_ids[start:start + CHUNK_SIZE]
+        remove(db_session, chunk)
+        scores = _pair_scores(chunk)
+        db_session.execute(insert(related).from_select(COLUMNS, _top(scores)))
+        # Scores are symmetric: enter the books into the lists of the others,
+        # at most as many per list as it keeps.
+        entering = _ranked(select(
+            scores.c.related_id.label("book_id"), scores.c.book_id.label("related_id"),
+            scores.c.score,
+        ).where(scores.c.related_id.not_in(chunk)))
+        db_session.execute(insert(related).from_select(COLUMNS, select(
+            entering.c.book_id, entering.c.related_id, entering.c.score
+        ).where(entering.c.rank <= settings.RELATED_BOOKS_LIMIT)))
+        neighbours = select(related.book_id).where(related.related_id.in_(chunk))
+        overflow = _ranked(select(related.book_id, related.related_id, related.score)
+                           .where(related.book_id.in_(neighbours)))
+        db_session.execute(delete(related).where(
+            tuple_(related.book_id, related.related_id).in_(
+                select(overflow.c.book_id, overflow.c.related_id)
+                .where(overflow.c.rank > settings.RELATED_BOOKS_LIMIT))))
+
+def _queue_job(db_session: Session, kind: str, total: Optional[int] = None):
+    # Left for app.jobs to pick up; it cannot be imported from here.
+    db_session.execute(insert(models.Job).values(
+        kind=kind, status="queued", total=total, created_at=datetime.utcnow()))
+
+def queue_rebuild(db_session: Session):
+    """
+    Queue a ``rebuild_related`` job if there are books. Does not commit.
+    """
+    total = db_session.scalar(
+        select(func.count()).select_from(models.Book))  # pylint: disable=not-callable
+    if total:
+        _queue_job(db_session, REBUILD_JOB, total)
+
+def mark_stale(db_session: Session, book_ids: Union[List[int], Select]):
+    """
+    Mark books for a refresh by the ``refresh_related`` job, queueing one
+    unless it is already queued. ``book_ids`` is a list of IDs or a select
+    of one column of IDs. Does not commit.
+    """
+    stale = models.StaleRelatedBook
+    if isinstance(book_ids, Select):
+        chunks = [book_ids]
+    else:
+        chunks = [
+            select(models.Book.id).where(models.Book.id.in_(book_ids[start:start + CHUNK_SIZE]))
+            for start in range(0, len(book_ids), CHUNK_SIZE)
+        ]
+    for chunk in chunks:
+        candidates = chunk.subquery()
+        db_session.execute(insert(stale).from_select(["book_id"], select(
+            candidates.c[0].distinct()
+        ).where(candidates.c[0].not_in(select(stale.book_id)))))
+    job = models.Job
+    queued = db_session.scalar(
+        select(job.id).where(job.kind == REFRESH_JOB, job.status == "queued").limit(1))
+    if queued is None:
+        _queue_job(db_session, REFRESH_JOB)
+
+def refresh_stale(db_session: Session, limit: int) -> List[int]:
+    """
+    Refresh at most ``limit`` of the books marked stale, and unmark them.
+    Does not commit.
+
+    Returns the IDs of the books refreshed.
+    """
+    stale = models.StaleRelatedBook
+    book_ids = db_session.scalars(
+        select(stale.book_id).order_by(stale.book_id).limit(limit)).all()
+    refresh(db_session, book_ids)
+    for start in range(0, len(book_ids), CHUNK_SIZE):
+        db_session.execute(delete(stale).where(
+            stale.book_id.in_(book_ids[start:start + CHUNK_SIZE])))
+    return book_ids
+
+def rebuild(
+    db_session: Session,
+    after_id: Optional[int] = None,
+    limit: Optional[int] = None) -> List[int]:
+    """
+    Recompute the lists of the books following ``after_id`` in ID order, or
+    of every book, at most ``limit`` of them. Does not commit.
+
+    Returns the IDs of the books recomputed.
+    """
+    statement = select(models.Book.id).order_by(models.Book.id)
+    if after_id is not None:
+        statement = statement.where(models.Book.id > after_id)
+    if limit is not None:
+        statement = statement.limit(limit)
+    book_ids = db_session.scalars(statement).all()
+    for start in range(0, len(book_ids), CHUNK_SIZE):
+        _recompute(db_session, book_ids[start:start + CHUNK_SIZE])
+    return book_ids
+
+def related_ids(db_session: Session, book_id: int, limit: int) -> List[int]:
+    """
+    IDs of the books most related to a book, best first.
+    """
+    related = models.RelatedBook
+    return db_session.scalars(
+        select(related.related_id).where(related.book_id == book_id)
+        .order_by(related.score.desc(), related.related_id).limit(limit)).all()
@@ -4,8 +4,8 @@
 Schemas for the bookstore application.
 """
 
-from datetime import date
-from typing import List, Optional
+from datetime import date, datetime
+from typing import Any, List, Optional
 from pydantic import BaseModel, ConfigDict
 
 class BookBase(BaseModel):
@@ -22,6 +22,15 @@ class BookCreate(BookBase):
     author_ids: List[int]
     genre_ids: List[int]
 
+class BookUpdate(BaseModel):
+    """
+    Schema for a partial book update: fields left out are not changed.
+    """
+    title: Optional[str] = None
+    publication_date: Optional[date] = None
+    author_ids: Optional[List[int]] = None
+    genre_ids: Optional[List[int]] = None
+
 class Book(BookBase):
     """
     Schema for a book, including its ID and relationships.
@@ -42,6 +51,49 @@ class Book(BookBase):
 
     model_config = ConfigDict(from_attributes=True)
 
+class BulkBookResult(BaseModel):
+    """
+    Outcome of a single entry of a bulk book import.
+    """
+    index: int
+    id: Optional[int] = None
+    errors: Optional[List[Any]] = None
+
+class BulkBookResponse(BaseModel):
+    """
+    Schema for the result of a bulk book import.
+    """
+    created: int
+    failed: int
+    results: List[BulkBookResult]
+
+class IdSelection(BaseModel):
+    """
+    Schema for the IDs selected by a bulk delete.
+    """
+    ids: List[int]
+
+class BulkDeleteResponse(BaseModel):
+    """
+    Schema for the result of a bulk delete.
+    """
+    deleted: int
+    links: int            # association rows deleted
+    missing: List[int]    # requested IDs that did not exist
+
+class BulkAuthorDeleteResponse(BulkDeleteResponse):
+    """
+    Schema for the result of a bulk delete of authors.
+    """
+    updated_books: int    # books that lost an author
+
+class BookBatch(BaseModel):
+    """
+    Schema for a multi-get of books: the books found, in request order, and the missing IDs.
+    """
+    items: List[Book]
+    missing: List[int]
+
 class AuthorBase(BaseModel):
     """
     Base schema for an author.
@@ -62,6 +114,13 @@ class Author(AuthorBase):
 
     model_config = ConfigDict(from_attributes=True)
 
+class AuthorBatch(BaseModel):
+    """
+    Schema for a multi-get of authors: the authors found, in request order, and the missing IDs.
+    """
+    items: List[Author]
+    missing: List[int]
+
 class GenreBase(BaseModel):
     """
     Base schema for a genre.
@@ -72,6 +131,16 @@ class GenreCreate(GenreBase):
     """
     Schema for creating a genre.
     """
+    parent_id: Optional[int] = None
+
+class GenreSummary(GenreBase):
+    """
+    Schema for a genre without its subgenres.
+    """
+    id: int
+    parent_id: Optional[int] = None
+
+    model_config = ConfigDict(from_attributes=True)
 
 class Genre(GenreBase):
     """
@@ -92,3 +161,38 @@ class Genre(GenreBase):
         """
         from_attributes = True
         arbitrary_types_allowed = True
+
+class Change(BaseModel):
+    """
+    Schema for an entry of the change feed.
+    """
+    token: int
+    entity: str
+    id: int
+    action: str
+    created_at: datetime
+
+class GenreBatch(BaseModel):
+    """
+    Schema for a multi-get of genres: the genres found, in request order, and the missing IDs.
+    """
+    items: List[Genre]
+    missing: List[int]
+
+class Job(BaseModel):
+    """
+    Schema for the status and progress of a background job.
+    """
+    id: int
+    kind: str
+    status: str
+    total: Optional[int] = None
+    processed: int
+    failed: int
+    # Items processed per second of work
+    throughput: Optional[float] = None
+    errors: List[Any]
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
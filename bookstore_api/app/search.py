@@ -0,0 +1,197 @@
+"""
+Full-text search over book titles and author names.
+
+Each book is indexed as one document made of its title and the names of
+its authors. The index lives in the same database and is updated in the
+same transaction as the writes that affect it (see ``app.crud``).
+
+Backends are picked by dialect: SQLite uses an FTS5 virtual table, PostgreSQL
+a ``tsvector`` column with a GIN index. Both tables are created and dropped
+alongside ``Base.metadata``.
+"""
+import re
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import DDL, bindparam, event, text
+from sqlalchemy.orm import Session
+
+from app.database import Base
+
+def search_terms(query: str) -> List[str]:
+    """
+    Split a user query into word tokens, dropping any search syntax.
+    """
+    return re.findall(r"\w+", query)
+
+class SearchBackend(ABC):
+    """
+    Interface of a full-text search backend.
+    """
+
+    @abstractmethod
+    def index_books(self, db_session: Session, book_ids: Iterable[int]):
+        """
+        (Re)index the given books from their current title and authors.
+        """
+
+    @abstractmethod
+    def remove_books(self, db_session: Session, book_ids: Iterable[int]):
+        """
+        Remove the given books from the index.
+        """
+
+    @abstractmethod
+    def search(
+        self,
+        db_session: Session,
+        terms: List[str],
+        limit: int,
+        offset: int) -> List[Tuple[int, float]]:
+        """
+        Return ``(book_id, score)`` pairs matching every term as a prefix, best first.
+        """
+
+    @abstractmethod
+    def rebuild(self, db_session: Session):
+        """
+        Reindex every book.
+        """
+
+class SQLiteSearchBackend(SearchBackend):
+    """
+    SQLite FTS5 backend; the document rowid is the book ID.
+    """
+    _documents = """
+        SELECT books.id, coalesce(books.title, ''),
+               coalesce(group_concat(authors.full_name, ' '), '')
+        FROM books
+        LEFT JOIN book_authors ON book_authors.book_id = books.id
+        LEFT JOIN authors ON authors.id = book_authors.author_id
+    """
+
+    def index_books(self, db_session, book_ids):
+        book_ids = list(book_ids)
+        if not book_ids:
+            return
+        self.remove_books(db_session, book_ids)
+        db_session.execute(
+            text(
+                "INSERT INTO book_search (rowid, title, authors) "
+                + self._documents
+                + " WHERE books.id IN :book_ids GROUP BY books.id"
+            ).bindparams(bindparam("book_ids", expanding=True)),
+            {"book_ids": book_ids})
+
+    def remove_books(self, db_session, book_ids):
+        book_ids = list(book_ids)
+        if not book_ids:
+            return
+        db_session.execute(
+            text("DELETE FROM book_search WHERE rowid IN :book_ids")
+            .bindparams(bindparam("book_ids", expanding=True)),
+            {"book_ids": book_ids})
+
+    def search(self, db_session, terms, limit, offset):
+        match = " ".join(f'"{term}"*' for term in terms)
+        # rank is bm25() with the column weights configured on the table.
+        rows = db_session.execute(
+            text(
+                "SELECT rowid, rank FROM book_search WHERE book_search MATCH :match "
+                "ORDER BY rank LIMIT :limit OFFSET :offset"),
+            {"match": match, "limit": limit, "offset": offset})
+        # bm25 scores are negative, lower being better.
+        return [(book_id, -score) for book_id, score in rows]
+
+    def rebuild(self, db_session):
+        db_session.execute(text("DELETE FROM book_search"))
+        db_session.execute(text(
+            "INSERT INTO book_search (rowid, title, authors) "
+            + self._documents + " GROUP BY books.id"))
+
+class PostgresSearchBackend(SearchBackend):
+    """
+    PostgreSQL backend storing a weighted ``tsvector`` per book.
+    """
+    _documents = """
+        SELECT books.id,
+               setweight(to_tsvector('simple', coalesce(books.title, '')), 'A')
+               || setweight(to_tsvector('simple',
+                    coalesce(string_agg(authors.full_name, ' '), '')), 'B')
+        FROM books
+        LEFT JOIN book_authors ON book_authors.book_id = books.id
+        LEFT JOIN authors ON authors.id = book_authors.author_id
+    """
+
+    def index_books(self, db_session, book_ids):
+        book_ids = list(book_ids)
+        if not book_ids:
+            return
+        self.remove_books(db_session, book_ids)
+        db_session.execute(
+            text(
+                "INSERT INTO book_search (book_id, document) "
+                + self._documents
+                + " WHERE books.id IN :book_ids GROUP BY books.id"
+            ).bindparams(bindparam("book_ids", expanding=True)),
+            {"book_ids": book_ids})
+
+    def remove_books(self, db_session, book_ids):
+        book_ids = list(book_ids)
+        if not book_ids:
+            return
+        db_session.execute(
+            text("DELETE FROM book_search WHERE book_id IN :book_ids")
+            .bindparams(bindparam("book_ids", expanding=True)),
+            {"book_ids": book_ids})
+
+    def search(self, db_session, terms, limit, offset):
+        query = " & ".join(f"{term}:*" for term in terms)
+        rows = db_session.execute(
+            text(
+                "SELECT book_id, ts_rank(document, query) AS score "
+                "FROM book_search, to_tsquery('simple', :query) AS query "
+                "WHERE document @@ query "
+                "ORDER BY score DESC, book_id LIMIT :limit OFFSET :offset"),
+            {"query": query, "limit": limit, "offset": offset})
+        return list(rows.tuples())
+
+    def rebuild(self, db_session):
+        db_session.execute(text("DELETE FROM book_search"))
+        db_session.execute(text(
+            "INSERT INTO book_search (book_id, document) "
+            + self._documents + " GROUP BY books.id"))
+
+BACKENDS: Dict[str, SearchBackend] = {
+    "sqlite": SQLiteSearchBackend(),
+    "postgresql": PostgresSearchBackend(),
+}
+
+def get_backend(db_session: Session) -> SearchBackend:
+    """
+    Search backend for the database ``db_session`` is bound to.
+    """
+    dialect = db_session.get_bind().dialect.name
+    try:
+        return BACKENDS[dialect]
+    except KeyError as exc:
+        raise RuntimeError(f"No search backend for the {dialect} dialect") from exc
+
+event.listen(Base.metadata, "after_create", DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS book_search USING fts5("
+    "title, authors, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+).execute_if(dialect="sqlite"))
+# Title matches weigh more than author name matches in the bm25 ranking.
+event.listen(Base.metadata, "after_create", DDL(
+    "INSERT INTO book_search (book_search, rank) VALUES ('rank', 'bm25(10.0, 1.0)')"
+).execute_if(dialect="sqlite"))
+event.listen(Base.metadata, "after_create", DDL(
+    "CREATE TABLE IF NOT EXISTS book_search ("
+    "book_id INTEGER PRIMARY KEY REFERENCES books (id), document tsvector NOT NULL)"
+).execute_if(dialect="postgresql"))
+event.listen(Base.metadata, "after_create", DDL(
+    "CREATE INDEX IF NOT EXISTS ix_book_search_document ON book_search USING gin (document)"
+).execute_if(dialect="postgresql"))
+event.listen(Base.metadata, "before_drop", DDL(
+    "DROP TABLE IF EXISTS book_search"
+).execute_if(dialect=("sqlite", "postgresql")))
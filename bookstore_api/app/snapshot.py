@@ -0,0 +1,380 @@
+"""
+Read-optimized in-memory snapshot of the catalog.
+
+With ``settings.SNAPSHOT_ENABLED`` the books, authors and both association
+tables are loaded into compact array-backed
+structures, and point reads and unfiltered ID-ordered lists are served from
+them without touching the database:
+
+- books and authors are parallel ``array('i')`` columns (IDs, versions,
+  dates as proleptic ordinals) plus a list of titles or names, sorted by ID
+  and looked up by bisection;
+- ``book_authors`` and ``book_genres`` are stored in both directions as CSR
+  adjacency lists: an offsets array indexed by position and a flat array of
+  referenced IDs, each slice sorted;
+- genres come from the genre tree of ``app.genre_cache``.
+
+A snapshot is immutable. ``refresh()`` builds a new one when the change
+counters moved and swaps it in with a single reference assignment, so
+readers never lock and never see a half-built snapshot. Refreshes run every
+``settings.SNAPSHOT_REFRESH_INTERVAL`` seconds; until then, reads served
+from the snapshot do not reflect newer writes.
+"""
+import bisect
+import time
+from array import array
+from datetime import date
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app import cache, genre_cache, metrics, models, versioning
+from app.loaders import BOOK_FIELDS, FULL_VIEW, BookView
+from app.pagination import PageParams, encode_cursor
+
+COUNTERS = (versioning.BOOKS, versioning.AUTHORS, versioning.GENRES)
+# Loads attempted per refresh while writes keep changing the counters.
+LOAD_ATTEMPTS = 3
+
+def _ordinal(value: Optional[date]) -> int:
+    return value.toordinal() if value is not None else 0
+
+def _date(ordinal: int) -> Optional[date]:
+    return date.fromordinal(ordinal) if ordinal else None
+
+class Adjacency:
+    """
+    Compressed sparse rows: the IDs linked to the entity at position ``i``
+    are ``refs[offsets[i]:offsets[i + 1]]``, in ascending order.
+    """
+    __slots__ = ("offsets", "refs")
+
+    def __init__(self, owner_ids: array, pairs: Iterable[Tuple[int, int]]):
+        # ``pairs`` are (owner ID, referenced ID), ordered by both.
+        self.offsets = array("i", [0])
+        self.refs = array("i")
+        position = 0
+        for owner_id, ref_id in pairs:
+            index = bisect.bisect_left(owner_ids, owner_id)
+            if index == len(owner_ids) or owner_ids[index] != owner_id:
+                continue
+            while position < index:
+                self.offsets.append(len(self.refs))
+                position += 1
+            self.refs.append(ref_id)
+        while position < len(owner_ids):
+            self.offsets.append(len(self.refs))
+            position += 1
+
+    def bounds(self, index: int) -> Tuple[int, int]:
+        """
+        Slice of ``refs`` linked to the entity at ``index``.
+        """
+        return self.offsets[index], self.offsets[index + 1]
+
+    def linked(self, index: int) -> List[int]:
+        """
+        IDs linked to the entity at ``index``.
+        """
+        start, end = self.bounds(index)
+        return self.refs[start:end].tolist()
+
+    def nbytes(self) -> int:
+        """
+        Size of the arrays in bytes.
+        """
+        return (len(self.offsets) + len(self.refs)) * self.offsets.itemsize
+
+class CatalogSnapshot:  # pylint: disable=too-many-instance-attributes
+    """
+    Immutable, array-backed copy of the catalog at one point in time.
+    """
+
+    def __init__(self, db_session: Session, counters: Dict[str, int]):
+        self.counters = counters
+        book = models.Book
+        self.book_ids = array("i")
+        self.book_versions = array("i")
+        self.book_dates = array("i")
+        self.titles: List[str] = []
+        for book_id, title, published, version in db_session.execute(
+                select(book.id, book.title, book.publication_date, book.version)
+                .order_by(book.id)):
+            self.book_ids.append(book_id)
+            self.titles.append(title)
+            self.book_dates.append(_ordinal(published))
+            self.book_versions.append(version)
+
+        author = models.Author
+        self.author_ids = array("i")
+        self.author_versions = array("i")
+        self.author_dates = array("i")
+        self.names: List[str] = []
+        for author_id, full_name, birth_date, version in db_session.execute(
+                select(author.id, author.full_name, author.birth_date, author.version)
+                .order_by(author.id)):
+            self.author_ids.append(author_id)
+            self.names.append(full_name)
+            self.author_dates.append(_ordinal(birth_date))
+            self.author_versions.append(version)
+
+        self.genres = genre_cache.build(db_session)
+        self.genre_ids = array("i", self.genres.ids)
+
+        book_authors, book_genres = models.book_authors.c, models.book_genres.c
+        self.book_authors = Adjacency(self.book_ids, db_session.execute(
+            select(book_authors.book_id, book_authors.author_id)
+            .order_by(book_authors.book_id, book_authors.author_id)))
+        self.author_books = Adjacency(self.author_ids, db_session.execute(
+            select(book_authors.author_id, book_authors.book_id)
+            .order_by(book_authors.author_id, book_authors.book_id)))
+        self.book_genres = Adjacency(self.book_ids, db_session.execute(
+            select(book_genres.book_id, book_genres.genre_id)
+            .order_by(book_genres.book_id, book_genres.genre_id)))
+        self.genre_books = Adjacency(self.genre_ids, db_session.execute(
+            select(book_genres.genre_id, book_genres.book_id)
+            .order_by(book_genres.genre_id, book_genres.book_id)))
+
+    # Lookups
+
+    @staticmethod
+    def _position(ids: array, entity_id: int) -> Optional[int]:
+        index = bisect.bisect_left(ids, entity_id)
+        if index < len(ids) and ids[index] == entity_id:
+            return index
+        return None
+
+    def _book_position(self, book_id: int) -> int:
+        index = self._position(self.book_ids, book_id)
+        if index is None:
+            raise HTTPException(status_code=404, detail="Book not found")
+        return index
+
+    def _author_position(self, author_id: int) -> int:
+        index = self._position(self.author_ids, author_id)
+        if index is None:
+            raise HTTPException(status_code=404, detail="Author not found")
+        return index
+
+    def book_etag(self, book_id: int, variant: Optional[str] = None) -> str:
+        """
+        Strong ETag of a book, or of its representation ``variant``; raises a
+        404 error if missing.
+        """
+        return versioning.strong_etag(
+            "book", book_id, self.book_versions[self._book_position(book_id)], variant)
+
+    def author_etag(self, author_id: int) -> str:
+        """
+        Strong ETag of an author; raises a 404 error if missing.
+        """
+        return versioning.strong_etag(
+            "author", author_id, self.author_versions[self._author_position(author_id)])
+
+    def list_etag(self, tables: Sequence[str]) -> str:
+        """
+        Weak list ETag from the change counters the snapshot was loaded at.
+        """
+        return versioning.weak_etag({name: self.counters[name] for name in tables})
+
+    # Records, shaped like app.loaders
+
+    def _author_record(self, index: int) -> Dict[str, Any]:
+        return {
+            "full_name": self.names[index],
+            "birth_date": _date(self.author_dates[index]),
+            "id": self.author_ids[index],
+        }
+
+    def _genre_record(self, genre_id: int) -> Optional[Dict[str, Any]]:
+        node = self.genres.nodes.get(genre_id)
+        if node is None:
+            return None
+        return {"name": node.name, "id": node.id, "parent_id": node.parent_id}
+
+    def _embedded_authors(self, author_ids: List[int]) -> List[Dict[str, Any]]:
+        positions = (self._position(self.author_ids, author_id) for author_id in author_ids)
+        return [self._author_record(index) for index in positions if index is not None]
+
+    def _book_records(self, positions: Iterable[int], view: BookView) -> List[Dict[str, Any]]:
+        fields, include = view.fields, view.include
+        records = []
+        for index in positions:
+            values = {
+                "title": self.titles[index],
+                "publication_date": _date(self.book_dates[index]),
+                "id": self.book_ids[index],
+            }
+            if "authors" in fields:
+                author_ids = self.book_authors.linked(index)
+                values["authors"] = (
+                    self._embedded_authors(author_ids) if "authors" in include else author_ids)
+            if "genres" in fields:
+                genre_ids = self.book_genres.linked(index)
+                values["genres"] = genre_ids if "genres" not in include else [
+                    record for record in map(self._genre_record, genre_ids) if record is not None]
+            if view is FULL_VIEW:
+                records.append(values)
+            else:
+                records.append({
+                    field: values[field] for field in BOOK_FIELDS
+                    if field == "id" or field in fields
+                })
+        return records
+
+    # Read endpoints, mirroring app.crud
+
+    def read_book(self, book_id: int, view: BookView = FULL_VIEW) -> Dict[str, Any]:
+        """
+        Same as ``crud.read_book``.
+        """
+        return self._book_records([self._book_position(book_id)], view)[0]
+
+    def read_books(self, book_ids: List[int], view: BookView = FULL_VIEW) -> Dict[str, Any]:
+        """
+        Same as ``crud.read_books``.
+        """
+        positions = [self._position(self.book_ids, book_id) for book_id in book_ids]
+        return {
+            "items": self._book_records((i for i in positions if i is not None), view),
+            "missing": [book_id for book_id, i in zip(book_ids, positions) if i is None],
+        }
+
+    def read_author(self, author_id: int) -> Dict[str, Any]:
+        """
+        Same as ``crud.read_author``.
+        """
+        return self._author_record(self._author_position(author_id))
+
+    def read_authors(self, author_ids: List[int]) -> Dict[str, Any]:
+        """
+        Same as ``crud.read_authors``.
+        """
+        positions = [self._position(self.author_ids, author_id) for author_id in author_ids]
+        return {
+            "items": [self._author_record(i) for i in positions if i is not None],
+            "missing": [author_id for author_id, i in zip(author_ids, positions) if i is None],
+        }
+
+    @staticmethod
+    def _page(
+        ids: array,
+        start: int,
+        end: int,
+        page: PageParams) -> Tuple[range, Optional[str]]:
+        """
+        Positions in ``ids[start:end]`` of the page following ``page.after_id``.
+        """
+        after_id = page.after_id
+        if after_id is not None:
+            start = bisect.bisect_right(ids, after_id, start, end)
+        stop = min(start + page.limit, end)
+        next_cursor = encode_cursor(ids[stop - 1]) if stop < end else None
+        return range(start, stop), next_cursor
+
+    def list_books(
+        self,
+        page: PageParams,
+        view: BookView = FULL_VIEW) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Same as ``crud.list_books`` without filters.
+        """
+        positions, next_cursor = self._page(self.book_ids, 0, len(self.book_ids), page)
+        return self._book_records(positions, view), next_cursor
+
+    def list_authors(self, page: PageParams) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Same as ``crud.list_authors``.
+        """
+        positions, next_cursor = self._page(self.author_ids, 0, len(self.author_ids), page)
+        return [self._author_record(i) for i in positions], next_cursor
+
+    def _linked_books(
+        self,
+        adjacency: Adjacency,
+        index: int,
+        page: PageParams,
+        view: BookView) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        start, end = adjacency.bounds(index)
+        refs, next_cursor = self._page(adjacency.refs, start, end, page)
+        positions = (self._position(self.book_ids, adjacency.refs[i]) for i in refs)
+        return self._book_records((i for i in positions if i is not None), view), next_cursor
+
+    def list_books_by_author(
+        self,
+        author_id: int,
+        page: PageParams,
+        view: BookView = FULL_VIEW) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Same as ``crud.list_books_by_author``.
+        """
+        return self._linked_books(self.author_books, self._author_position(author_id), page, view)
+
+    def list_books_by_genre(
+        self,
+        genre_id: int,
+        page: PageParams,
+        view: BookView = FULL_VIEW) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Same as ``crud.list_books_by_genre`` without subgenres.
+        """
+        index = self._position(self.genre_ids, genre_id)
+        if index is None:
+            raise HTTPException(status_code=404, detail="Genre not found")
+        return self._linked_books(self.genre_books, index, page, view)
+
+    def nbytes(self) -> int:
+        """
+        Approximate memory held by the snapshot, excluding the genre tree.
+        """
+        arrays = (self.book_ids, self.book_versions, self.book_dates,
+                  self.author_ids, self.author_versions, self.author_dates, self.genre_ids)
+        strings = sum(len(value.encode()) + 49 for value in (*self.titles, *self.names))
+        return (sum(len(values) * values.itemsize for values in arrays)
+                + 8 * (len(self.titles) + len(self.names)) + strings
+                + sum(adjacency.nbytes() for adjacency in (
+                    self.book_authors, self.author_books, self.book_genres, self.genre_books)))
+
+_snapshot: Optional[CatalogSnapshot] = None
+
+def current() -> Optional[CatalogSnapshot]:
+    """
+    The snapshot to serve reads from, or None when snapshot mode is off or
+    the first load has not completed.
+    """
+    return _snapshot
+
+def refresh(db_session: Session, force: bool = False) -> bool:
+    """
+    Load a new snapshot and swap it in, unless the change counters show the
+    current one is up to date. Returns whether a new snapshot was loaded.
+
+    The tables are read with separate queries; the load is repeated when a
+    write bumped the counters meanwhile, so the snapshot is consistent.
+    """
+    global _snapshot  # pylint: disable=global-statement
+    counters = versioning.read_counters(db_session, COUNTERS)
+    if not force and _snapshot is not None and counters == _snapshot.counters:
+        return False
+    for _attempt in range(LOAD_ATTEMPTS):
+        loaded = CatalogSnapshot(db_session, counters)
+        latest = versioning.read_counters(db_session, COUNTERS)
+        if latest == counters:
+            break
+        # When writes keep landing, the last load is served anyway: its
+        # counters are already behind, so the next refresh replaces it.
+        counters = latest
+    _snapshot = loaded
+    metrics.observe_snapshot(loaded.nbytes(), time.time())
+    # Cached responses may have been built from the previous snapshot.
+    cache.response_cache.clear()
+    return True
+
+def clear():
+    """
+    Stop serving from the snapshot.
+    """
+    global _snapshot  # pylint: disable=global-statement
+    _snapshot = None
@@ -0,0 +1,92 @@
+"""
+Row versions, change counters and ETags.
+
+Books and authors carry a ``version`` column that every write bumps; it is
+the source of their strong ETags and of the ``If-Match`` checks on ``PUT``.
+List endpoints get weak ETags derived from per-table change counters,
+bumped in the same transaction as the writes to that table.
+"""
+from typing import Dict, Iterable, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import insert, select, update
+from sqlalchemy.orm import Session
+
+from app import models
+
+BOOKS = "books"
+AUTHORS = "authors"
+GENRES = "genres"
+
+def bump_counters(db_session: Session, names: Iterable[str]):
+    """
+    Increment the change counters of the given tables.
+    """
+    counter = models.ChangeCounter
+    for name in names:
+        result = db_session.execute(
+            update(counter).where(counter.name == name).values(value=counter.value + 1)
+            .execution_options(synchronize_session=False))
+        if result.rowcount == 0:
+            db_session.execute(insert(counter).values(name=name, value=1))
+
+def read_counters(db_session: Session, names: Iterable[str]) -> Dict[str, int]:
+    """
+    Current change counters of the given tables.
+    """
+    names = list(names)
+    counter = models.ChangeCounter
+    values = dict(db_session.execute(
+        select(counter.name, counter.value).where(counter.name.in_(names))).all())
+    return {name: values.get(name, 0) for name in names}
+
+def strong_etag(kind: str, entity_id: int, version: int, variant: Optional[str] = None) -> str:
+    """
+    Strong ETag of a versioned entity, or of its partial representation
+    ``variant``.
+    """
+    if variant is not None:
+        return f'"{kind}-{entity_id}-v{version}-{variant}"'
+    return f'"{kind}-{entity_id}-v{version}"'
+
+def weak_etag(counters: Dict[str, int]) -> str:
+    """
+    Weak ETag of a list derived from the change counters it depends on.
+    """
+    return 'W/"' + "-".join(f"{name}{value}" for name, value in counters.items()) + '"'
+
+def _etag_list(header: str):
+    return [tag.strip() for tag in header.split(",") if tag.strip()]
+
+def none_match(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """
+    Whether ``If-None-Match`` matches ``etag``, i.e. a 304 can be returned.
+
+    Uses the weak comparison required for ``If-None-Match``.
+    """
+    if not if_none_match or not etag:
+        return False
+    candidates = _etag_list(if_none_match)
+    if "*" in candidates:
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.removeprefix("W/") == opaque for candidate in candidates)
+
+def expected_version(if_match: Optional[str], kind: str, entity_id: int) -> Optional[int]:
+    """
+    Version required by an ``If-Match`` header, or None when any version is accepted.
+
+    Raises a 412 error when the header cannot match this entity.
+    """
+    if not if_match:
+        return None
+    candidates = _etag_list(if_match)
+    if "*" in candidates:
+        return None
+    prefix = f'"{kind}-{entity_id}-v'
+    for candidate in candidates:
+        if candidate.startswith(prefix) and candidate.endswith('"'):
+            version = candidate[len(prefix):-1]
+            if version.isdigit():
+                return int(version)
+    raise HTTPException(status_code=412, detail="Precondition failed")
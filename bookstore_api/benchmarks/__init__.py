@@ -0,0 +1,8 @@
+"""
+Benchmark suite for the bookstore API.
+
+Run ``python -m benchmarks run --books 100000`` from the project root to
+generate (once) a synthetic catalog and benchmark every endpoint against it,
+and ``python -m benchmarks compare baseline.json current.json`` to compare
+two saved runs. See ``benchmarks/__main__.py`` for all options.
+"""
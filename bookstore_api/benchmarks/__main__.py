@@ -0,0 +1,143 @@
+"""
+Command line entry point of the benchmark suite.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Any, Dict
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def run(args: argparse.Namespace) -> int:
+    """
+    Generate the catalog if needed, benchmark every endpoint and save the results.
+    """
+    database_url = args.database_url or f"sqlite:///./benchmark-{args.books}.db"
+    # Settings are read when the app package is first imported.
+    os.environ["SQLALCHEMY_DATABASE_URL"] = database_url
+    os.environ["RESPONSE_CACHE_ENABLED"] = "false" if args.no_cache else "true"
+    if args.use_async:
+        os.environ["DB_ASYNC"] = "true"
+
+    # pylint: disable=import-outside-toplevel
+    from app import database
+    from benchmarks import catalog, driver
+
+    database.init_db()
+    with database.SessionLocal() as db_session:
+        stored = catalog.stored_catalog(db_session)
+        if stored is None:
+            started = time.perf_counter()
+            sizes = catalog.generate_catalog(db_session, args.books, args.seed)
+            print(f"Generated {sizes} in {time.perf_counter() - started:.1f} s", flush=True)
+        elif stored != catalog.catalog_marker(args.books, args.seed):
+            print(f"{database_url} holds another catalog ({stored})", file=sys.stderr)
+            return 1
+    sizes = {
+        "books": args.books,
+        "authors": max(1, args.books // catalog.BOOKS_PER_AUTHOR),
+        "genres": len(database.taxonomy_rows()),
+    }
+
+    state = driver.RunState(seed=args.seed, **sizes)
+    results = asyncio.run(driver.run(
+        state, args.mode, driver.Load(args.requests, args.concurrency),
+        driver.Server(args.workers, args.port), only=args.only))
+    report: Dict[str, Any] = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "database": database.engine.dialect.name,
+            "catalog": {**sizes, "seed": args.seed},
+            "mode": args.mode,
+            "async": args.use_async,
+            "response_cache": not args.no_cache,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "workers": args.workers if args.mode == "uvicorn" else None,
+        },
+        "endpoints": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as output:
+        json.dump(report, output, indent=2)
+    print(f"Saved results to {args.output}")
+    return 0
+
+def compare(args: argparse.Namespace) -> int:
+    """
+    Compare two saved runs; fails when an endpoint's p95 latency regressed
+    by more than the threshold.
+    """
+    with open(args.baseline, encoding="utf-8") as baseline_file:
+        baseline = json.load(baseline_file)["endpoints"]
+    with open(args.current, encoding="utf-8") as current_file:
+        current = json.load(current_file)["endpoints"]
+
+    regressions = 0
+    for name, result in current.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        old_p95 = before["latency_ms"]["p95"]
+        new_p95 = result["latency_ms"]["p95"]
+        change = (new_p95 - old_p95) / old_p95 if old_p95 else 0.0
+        regressed = change > args.threshold
+        regressions += regressed
+        print(
+            f"{name:<50} p95 {old_p95:>9} -> {new_p95:>9} ms ({change:+.0%})  "
+            f"sql {before['sql_per_request']} -> {result['sql_per_request']}"
+            f"{'  REGRESSION' if regressed else ''}")
+    return 1 if regressions else 0
+
+def main() -> int:
+    """
+    Parse the command line and run the requested command.
+    """
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="benchmark every endpoint")
+    run_parser.add_argument("--books", type=int, default=10000,
+                            help="catalog size, e.g. 10000, 100000 or 1000000")
+    run_parser.add_argument("--seed", type=int, default=42)
+    run_parser.add_argument("--database-url",
+                            help="defaults to sqlite:///./benchmark-<books>.db")
+    run_parser.add_argument("--mode", choices=("asgi", "uvicorn"), default="asgi")
+    run_parser.add_argument("--requests", type=int, default=500,
+                            help="requests per endpoint")
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--workers", type=int, default=4,
+                            help="uvicorn worker processes")
+    run_parser.add_argument("--port", type=int, default=8765)
+    run_parser.add_argument("--no-cache", action="store_true",
+                            help="disable the response cache")
+    run_parser.add_argument("--async", dest="use_async", action="store_true",
+                            help="serve endpoints with AsyncSession")
+    run_parser.add_argument("--only", nargs="*", help="scenario names to run")
+    run_parser.add_argument("--output", default="benchmark-results.json")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser("compare", help="compare two saved runs")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="tolerated relative p95 increase")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
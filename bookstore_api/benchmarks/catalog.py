@@ -0,0 +1,123 @@
+"""
+Deterministic synthetic catalogs for benchmarking.
+
+The same ``books`` / ``seed`` pair always produces the same rows: titles
+drawn from a fixed vocabulary, a skewed author distribution (a few prolific
+authors, a long tail of one-book authors) and genres drawn from the seeded
+taxonomy with a preference for leaf genres. Rows get preassigned IDs and
+are written with executemany inserts, one commit per chunk.
+"""
+import random
+from datetime import date, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, insert, select, text
+from sqlalchemy.orm import Session
+
+from app import models, related, search
+
+CATALOG_KEY = "benchmark_catalog"
+CHUNK_SIZE = 10000
+BOOKS_PER_AUTHOR = 5
+
+WORDS = (
+    "shadow river winter crown glass garden silent empire night stone house "
+    "ghost journey iron secret storm forest letters city mirror ember ocean "
+    "kingdom song lost last first wild broken golden hidden dark bright "
+    "memory star wolf sea road bridge tower island fire heart quiet long"
+).split()
+FIRST_NAMES = (
+    "Ada Alan Clara David Elena Farid Grace Hana Ivan Jana Kofi Lena Mara "
+    "Nadia Omar Priya Quinn Rosa Sami Tove Umar Vera Wen Yusuf Zora"
+).split()
+LAST_NAMES = (
+    "Abe Brandt Costa Dube Eriksen Fontaine Garcia Haddad Ito Jensen Kowalski "
+    "Laine Moreau Novak Okafor Petrov Quist Rossi Sato Tanaka Ueda Varga Weber"
+).split()
+
+def catalog_marker(books: int, seed: int) -> str:
+    """
+    Value recorded in ``app_state`` once a catalog has been generated.
+    """
+    return f"{books}:{seed}"
+
+def stored_catalog(db_session: Session) -> Optional[str]:
+    """
+    Marker of the catalog already generated in the database, if any.
+    """
+    return db_session.scalar(
+        select(models.AppState.value).where(models.AppState.key == CATALOG_KEY))
+
+def _random_date(rng: random.Random, start: date, days: int) -> date:
+    return start + timedelta(days=rng.randrange(days))
+
+def _skewed_index(rng: random.Random, size: int) -> int:
+    # Squaring a uniform draw favours low indexes, so the first authors
+    # write most of the books.
+    return int(size * rng.random() ** 2)
+
+def _leaf_weighted_genres(genre_rows) -> List[int]:
+    parent_ids = {parent_id for _, parent_id in genre_rows}
+    pool = []
+    for genre_id, _ in genre_rows:
+        pool.extend([genre_id] * (1 if genre_id in parent_ids else 4))
+    return pool
+
+def generate_catalog(db_session: Session, books: int, seed: int = 42) -> Dict[str, int]:
+    """
+    Fill an empty catalog with ``books`` books and their authors.
+
+    Genres must already be seeded (see ``app.database.init_db``). Returns
+    the number of books, authors and genres of the catalog.
+    """
+    if db_session.scalar(
+            select(func.count()).select_from(models.Book)):  # pylint: disable=not-callable
+        raise ValueError("The catalog already contains books")
+    rng = random.Random(seed)
+    genre_rows = db_session.execute(
+        select(models.Genre.id, models.Genre.parent_id).order_by(models.Genre.id)).all()
+    genre_pool = _leaf_weighted_genres(genre_rows)
+    author_count = max(1, books // BOOKS_PER_AUTHOR)
+
+    for start in range(0, author_count, CHUNK_SIZE):
+        db_session.execute(insert(models.Author), [
+            {
+                "id": author_id,
+                "full_name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+                "birth_date": _random_date(rng, date(1900, 1, 1), 100 * 365),
+            }
+            for author_id in range(start + 1, min(start + CHUNK_SIZE, author_count) + 1)
+        ])
+        db_session.commit()
+
+    for start in range(0, books, CHUNK_SIZE):
+        book_rows, author_links, genre_links = [], [], []
+        for book_id in range(start + 1, min(start + CHUNK_SIZE, books) + 1):
+            book_rows.append({
+                "id": book_id,
+                "title": " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))).title(),
+                "publication_date": _random_date(rng, date(1900, 1, 1), 125 * 365),
+            })
+            author_ids = {
+                _skewed_index(rng, author_count) + 1
+                for _ in range(rng.choices((1, 2, 3), (70, 25, 5))[0])
+            }
+            genre_ids = {rng.choice(genre_pool) for _ in range(rng.randint(1, 3))}
+            author_links.extend({"book_id": book_id, "author_id": i} for i in sorted(author_ids))
+            genre_links.extend({"book_id": book_id, "genre_id": i} for i in sorted(genre_ids))
+        db_session.execute(insert(models.Book), book_rows)
+        db_session.execute(insert(models.book_authors), author_links)
+        db_session.execute(insert(models.book_genres), genre_links)
+        db_session.commit()
+
+    if db_session.get_bind().dialect.name == "postgresql":
+        # Explicit IDs do not advance the serial sequences.
+        for table in ("authors", "books"):
+            db_session.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"(SELECT max(id) FROM {table}))"))
+    search.get_backend(db_session).rebuild(db_session)
+    related.rebuild(db_session)
+    db_session.merge(models.AppState(key=CATALOG_KEY, value=catalog_marker(books, seed)))
+    db_session.commit()
+    return {"books": books, "authors": author_count, "genres": len(genre_rows)}
@@ -0,0 +1,396 @@
+"""
+Benchmark driver exercising every endpoint of ``app.main``.
+
+Each scenario issues requests against one route with randomized but
+reproducible parameters, from ``concurrency`` concurrent clients, and
+reports throughput, latency percentiles and (in ASGI mode) the number of
+SQL statements per request.
+
+Two transports are supported:
+
+* ``asgi``: requests go through ``httpx.ASGITransport`` straight into the
+  application in this process, which also lets SQL statements be counted.
+* ``uvicorn``: the application is served by a separate uvicorn process with
+  ``workers`` workers and driven over real HTTP connections.
+"""
+import asyncio
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import httpx
+from sqlalchemy import event
+
+Request = Tuple[str, str, Dict[str, Any]]
+
+class Load(NamedTuple):
+    """
+    How hard each scenario is driven: the requests issued and the clients
+    issuing them concurrently.
+    """
+    requests: int
+    concurrency: int
+
+class Server(NamedTuple):
+    """
+    The uvicorn server of ``uvicorn`` mode.
+    """
+    workers: int = 1
+    port: int = 8765
+
+class RunState:
+    """
+    Catalog dimensions and IDs of the rows created during the run, in pools
+    named after what they hold ("books", "jobs", "batch_books"...).
+    """
+
+    def __init__(self, books: int, authors: int, genres: int, seed: int):
+        self.books = books
+        self.authors = authors
+        self.genres = genres
+        self.rng = random.Random(seed)
+        self.created: Dict[str, deque] = defaultdict(deque)
+
+    def book_id(self) -> int:
+        """A random book of the generated catalog."""
+        return self.rng.randint(1, self.books)
+
+    def author_id(self) -> int:
+        """A random author of the generated catalog."""
+        return self.rng.randint(1, self.authors)
+
+    def genre_id(self) -> int:
+        """A random seeded genre."""
+        return self.rng.randint(1, self.genres)
+
+    def id_list(self, pick: Callable[[], int], count: int = 20) -> str:
+        """``count`` random IDs drawn with ``pick``, as a multi-get ``ids`` parameter."""
+        return ",".join(str(pick()) for _ in range(count))
+
+    def book_payload(self) -> Dict[str, Any]:
+        """A valid book creation payload."""
+        return {
+            "title": f"Benchmark Book {self.rng.randrange(10 ** 9)}",
+            "publication_date": "2020-01-01",
+            "author_ids": [self.author_id()],
+            "genre_ids": [self.genre_id(), self.genre_id()],
+        }
+
+    def author_payload(self) -> Dict[str, Any]:
+        """A valid author creation payload."""
+        return {"full_name": f"Benchmark Author {self.rng.randrange(10 ** 9)}",
+                "birth_date": "1970-01-01"}
+
+class Scenario(NamedTuple):
+    """
+    One benchmarked route: how to build a request, or None to skip one when
+    there is no row to use, and what to remember of the response.
+    """
+    name: str
+    request: Callable[[RunState], Optional[Request]]
+    on_response: Optional[Callable[[RunState, httpx.Response], None]] = None
+    max_requests: Optional[int] = None
+
+def _remember(*pools: str) -> Callable[[RunState, httpx.Response], None]:
+    # With several pools, each ID goes to the shortest one so they fill evenly.
+    def remember(state, response):
+        if response.status_code in (200, 202):
+            pool = min(pools, key=lambda name: len(state.created[name]))
+            state.created[pool].append(response.json()["id"])
+    return remember
+
+def _remember_bulk(pool: str) -> Callable[[RunState, httpx.Response], None]:
+    def remember(state, response):
+        if response.status_code == 200:
+            state.created[pool].extend(
+                result["id"] for result in response.json()["results"] if result["id"])
+    return remember
+
+def _delete_created(pool: str, path: str) -> Callable[[RunState], Optional[Request]]:
+    def request(state):
+        created = state.created[pool]
+        return ("DELETE", f"{path}/{created.popleft()}", {}) if created else None
+    return request
+
+def _delete_created_batch(pool: str, path: str) -> Callable[[RunState], Optional[Request]]:
+    def request(state):
+        created = state.created[pool]
+        ids = [created.popleft() for _ in range(min(10, len(created)))]
+        return ("DELETE", path, {"json": {"ids": ids}}) if ids else None
+    return request
+
+def _cycled(state: RunState, pool: str, fallback: Callable[[], int]) -> int:
+    created = state.created[pool]
+    if not created:
+        return fallback()
+    created.rotate(-1)
+    return created[0]
+
+def _read_created_job(state: RunState) -> Optional[Request]:
+    created = state.created["jobs"]
+    if not created:
+        return None
+    created.rotate(-1)
+    return ("GET", f"/jobs/{created[0]}", {})
+
+SEARCH_TERMS = ("shadow", "river crown", "gold", "night sea", "tower", "Ada", "Weber", "ir")
+
+# Writes run before the reads that depend on the rows they create, and
+# deletes come last so that they only remove rows created by the run.
+SCENARIOS: List[Scenario] = [
+    Scenario("GET /", lambda s: ("GET", "/", {})),
+    Scenario("POST /books/", lambda s: ("POST", "/books/", {"json": s.book_payload()}),
+             _remember("books")),
+    Scenario("POST /books/bulk", lambda s: (
+        "POST", "/books/bulk", {"json": [s.book_payload() for _ in range(100)]}),
+             _remember_bulk("batch_books")),
+    Scenario("POST /authors/", lambda s: ("POST", "/authors/", {"json": s.author_payload()}),
+             _remember("authors", "batch_authors")),
+    Scenario("POST /genres/", lambda s: ("POST", "/genres/", {"json": {
+        "name": f"Benchmark Genre {s.rng.randrange(10 ** 9)}", "parent_id": s.genre_id()}}),
+             _remember("genres")),
+    Scenario("GET /books/{book_id}", lambda s: ("GET", f"/books/{s.book_id()}", {})),
+    Scenario("GET /books/{book_id}/related", lambda s: (
+        "GET", f"/books/{s.book_id()}/related", {})),
+    Scenario("GET /books?ids=", lambda s: ("GET", "/books", {"params": {
+        "ids": s.id_list(s.book_id)}})),
+    Scenario("GET /books/", lambda s: ("GET", "/books/", {"params": {
+        "limit": 100, "cursor": None}})),
+    Scenario("GET /books/ (filtered)", lambda s: ("GET", "/books/", {"params": {
+        "limit": 100, "published_from": "1950-01-01", "published_to": "1970-12-31",
+        "genre_id": s.genre_id()}})),
+    Scenario("GET /books/ (sorted)", lambda s: ("GET", "/books/", {"params": {
+        "limit": 100, "sort": s.rng.choice(("title", "-publication_date"))}})),
+    Scenario("GET /books/ (deep page)", lambda s: ("GET", "/books/", {"params": {
+        "limit": 100, "cursor": _cursor(s.book_id())}})),
+    Scenario("GET /search", lambda s: ("GET", "/search", {"params": {
+        "q": s.rng.choice(SEARCH_TERMS), "limit": 20}})),
+    Scenario("GET /authors/", lambda s: ("GET", "/authors/", {"params": {
+        "limit": 100, "cursor": _cursor(s.author_id())}})),
+    Scenario("GET /authors?ids=", lambda s: ("GET", "/authors", {"params": {
+        "ids": s.id_list(s.author_id)}})),
+    Scenario("GET /authors/{author_id}", lambda s: ("GET", f"/authors/{s.author_id()}", {})),
+    Scenario("GET /authors/{author_id}/books", lambda s: (
+        "GET", f"/authors/{s.author_id()}/books", {})),
+    Scenario("GET /genres/", lambda s: ("GET", "/genres/", {})),
+    Scenario("GET /genres?ids=", lambda s: ("GET", "/genres", {"params": {
+        "ids": s.id_list(s.genre_id)}})),
+    Scenario("GET /genres/{genre_id}", lambda s: ("GET", f"/genres/{s.genre_id()}", {})),
+    Scenario("GET /genres/{genre_id}/descendants", lambda s: (
+        "GET", f"/genres/{s.genre_id()}/descendants", {})),
+    Scenario("GET /genres/{genre_id}/ancestors", lambda s: (
+        "GET", f"/genres/{s.genre_id()}/ancestors", {})),
+    Scenario("GET /genres/{genre_id}/books", lambda s: (
+        "GET", f"/genres/{s.genre_id()}/books", {"params": {"limit": 100}})),
+    Scenario("GET /genres/{genre_id}/books?include_descendants", lambda s: (
+        "GET", f"/genres/{s.genre_id()}/books",
+        {"params": {"limit": 100, "include_descendants": "true"}})),
+    Scenario("POST /jobs/import-books", lambda s: (
+        "POST", "/jobs/import-books", {"json": [s.book_payload() for _ in range(100)]}),
+             _remember("jobs")),
+    Scenario("POST /jobs/rebuild/{index}", lambda s: (
+        "POST", f"/jobs/rebuild/{s.rng.choice(('related', 'search'))}", {}),
+             _remember("jobs"), max_requests=2),
+    Scenario("GET /jobs/{job_id}", _read_created_job),
+    Scenario("GET /changes", lambda s: ("GET", "/changes", {"params": {"limit": 100}})),
+    Scenario("GET /export/books", lambda s: ("GET", "/export/books", {}), max_requests=3),
+    Scenario("GET /export/authors", lambda s: ("GET", "/export/authors", {}), max_requests=3),
+    Scenario("GET /export/genres", lambda s: ("GET", "/export/genres", {})),
+    Scenario("GET /cache/stats", lambda s: ("GET", "/cache/stats", {})),
+    Scenario("GET /metrics", lambda s: ("GET", "/metrics", {})),
+    Scenario("GET /admission/stats", lambda s: ("GET", "/admission/stats", {})),
+    Scenario("PUT /books/{book_id}", lambda s: (
+        "PUT", f"/books/{_cycled(s, 'books', s.book_id)}", {"json": s.book_payload()})),
+    Scenario("PATCH /books/{book_id}", lambda s: (
+        "PATCH", f"/books/{_cycled(s, 'books', s.book_id)}",
+        {"json": {"title": f"Patched Book {s.rng.randrange(10 ** 9)}"}})),
+    Scenario("PUT /authors/{author_id}", lambda s: (
+        "PUT", f"/authors/{_cycled(s, 'authors', s.author_id)}",
+        {"json": s.author_payload()})),
+    Scenario("PUT /genres/{genre_id}", lambda s: (
+        "PUT", f"/genres/{_cycled(s, 'genres', s.genre_id)}",
+        {"json": {"name": f"Renamed Genre {s.rng.randrange(10 ** 9)}"}})),
+    Scenario("DELETE /books/{book_id}", _delete_created("books", "/books")),
+    Scenario("DELETE /authors/{author_id}", _delete_created("authors", "/authors")),
+    Scenario("DELETE /books", _delete_created_batch("batch_books", "/books")),
+    Scenario("DELETE /authors", _delete_created_batch("batch_authors", "/authors")),
+]
+
+def _cursor(after_id: int) -> str:
+    from app.pagination import encode_cursor  # pylint: disable=import-outside-toplevel
+    return encode_cursor(after_id)
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    Nearest-rank percentile of already sorted ``values``.
+    """
+    if not values:
+        return 0.0
+    rank = max(1, math.ceil(percent / 100 * len(values)))
+    return values[rank - 1]
+
+class StatementCounter:
+    """
+    Counts the SQL statements executed by the application's engines.
+    """
+
+    def __init__(self):
+        from app import database  # pylint: disable=import-outside-toplevel
+        engines = [database.engine, database.read_engine]
+        engines += [engine.sync_engine for engine in (
+            database.async_engine, database.async_read_engine) if engine is not None]
+        self.engines = list({id(engine): engine for engine in engines}.values())
+        self.count = 0
+
+    def _count(self, *_args):
+        self.count += 1
+
+    def __enter__(self):
+        for engine in self.engines:
+            event.listen(engine, "before_cursor_execute", self._count)
+        return self
+
+    def __exit__(self, *_exc):
+        for engine in self.engines:
+            event.remove(engine, "before_cursor_execute", self._count)
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    scenario: Scenario,
+    state: RunState,
+    load: Load,
+    counter: Optional[StatementCounter]) -> Dict[str, Any]:
+    """
+    Issue the requests of a scenario and summarize their timings. Requests
+    the scenario skips are counted apart.
+    """
+    requests = load.requests
+    if scenario.max_requests is not None:
+        requests = min(requests, scenario.max_requests)
+    latencies: List[float] = []
+    errors = skipped = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors, skipped
+        for _ in remaining:
+            request = scenario.request(state)
+            if request is None:
+                skipped += 1
+                continue
+            method, url, kwargs = request
+            if "params" in kwargs:
+                kwargs["params"] = {k: v for k, v in kwargs["params"].items() if v is not None}
+            started = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            await response.aread()
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+            elif scenario.on_response is not None:
+                scenario.on_response(state, response)
+
+    statements_before = counter.count if counter is not None else 0
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(load.concurrency, requests))))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    issued = len(latencies)
+    return {
+        "requests": issued,
+        "skipped": skipped,
+        "errors": errors,
+        "throughput_rps": round(issued / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else None,
+        },
+        "sql_per_request": (
+            round((counter.count - statements_before) / issued, 2)
+            if counter is not None and issued else None),
+    }
+
+@asynccontextmanager
+async def asgi_client():
+    """
+    Client calling the application in-process, with its lifespan running.
+    Server errors are answered with a 500 and counted, as over HTTP.
+    """
+    from app.main import app  # pylint: disable=import-outside-toplevel
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            yield client
+
+@asynccontextmanager
+async def uvicorn_client(server: Server, concurrency: int):
+    """
+    Client calling the application served by a uvicorn subprocess.
+    """
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    with subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(server.port),
+             "--workers", str(server.workers), "--log-level", "warning"],
+            env=os.environ.copy()) as process:
+        try:
+            async with httpx.AsyncClient(
+                    base_url=f"http://127.0.0.1:{server.port}", limits=limits,
+                    timeout=60) as client:
+                for _ in range(300):
+                    try:
+                        await client.get("/")
+                        break
+                    except httpx.TransportError:
+                        await asyncio.sleep(0.1)
+                else:
+                    raise RuntimeError("uvicorn did not start")
+                yield client
+        finally:
+            process.terminate()
+
+async def run(
+    state: RunState,
+    mode: str,
+    load: Load,
+    server: Server = Server(),
+    only: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Run every scenario (or those named in ``only``) and return their results by name.
+    """
+    if mode == "asgi":
+        client_context = asgi_client()
+        counter = StatementCounter()
+    else:
+        client_context = uvicorn_client(server, load.concurrency)
+        counter = None
+    results = {}
+    async with client_context as client:
+        for scenario in SCENARIOS:
+            if only and scenario.name not in only:
+                continue
+            if counter is not None:
+                with counter:
+                    results[scenario.name] = await run_scenario(
+                        client, scenario, state, load, counter)
+            else:
+                results[scenario.name] = await run_scenario(client, scenario, state, load, None)
+            print(_summary_line(scenario.name, results[scenario.name]), flush=True)
+    return results
+
+def _summary_line(name: str, result: Dict[str, Any]) -> str:
+    latency = result["latency_ms"]
+    sql = result["sql_per_request"]
+    return (
+        f"{name:<50} {result['throughput_rps']:>9} req/s  p50 {latency['p50']:>9} ms  "
+        f"p95 {latency['p95']:>9} ms  p99 {latency['p99']:>9} ms  "
+        f"sql {'-' if sql is None else sql:>5}  errors {result['errors']}"
+        f"{'  skipped ' + str(result['skipped']) if result['skipped'] else ''}")